@@ -20,9 +20,19 @@ internal static class UpdateDataCommon
         TypeInfoResolver = SourceGenerationContext.Default
     };
 
-    public static Stream OpenDecompressionStream(PackageCompressionType compressionType, Stream stream)
+    public static Stream OpenDecompressionStream(PackageCompressionType compressionType, Stream stream, byte[]? dictionary = null)
     {
         ArgumentNullException.ThrowIfNull(stream);
+        if (dictionary != null)
+        {
+            if (compressionType != PackageCompressionType.Zstandard)
+            {
+                throw new InvalidDataException("Dictionary is only supported for zstd packages");
+            }
+            var zstdStream = new ZstdSharp.DecompressionStream(stream, leaveOpen: true);
+            zstdStream.LoadDictionary(dictionary);
+            return zstdStream;
+        }
         return compressionType switch
         {
             PackageCompressionType.Gzip => new GZipStream(stream, CompressionMode.Decompress, leaveOpen: true),
@@ -23,6 +23,7 @@ namespace MaaUpdateEngine
     {
         [NotNull, JsonRequired] public string[] ForVersion { get; set; }
         [NotNull, JsonRequired] public Chunk[] Chunks { get; set; }
+        public int? Dictionary { get; set; }
     }
 
     internal class Chunk
@@ -31,6 +32,7 @@ namespace MaaUpdateEngine
         [JsonRequired] public long Offset { get; set; }
         [JsonRequired] public long Size { get; set; }
         [NotNull, JsonRequired] public string Hash { get; set; }
+        public bool Dictionary { get; set; }
 
         [return: NotNull]
         public string[] GetTargetVersions()
@@ -218,6 +218,10 @@ namespace MaaUpdateEngine
             else
             {
                 var apply_chunks = delta_manifest.Chunks.Where(c => c.GetTargetVersions().Contains(referencePackageManifest!.Version)).ToArray();
+                if (apply_chunks.Any(c => c.Dictionary) && delta_manifest.Dictionary is int dictionary_index && dictionary_index >= 0 && dictionary_index < delta_manifest.Chunks.Length)
+                {
+                    apply_chunks = [.. apply_chunks, delta_manifest.Chunks[dictionary_index]];
+                }
                 // maximum position relative to the first chunk
                 var last_chunk_end = chunks_offset + apply_chunks.Select(c => c.Offset + c.Size).Max();
 
@@ -89,6 +89,9 @@ namespace MaaUpdateEngine
 
             ReportBytes(total_bytes, bytes_consumed);
 
+            // chunks compressed with the package dictionary need it loaded first
+            var dictionary = apply_chunks.Any(c => c.Dictionary) ? ReadDictionary(updatePackage) : null;
+
             var patch_files = new Dictionary<string, List<PatchRecord>>();
             var interested_patch_data = new Dictionary<string, byte[]>();
 
@@ -109,7 +112,7 @@ namespace MaaUpdateEngine
 
                 chunk_stream.Position = 0;
 
-                var decompress_stream = OpenDecompressionStream(updatePackage.CompressionType, chunk_stream);
+                var decompress_stream = OpenDecompressionStream(updatePackage.CompressionType, chunk_stream, chunk_meta.Dictionary ? dictionary : null);
                 var tf = new TarReader(decompress_stream, true);
 
                 var chunk_manifest_entry = tf.GetNextEntry();
@@ -463,6 +466,30 @@ namespace MaaUpdateEngine
                 throw new NotSupportedException("Unsupported patch type");
             }
         }
+        private static byte[] ReadDictionary(UpdatePackage updatePackage)
+        {
+            var chunks = updatePackage.PackageIndex.Chunks;
+            var index = updatePackage.PackageIndex.Dictionary ?? throw new InvalidDataException("Missing dictionary chunk");
+            if (index < 0 || index >= chunks.Length)
+            {
+                throw new InvalidDataException("Invalid dictionary chunk");
+            }
+            var chunk_meta = chunks[index];
+            var chunk_stream = updatePackage.OpenChunk(chunk_meta);
+
+            var (hasher, expect_hash) = ParseHashString(chunk_meta.Hash);
+            if (!hasher.ComputeHash(chunk_stream).SequenceEqual(expect_hash))
+            {
+                throw new InvalidDataException("Invalid chunk hash");
+            }
+
+            chunk_stream.Position = 0;
+            using var decompress_stream = OpenDecompressionStream(updatePackage.CompressionType, chunk_stream);
+            using var ms = new MemoryStream();
+            decompress_stream.CopyTo(ms);
+            return ms.ToArray();
+        }
+
         private static (HashAlgorithm, byte[]) ParseHashString(string hashStr)
         {
             if (hashStr.StartsWith("sha256:"))
@@ -1,13 +1,29 @@
 from . import makedelta
-import sys
+from . import compression_profiles
+import argparse
+
+def read_list(path):
+    return [ x.strip() for x in open(path, 'r', encoding='utf-8') ]
 
 def main():
     from . import pkgprov_maa
-    if len(sys.argv) != 3:
-        print("Usage: makedelta.py <versions.txt> <nonlinear_versions.txt>")
-        sys.exit(1)
-    versions = [ x.strip() for x in open(sys.argv[1], 'r', encoding='utf-8') ]
-    nonlinear_versions = [ x.strip() for x in open(sys.argv[2], 'r', encoding='utf-8') ]
-    makedelta.main(pkgprov_maa, "MAA", "win-x64", versions, nonlinear_versions)
+    parser = argparse.ArgumentParser(prog='python -m makedelta', usage='%(prog)s [--variant VARIANT ...] [--profile PROFILE] [--frame-size MIB] [--dictionary] <versions.txt> <nonlinear_versions.txt> [<versions.txt> <nonlinear_versions.txt> ...]')
+    # each pair of lists is a target, e.g. stable, beta and nightly channels
+    parser.add_argument('lists', nargs='+', help='version list and nonlinear version list of each target')
+    parser.add_argument('--variant', action='append', help='variants to build, may be repeated (default: win-x64)')
+    parser.add_argument('--profile', choices=list(compression_profiles.PROFILES), default='release', help='compression profile (default: release)')
+    parser.add_argument('--frame-size', type=float, default=0, metavar='MIB', help='split fallback chunks into seekable zstd frames of about this size, compressed in parallel (default: one frame)')
+    parser.add_argument('--dictionary', action='store_true', help='compress small delta chunks with a zstd dictionary trained on them, consumers must support the dictionary chunk')
+    args = parser.parse_args()
+    if len(args.lists) % 2:
+        parser.error("version lists must come in pairs")
+    makedelta.compression_profile = compression_profiles.PROFILES[args.profile]
+    makedelta.chunk_frame_size = int(args.frame_size * 1048576)
+    makedelta.chunk_dictionary = args.dictionary
+    targets = [makedelta.DeltaTarget(read_list(a), read_list(b)) for a, b in zip(args.lists[0::2], args.lists[1::2])]
+    try:
+        makedelta.main(pkgprov_maa, "MAA", args.variant or ["win-x64"], targets[0].versions, targets[0].nonlinear_versions, targets[1:])
+    finally:
+        pkgprov_maa.close()
 
 main()
@@ -0,0 +1,458 @@
+"""Reference applier of delta packages, the Python counterpart of UpdateSession in MaaUpdateEngine.
+
+    python -m makedelta.apply <package> <root_dir> <current_version> [--bspatch EXECUTABLE] [--jobs N]
+
+The package is read front to back and only the chunks targeting the current version are read,
+so it can be streamed from stdin (`-`). Each chunk is decompressed and staged as it is read, memory
+does not grow with the chunk size. zstd and copy patches are applied in process, bsdiff patches
+through a hook, in parallel across files.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import typing
+
+from . import iohelper
+from . import manifest
+
+ZSTD_EXECUTABLE = os.environ.get("ZSTD", "zstd")
+MAA_BSPATCH_EXECUTABLE = os.environ.get("MAA_BSPATCH", "maa_bspatch")
+
+HEADER_MAGIC = b"\x5A\x2A\x4D\x18\x08\x00\x00\x00MUE1"
+
+BsdiffHook = typing.Callable[[str, str, str], None]
+"""Applies a bsdiff patch, called with the old file, the patch file and the new file to write"""
+
+def bspatch_executable(old_file: str, patch_file: str, new_file: str):
+    """Default bsdiff hook, runs MAA_BSPATCH <old> <patch> <new>"""
+    subprocess.run([MAA_BSPATCH_EXECUTABLE, old_file, patch_file, new_file], check=True)
+
+try:
+    from .zstd_ctypes import ZstdDecompressReader as _ZstdDecompressReader
+    def _decompress_chunk(source: typing.BinaryIO, dictionary: bytes | None, workdir: str | None) -> typing.BinaryIO:
+        return io.BufferedReader(_ZstdDecompressReader(source, dictionary), 1048576)
+
+    def _apply_zstd_patch(old_file: str, patch_file: str, new_file: str):
+        old = iohelper.read_file(old_file)
+        with open(patch_file, 'rb') as patch, _ZstdDecompressReader(patch, prefix=old) as zf, open(new_file, 'wb') as out:
+            shutil.copyfileobj(zf, out, 1048576)
+except ImportError:
+    @contextlib.contextmanager
+    def _decompress_chunk(source: typing.BinaryIO, dictionary: bytes | None, workdir: str | None) -> typing.Iterator[typing.BinaryIO]:
+        args = [ZSTD_EXECUTABLE, '-q', '-dc']
+        if dictionary is not None:
+            dictfile = os.path.join(workdir, 'dictionary')
+            if not os.path.exists(dictfile):
+                iohelper.write_file(dictfile, dictionary)
+            args += ['-D', dictfile]
+        with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
+            feed_error = []
+            def feed():
+                try:
+                    with proc.stdin:
+                        shutil.copyfileobj(source, proc.stdin, 1048576)
+                except BrokenPipeError:
+                    # zstd exits early when the reader stops reading
+                    pass
+                except Exception as e:
+                    feed_error.append(e)
+            feeder = threading.Thread(target=feed, name='zstd_feed')
+            feeder.start()
+            try:
+                yield proc.stdout
+                while proc.stdout.read(1048576):
+                    pass
+            finally:
+                proc.stdout.close()
+                feeder.join()
+        if feed_error:
+            raise feed_error[0]
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+
+    def _apply_zstd_patch(old_file: str, patch_file: str, new_file: str):
+        subprocess.run([ZSTD_EXECUTABLE, '-q', '-d', '-f', '--long=31', '--patch-from', old_file, patch_file, '-o', new_file], check=True)
+
+
+def _check_hash(source: "bytes | str | _RangeReader", expected: str, what: str):
+    algorithm, _, digest = expected.partition(':')
+    if algorithm != "sha256":
+        raise ValueError(f"unsupported hash of {what}: {expected}")
+    if isinstance(source, bytes):
+        actual = hashlib.sha256(source).hexdigest()
+    elif isinstance(source, _RangeReader):
+        actual = source.hexdigest()
+    else:
+        actual = iohelper.sha256_file(source)
+    if actual != digest:
+        raise ValueError(f"hash mismatch of {what}")
+
+def _package_path(root: str, name: str) -> str:
+    parts = name.split('/')
+    if not name or '\\' in name or ':' in parts[0] or any(x in ('', '.', '..') for x in parts):
+        raise ValueError(f"unsafe path in package: {name!r}")
+    return os.path.join(root, *parts)
+
+def _tar_members(tf: tarfile.TarFile):
+    """Members of a tar stream, chunks except the last one have no EOF mark"""
+    while True:
+        try:
+            member = tf.next()
+        except tarfile.ReadError:
+            if tf.offset == 0:
+                raise
+            return
+        if member is None:
+            return
+        yield member
+
+
+class PackageReader:
+    """Reads ranges of a package in ascending order and counts the bytes read.
+
+    Skipped ranges are seeked over, or read and dropped if the file object is a stream.
+    """
+    def __init__(self, fileobj: typing.BinaryIO):
+        self.fileobj = fileobj
+        self.position = 0
+        self.bytes_read = 0
+        self._seekable = fileobj.seekable()
+
+    def _read(self, size: int) -> bytes:
+        data = self.fileobj.read(size)
+        while len(data) < size:
+            more = self.fileobj.read(size - len(data))
+            if not more:
+                raise ValueError("unexpected end of package")
+            data += more
+        self.bytes_read += size
+        self.position += size
+        return data
+
+    def _skip_to(self, offset: int):
+        if offset < self.position:
+            raise ValueError("package ranges must be read in ascending order")
+        if offset > self.position:
+            if self._seekable:
+                self.fileobj.seek(offset)
+                self.position = offset
+            else:
+                while self.position < offset:
+                    self._read(min(offset - self.position, 1048576))
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        self._skip_to(offset)
+        return self._read(size)
+
+    def open_range(self, offset: int, size: int) -> "_RangeReader":
+        """File object over a range, valid until another range is read"""
+        self._skip_to(offset)
+        return _RangeReader(self, size)
+
+
+class _RangeReader(io.RawIOBase):
+    """Reads a range of a package and hashes it on the way"""
+    def __init__(self, package: PackageReader, size: int):
+        self.package = package
+        self.remaining = size
+        self.hasher = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        size = min(len(b), self.remaining, 1048576)
+        if not size:
+            return 0
+        data = self.package._read(size)
+        b[:size] = data
+        self.hasher.update(data)
+        self.remaining -= size
+        return size
+
+    def hexdigest(self) -> str:
+        """Reads the rest of the range and returns its sha256"""
+        while self.read(1048576):
+            pass
+        return self.hasher.hexdigest()
+
+
+@dataclasses.dataclass(slots=True)
+class DeltaPackage:
+    manifest: manifest.PackageManifest
+    delta_manifest: manifest.DeltaPackageManifest
+    chunks_offset: int
+    """Offset of the first chunk in the package file, chunk offsets are relative to it"""
+
+def read_delta_package(reader: PackageReader) -> DeltaPackage:
+    """Reads the header and the manifest chunk"""
+    header = reader.read_at(0, 16)
+    if header[:12] != HEADER_MAGIC:
+        raise ValueError("not a zstd compressed MUE1 package")
+    manifest_size, = struct.unpack('<I', header[12:])
+    with _decompress_chunk(io.BytesIO(reader.read_at(16, manifest_size)), None, None) as f:
+        tf = tarfile.open(fileobj=f, mode='r|')
+        entries = []
+        for member in _tar_members(tf):
+            entries.append((member.name, tf.extractfile(member).read() if member.isfile() else None))
+            if len(entries) == 2:
+                break
+    if len(entries) < 2 or not entries[0][0].startswith('.maa_update/packages/') or not entries[1][0].startswith('.maa_update/delta/'):
+        raise ValueError("invalid manifest chunk")
+    return DeltaPackage(json.loads(entries[0][1]), json.loads(entries[1][1]), 16 + manifest_size)
+
+
+def check_delta_package(package: os.PathLike | typing.BinaryIO) -> DeltaPackage:
+    """Reads every chunk of a delta package, checks its hash and decompresses it.
+
+    Chunks flagged with "dictionary" must follow an existing dictionary chunk.
+    """
+    with contextlib.ExitStack() as stack:
+        fileobj = package if hasattr(package, 'read') else stack.enter_context(open(package, 'rb'))
+        reader = PackageReader(fileobj)
+        pkg = read_delta_package(reader)
+        chunks = pkg.delta_manifest["chunks"]
+        dictionary_chunk = None
+        if (index := pkg.delta_manifest.get("dictionary")) is not None:
+            if not 0 <= index < len(chunks) or chunks[index]["target"] != "dictionary":
+                raise ValueError("invalid dictionary chunk")
+            dictionary_chunk = chunks[index]
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='.maa_update_'))
+        dictionary = None
+        for chunk in sorted(chunks, key=lambda x: x["offset"]):
+            what = f"chunk at {chunk['offset']}"
+            if chunk.get("dictionary") and dictionary is None:
+                raise ValueError(f"{what} precedes the dictionary chunk" if dictionary_chunk else f"{what} uses a missing dictionary chunk")
+            with reader.open_range(pkg.chunks_offset + chunk["offset"], chunk["size"]) as raw:
+                with _decompress_chunk(raw, dictionary if chunk.get("dictionary") else None, workdir) as f:
+                    if chunk is dictionary_chunk:
+                        dictionary = f.read()
+                    else:
+                        while f.read(1048576):
+                            pass
+                _check_hash(raw, chunk["hash"], what)
+    return pkg
+
+
+@dataclasses.dataclass(slots=True)
+class ApplyResult:
+    version: str
+    """The version after applying the package"""
+    bytes_read: int
+    """Bytes read from the package, including the header and manifest chunk"""
+    chunks: int
+    files_written: int = 0
+    files_removed: int = 0
+    files_patched: int = 0
+
+
+class _Session:
+    """Changes to root_dir staged in workdir, mirrors UpdateSession.
+
+    Chunks are added in package order, from the newest changes to the oldest ones, while
+    UpdateSession reads them backwards: the first change of a file wins and patch series
+    are chained once all chunks are added.
+    """
+    def __init__(self, root_dir: str, workdir: str, current_version: str, new_version: str):
+        self.root_dir = root_dir
+        self.workdir = workdir
+        self.current_version = current_version
+        self.new_version = new_version
+        # path in package -> staged file, None for removal
+        self.updated: dict[str, str | None] = {}
+        # (path in package, patch base) -> patch
+        self.patches: dict[tuple[str, str], manifest.PatchFile] = {}
+        # patches leading to new_version, directly or through a newer patch
+        self._leading: set[tuple[str, str]] = set()
+        # archive path of patch -> staged file
+        self.patch_data: dict[str, str | None] = {}
+        # next() on a count is atomic, temp files are also named from patch threads
+        self._serial = itertools.count(1)
+
+    def temp_file(self) -> str:
+        return os.path.join(self.workdir, f'{next(self._serial):08d}')
+
+    def _extract(self, tf: tarfile.TarFile, member: tarfile.TarInfo) -> str:
+        tmpfile = self.temp_file()
+        with tf.extractfile(member) as src, open(tmpfile, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1048576)
+        return tmpfile
+
+    def add_chunk(self, stream: typing.BinaryIO):
+        tf = tarfile.open(fileobj=stream, mode='r|')
+        members = _tar_members(tf)
+        first = next(members, None)
+        if first is None or not first.isfile() or not first.name.startswith('.maa_update/delta/') or not first.name.endswith('/chunk_manifest.json'):
+            raise ValueError("invalid chunk manifest")
+        chunk_manifest: manifest.ChunkManifest = json.loads(tf.extractfile(first).read())
+
+        for name in chunk_manifest.get("remove_files") or []:
+            self.updated.setdefault(name, None)
+
+        patch_base = chunk_manifest["patch_base"]
+        patch_names = set()
+        for pf in chunk_manifest.get("patch_files") or []:
+            patch_names.add(pf["patch"])
+            self.patches[pf["file"], patch_base] = pf
+            # only patches that can end a series at new_version are staged
+            if pf["new_version"] == self.new_version or (pf["file"], pf["new_version"]) in self._leading:
+                self._leading.add((pf["file"], patch_base))
+                self.patch_data[pf["patch"]] = None
+
+        for member in members:
+            if member.name in self.patch_data:
+                self.patch_data[member.name] = self._extract(tf, member)
+            elif member.name in patch_names:
+                continue
+            elif member.isfile():
+                _package_path(self.root_dir, member.name)
+                if member.name not in self.updated:
+                    self.updated[member.name] = self._extract(tf, member)
+
+    def patch_series(self) -> dict[str, list[manifest.PatchFile]]:
+        """Patch series of each file, chained from current_version"""
+        result = {}
+        for (path, patch_base), pf in self.patches.items():
+            if patch_base != self.current_version:
+                continue
+            series = [pf]
+            bases = {patch_base}
+            while (version := series[-1]["new_version"]) not in bases and (pf := self.patches.get((path, version))) is not None:
+                series.append(pf)
+                bases.add(version)
+            result[path] = series
+        return result
+
+    def _source_file(self, path: str) -> str:
+        if path in self.updated:
+            if self.updated[path] is None:
+                raise FileNotFoundError(f"file is removed by the package: {path}")
+            return self.updated[path]
+        return _package_path(self.root_dir, path)
+
+    def _patch_file(self, path: str, series: list[manifest.PatchFile], bsdiff_hook: BsdiffHook) -> str | None:
+        """Returns the staged patched file, None if the series only copies"""
+        if series[-1]["new_version"] != self.new_version:
+            raise ValueError(f"invalid patch series: {path} is not patched to {self.new_version}")
+        source = current = self._source_file(path)
+        checked_hash = None
+        for pf in series:
+            if checked_hash != pf["old_hash"]:
+                _check_hash(current, pf["old_hash"], path)
+            if pf["patch_type"] == "copy":
+                checked_hash = pf["old_hash"]
+                continue
+            patch = self.patch_data.get(pf["patch"])
+            if patch is None:
+                raise ValueError(f"missing patch data: {pf['patch']}")
+            out = self.temp_file()
+            if pf["patch_type"] == "zstd":
+                _apply_zstd_patch(current, patch, out)
+            elif pf["patch_type"] == "bsdiff":
+                bsdiff_hook(current, patch, out)
+            else:
+                raise ValueError(f"unsupported patch type: {pf['patch_type']}")
+            _check_hash(out, pf["new_hash"], path)
+            checked_hash = pf["new_hash"]
+            if current != source:
+                os.unlink(current)
+            current = out
+        return current if current != source else None
+
+    def apply_patches(self, bsdiff_hook: BsdiffHook, jobs: int | None) -> int:
+        with concurrent.futures.ThreadPoolExecutor(jobs or os.cpu_count(), thread_name_prefix='apply_patch') as executor:
+            futures = {path: executor.submit(self._patch_file, path, series, bsdiff_hook) for path, series in self.patch_series().items()}
+            results = {path: future.result() for path, future in futures.items()}
+        patched = {path: x for path, x in results.items() if x is not None}
+        self.updated.update(patched)
+        return len(patched)
+
+    def commit(self):
+        for path, staged in self.updated.items():
+            target = _package_path(self.root_dir, path)
+            if staged is None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(target)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(staged, target)
+
+
+def apply_delta(package: os.PathLike | typing.BinaryIO, root_dir: os.PathLike, current_version: str,
+                bsdiff_hook: BsdiffHook = bspatch_executable, jobs: int | None = None) -> ApplyResult:
+    """Updates the files in root_dir from current_version to the version of the delta package"""
+    root_dir = os.path.abspath(root_dir)
+    with contextlib.ExitStack() as stack:
+        fileobj = package if hasattr(package, 'read') else stack.enter_context(open(package, 'rb'))
+        reader = PackageReader(fileobj)
+        pkg = read_delta_package(reader)
+        delta_manifest = pkg.delta_manifest
+        if current_version not in delta_manifest["for_version"]:
+            raise ValueError(f"package doesn't apply to {current_version}")
+
+        chunks = delta_manifest["chunks"]
+        apply_chunks = [x for x in chunks if isinstance(x["target"], list) and current_version in x["target"]]
+        needed = list(apply_chunks)
+        dictionary_chunk = None
+        if any(x.get("dictionary") for x in apply_chunks):
+            dictionary_chunk = chunks[delta_manifest["dictionary"]]
+            needed.append(dictionary_chunk)
+
+        # staged next to root_dir, so committing is a rename on the same file system
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='.maa_update_', dir=os.path.dirname(root_dir)))
+        session = _Session(root_dir, workdir, current_version, pkg.manifest["version"])
+        dictionary = None
+        # chunks are applied while they are read, their hashes are checked before anything is committed
+        for chunk in sorted(needed, key=lambda x: x["offset"]):
+            what = f"chunk at {chunk['offset']}"
+            with reader.open_range(pkg.chunks_offset + chunk["offset"], chunk["size"]) as raw:
+                if chunk is dictionary_chunk:
+                    with _decompress_chunk(raw, None, workdir) as f:
+                        dictionary = f.read()
+                elif chunk.get("dictionary") and dictionary is None:
+                    raise ValueError(f"{what} precedes the dictionary chunk")
+                else:
+                    with _decompress_chunk(raw, dictionary if chunk.get("dictionary") else None, workdir) as f:
+                        session.add_chunk(f)
+                _check_hash(raw, chunk["hash"], what)
+        files_removed = sum(x is None for x in session.updated.values())
+        files_written = len(session.updated) - files_removed
+        files_patched = session.apply_patches(bsdiff_hook, jobs)
+        session.commit()
+
+    return ApplyResult(pkg.manifest["version"], reader.bytes_read, len(needed), files_written, files_removed, files_patched)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m makedelta.apply', description='Apply a delta package to an installed package')
+    parser.add_argument('package', help="delta package file, - for stdin")
+    parser.add_argument('root_dir')
+    parser.add_argument('current_version')
+    parser.add_argument('--bspatch', help='bsdiff patch executable, called with old, patch and new file (default: $MAA_BSPATCH or maa_bspatch)')
+    parser.add_argument('--jobs', type=int, help='files patched in parallel (default: CPU count)')
+    args = parser.parse_args()
+
+    hook = bspatch_executable
+    if args.bspatch:
+        hook = lambda old, patch, new: subprocess.run([args.bspatch, old, patch, new], check=True)
+    start = time.perf_counter()
+    result = apply_delta(sys.stdin.buffer if args.package == '-' else args.package, args.root_dir, args.current_version, hook, args.jobs)
+    print(f"Updated {args.current_version} to {result.version} in {time.perf_counter() - start:.2f}s: read {iohelper.format_size(result.bytes_read)} in {result.chunks} chunks, "
+          f"{result.files_written} files written, {result.files_removed} removed, {result.files_patched} patched", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
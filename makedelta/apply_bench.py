@@ -0,0 +1,79 @@
+"""Client-side cost of a delta package, applied to every version it supports.
+
+    python -m makedelta.apply_bench <package> [--pattern PATTERN] [--workdir DIR] [--bspatch EXECUTABLE] [--jobs N] [--json FILE]
+
+Each source version is extracted from its package zip (not timed), updated with makedelta.apply,
+and compared with the zip of the target version if there is one.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import zipfile
+import zlib
+
+from . import apply
+from . import pkgprov_maa
+
+def _matches_zip(root: str, zip_path: str) -> bool:
+    with zipfile.ZipFile(zip_path) as zf:
+        expected = {x.filename: x.CRC for x in zf.infolist() if not x.is_dir()}
+    actual = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                crc = 0
+                while block := f.read(1048576):
+                    crc = zlib.crc32(block, crc)
+            actual[os.path.relpath(path, root).replace(os.sep, '/')] = crc
+    return actual == expected
+
+def run(package_file: str, pattern: str, workdir: str, bsdiff_hook: apply.BsdiffHook, jobs: int | None) -> list[dict]:
+    with open(package_file, 'rb') as f:
+        pkg = apply.read_delta_package(apply.PackageReader(f))
+    name, variant, target = pkg.manifest["name"], pkg.manifest.get("variant"), pkg.manifest["version"]
+    target_zip = pattern.format(name=name, version=target, variant=variant)
+    results = []
+    for version in pkg.delta_manifest["for_version"]:
+        root = os.path.join(workdir, version)
+        shutil.rmtree(root, ignore_errors=True)
+        with zipfile.ZipFile(pattern.format(name=name, version=version, variant=variant)) as zf:
+            zf.extractall(root)
+        start = time.perf_counter()
+        result = apply.apply_delta(package_file, root, version, bsdiff_hook, jobs)
+        elapsed = time.perf_counter() - start
+        verified = _matches_zip(root, target_zip) if os.path.exists(target_zip) else None
+        shutil.rmtree(root, ignore_errors=True)
+        results.append({"version": version, "time": elapsed, "bytes_read": result.bytes_read, "chunks": result.chunks,
+                        "files_written": result.files_written, "files_removed": result.files_removed, "files_patched": result.files_patched,
+                        "verified": verified})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m makedelta.apply_bench', description='Apply a delta package to every version it supports')
+    parser.add_argument('package')
+    parser.add_argument('--pattern', default=pkgprov_maa.package_pattern, help='package zip of each version, formatted with name, version and variant')
+    parser.add_argument('--workdir', default='bench/apply', help='directory for extracted versions')
+    parser.add_argument('--bspatch', help='bsdiff patch executable, called with old, patch and new file (default: $MAA_BSPATCH or maa_bspatch)')
+    parser.add_argument('--jobs', type=int, help='files patched in parallel (default: CPU count)')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    hook = apply.bspatch_executable
+    if args.bspatch:
+        hook = lambda old, patch, new: subprocess.run([args.bspatch, old, patch, new], check=True)
+    results = run(args.package, args.pattern, os.path.abspath(args.workdir), hook, args.jobs)
+
+    print(f"{'version':<24} {'read':>12} {'chunks':>6} {'written':>7} {'removed':>7} {'patched':>7} {'time':>9} {'verified':>8}", file=sys.stderr)
+    for x in results:
+        print(f"{x['version']:<24} {x['bytes_read']:>12} {x['chunks']:>6} {x['files_written']:>7} {x['files_removed']:>7} {x['files_patched']:>7} {x['time']:>8.3f}s {str(x['verified']):>8}", file=sys.stderr)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
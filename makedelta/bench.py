@@ -0,0 +1,127 @@
+"""Offline benchmark of the makedelta pipeline on synthetic packages.
+
+    python -m makedelta.bench [--scale NAME ...] [--profile PROFILE] [--workdir DIR] [--repeat N] [--warm] [--json FILE]
+
+Each scale generates a deterministic version series, then runs a full build in its own
+working directory and reports wall time per stage from the trace spans.
+"""
+import argparse
+import contextlib
+import dataclasses
+import json
+import os
+import shutil
+import sys
+import time
+
+from . import compression_profiles
+from . import makedelta
+from . import pkgdiff
+from . import pkgprov
+from . import synthetic
+from . import trace
+from .zip_index import ZipIndex
+
+SCALES = {
+    'small': synthetic.SyntheticSpec(file_count=200, mean_size=32768, versions=6),
+    'medium': synthetic.SyntheticSpec(file_count=2000, mean_size=16384, versions=15),
+    'large': synthetic.SyntheticSpec(file_count=10000, mean_size=8192, versions=40, branch_every=5),
+}
+
+# stage name -> span names, parallel spans of a stage are measured from the first start to the last end
+STAGES = {
+    'sort_versions': ['sort_versions'],
+    'generate_file_history': ['generate_file_history'],
+    'find_best_patch': ['find_best_patch'],
+    'chunks': ['delta chunk', 'dictionary chunk', 'patch fallback chunk', 'unchanged chunk', 'chunk frame'],
+    'amalgamate': ['amalgamate'],
+}
+
+PACKAGE_NAME = 'SYN'
+
+@contextlib.contextmanager
+def _working_directory(path):
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def _stage_times(events: list[dict]) -> dict[str, float]:
+    result = {}
+    for stage, names in STAGES.items():
+        spans = [x for x in events if x["name"] in names]
+        if spans:
+            result[stage] = (max(x["ts"] + x["dur"] for x in spans) - min(x["ts"] for x in spans)) / 1e6
+    return result
+
+def time_package_diff(series: synthetic.SyntheticSeries) -> float:
+    """Diffs each consecutive pair of freshly opened packages, including entry table construction"""
+    provider = pkgprov.ZipDirectoryProvider(series.pattern)
+    pkgs = [provider.open_package(PACKAGE_NAME, x, None) for x in series.versions]
+    for pkg in pkgs:
+        pkg.get_entries()
+    start = time.perf_counter()
+    for a, b in zip(pkgs[:-1], pkgs[1:]):
+        pkgdiff.package_diff(a, b)
+    return time.perf_counter() - start
+
+def run_build(series: synthetic.SyntheticSeries, rundir: str, warm: bool) -> dict[str, float]:
+    if not warm:
+        shutil.rmtree(rundir, ignore_errors=True)
+        # hashes, entry tables and extracted files of earlier repeats are cached in this process too
+        makedelta.reset_caches()
+    os.makedirs(os.path.join(rundir, 'cache'), exist_ok=True)
+    os.makedirs(os.path.join(rundir, 'output'), exist_ok=True)
+    with _working_directory(rundir):
+        index = ZipIndex(makedelta.cache_dir + '/zip_index.db')
+        provider = pkgprov.ZipDirectoryProvider(series.pattern, index)
+        trace.enable()
+        start = time.perf_counter()
+        try:
+            makedelta.build_delta(provider, PACKAGE_NAME, None, list(series.versions), list(series.nonlinear_versions))
+        finally:
+            index.close()
+        total = time.perf_counter() - start
+    result = _stage_times(trace.events())
+    result['total'] = total
+    return result
+
+def run_scale(name: str, spec: synthetic.SyntheticSpec, workdir: str, repeat: int, warm: bool) -> dict:
+    start = time.perf_counter()
+    series = synthetic.generate_series(spec, os.path.join(workdir, name, 'testdata'), PACKAGE_NAME)
+    result = {"spec": dataclasses.asdict(spec), "generate": time.perf_counter() - start, "runs": []}
+    for _ in range(repeat):
+        run = {"package_diff": time_package_diff(series)}
+        run.update(run_build(series, os.path.join(workdir, name, 'run'), warm))
+        result["runs"].append(run)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m makedelta.bench', description='Benchmark makedelta on synthetic packages')
+    parser.add_argument('--scale', action='append', choices=list(SCALES), help='scales to run, may be repeated (default: small)')
+    parser.add_argument('--profile', choices=list(compression_profiles.PROFILES), default='release', help='compression profile (default: release)')
+    parser.add_argument('--workdir', default='bench', help='directory for generated packages and build outputs')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--warm', action='store_true', help='keep caches between repeated builds')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    makedelta.compression_profile = compression_profiles.PROFILES[args.profile]
+    workdir = os.path.abspath(args.workdir)
+    results = {}
+    for name in args.scale or ['small']:
+        results[name] = run_scale(name, SCALES[name], workdir, args.repeat, args.warm)
+
+    stages = ['package_diff', *STAGES, 'total']
+    print(f"{'scale':<8} {'run':>3} " + ' '.join(f"{x:>22}" for x in stages), file=sys.stderr)
+    for name, result in results.items():
+        for i, run in enumerate(result["runs"]):
+            print(f"{name:<8} {i:>3} " + ' '.join(f"{run.get(x, 0):>21.3f}s" for x in stages), file=sys.stderr)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
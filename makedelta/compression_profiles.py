@@ -0,0 +1,71 @@
+import dataclasses
+import os
+import typing
+
+from .zstd_params import CompressionParameters
+
+ArtefactKind = typing.Literal["patch", "nested_patch", "delta_chunk", "fallback_chunk", "manifest"]
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class Compression:
+    """Compression parameters of one artefact kind, with the level picked by input size"""
+    params: CompressionParameters
+    size_levels: tuple[tuple[int, int], ...] = ()
+    """(size limit, level) pairs in ascending size limit, inputs up to a limit use its level.
+    Larger inputs, and inputs of unknown size, use params.level."""
+
+    def for_size(self, size: int | None = None) -> CompressionParameters:
+        if size is not None:
+            for limit, level in self.size_levels:
+                if size <= limit:
+                    return dataclasses.replace(self.params, level=level)
+        return self.params
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class CompressionProfile:
+    name: str
+    patch: Compression
+    """zstd --patch-from, only the level is used, the window follows the source file"""
+    nested_patch: Compression
+    """Recompression of tiny zstd patches to estimate their size in the delta chunk"""
+    delta_chunk: Compression
+    fallback_chunk: Compression
+    """Patch fallback and unchanged files chunks, the bulk of a package"""
+    manifest: Compression
+
+    def params(self, kind: ArtefactKind, size: int | None = None) -> CompressionParameters:
+        return getattr(self, kind).for_size(size)
+
+
+_MiB = 1048576
+_cpus = os.cpu_count() or 1
+
+PROFILES = {
+    # PR and CI builds, level 22 costs minutes per large file for a few percent
+    "preview": CompressionProfile(
+        name="preview",
+        patch=Compression(CompressionParameters(level=9), size_levels=((4 * _MiB, 19), (32 * _MiB, 15))),
+        nested_patch=Compression(CompressionParameters(level=19)),
+        delta_chunk=Compression(CompressionParameters(level=9, nb_workers=_cpus), size_levels=((_MiB, 19), (16 * _MiB, 15))),
+        fallback_chunk=Compression(CompressionParameters(level=6, nb_workers=_cpus, job_size=64 * _MiB, long_distance_matching=True), size_levels=((64 * _MiB, 15),)),
+        manifest=Compression(CompressionParameters(level=19)),
+    ),
+    "release": CompressionProfile(
+        name="release",
+        patch=Compression(CompressionParameters(level=22)),
+        nested_patch=Compression(CompressionParameters(level=22)),
+        delta_chunk=Compression(CompressionParameters(level=22)),
+        fallback_chunk=Compression(CompressionParameters(level=22, nb_workers=_cpus, job_size=64 * _MiB, long_distance_matching=True)),
+        manifest=Compression(CompressionParameters(level=22)),
+    ),
+    # packages kept for years, uses the largest window consumers accept by default
+    "archival": CompressionProfile(
+        name="archival",
+        patch=Compression(CompressionParameters(level=22)),
+        nested_patch=Compression(CompressionParameters(level=22)),
+        delta_chunk=Compression(CompressionParameters(level=22, window_log=27, long_distance_matching=True)),
+        fallback_chunk=Compression(CompressionParameters(level=22, nb_workers=_cpus, job_size=256 * _MiB, window_log=27, long_distance_matching=True)),
+        manifest=Compression(CompressionParameters(level=22)),
+    ),
+}
@@ -1,4 +1,5 @@
 import threading
+import collections
 import concurrent.futures
 import functools
 
@@ -9,16 +10,20 @@ def __make_key(args: tuple, kwargs: dict, _kwargs_delimiter=object()):
 def _make_key(args: tuple, kwargs: dict):
     return __make_key(args, kwargs)
 
-def once_cache(func):
-    completed = {}
+def _once_wrapper(func, key_func, maxsize: int | None):
+    completed = collections.OrderedDict()
     pending = {}
     lock = threading.RLock()
+    # bumped by cache_clear, results computed before are not stored
+    generation = 0
 
     def wrapper(*args, **kwargs):
-        cache_key = _make_key(args, kwargs)
+        cache_key = key_func(*args, **kwargs)
         need_compute = False
         with lock:
             if cache_key in completed:
+                if maxsize is not None:
+                    completed.move_to_end(cache_key)
                 return completed[cache_key]
             elif cache_key in pending:
                 future = pending[cache_key]
@@ -26,17 +31,50 @@ def once_cache(func):
                 need_compute = True
                 future = concurrent.futures.Future()
                 pending[cache_key] = future
+                started_generation = generation
         if need_compute:
             try:
-                result = func(*args)
+                result = func(*args, **kwargs)
                 with lock:
-                    completed[cache_key] = result
-                    del pending[cache_key]
+                    if started_generation == generation:
+                        completed[cache_key] = result
+                        if maxsize is not None:
+                            while len(completed) > maxsize:
+                                completed.popitem(last=False)
+                        del pending[cache_key]
                 future.set_result(result)
             except Exception as e:
                 with lock:
-                    del pending[cache_key]
+                    if started_generation == generation:
+                        del pending[cache_key]
                 future.set_exception(e)
-    
+
         return future.result()
+
+    def cache_clear():
+        """Forgets all results, computations in progress still complete for their callers but are not stored"""
+        nonlocal generation
+        with lock:
+            completed.clear()
+            pending.clear()
+            generation += 1
+
+    wrapper.cache_clear = cache_clear
     return functools.update_wrapper(wrapper, func)
+
+def once_cache(func):
+    return _once_wrapper(func, lambda *args, **kwargs: _make_key(args, kwargs), None)
+
+def once_lru_cache(maxsize: int):
+    """once_cache that only keeps `maxsize` most recently used results.
+
+    Evicted results stay valid for callers still holding them."""
+    def decorator(func):
+        return _once_wrapper(func, lambda *args, **kwargs: _make_key(args, kwargs), maxsize)
+    return decorator
+
+def once_cache_by(key_func):
+    """once_cache keyed by `key_func(*args, **kwargs)` instead of all arguments"""
+    def decorator(func):
+        return _once_wrapper(func, key_func, None)
+    return decorator
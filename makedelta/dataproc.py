@@ -1,9 +1,13 @@
+import io
 import shutil
 import os
 import random
 import subprocess
+import tempfile
+import threading
 
 from . import iohelper
+from .zstd_params import CompressionParameters
 
 
 ZSTD_EXECUTABLE = os.environ.get("ZSTD", "zstd")
@@ -16,23 +20,239 @@ if not shutil.which(ZSTD_EXECUTABLE):
 if not shutil.which(MAA_BSDIFF_EXECUTABLE):
     raise Exception(f"MAA_BSDIFF executable not found: {MAA_BSDIFF_EXECUTABLE}")
 
-def zstd_compress_file(infile, outfile):
-    with iohelper.safe_output_filename(outfile) as tmpfile:
-        subprocess.run([ZSTD_EXECUTABLE, '-q', '--ultra', '-22', '-f', infile, '-o', tmpfile], check=True)
+ZSTD_DEFAULT_PARAMS = CompressionParameters(level=22)
+
+
+def _patch_tmpfile(patchfile: str) -> str:
+    return patchfile + f'.tmp{os.getpid():X}{random.randint(0, 0x7FFFFFFF):08X}'
+
+class PatchProcess:
+    """Patch generation running in a subprocess that can be cancelled.
+
+    `args_func(tmpfile)` returns the command line writing to tmpfile, which is moved to
+    patchfile when the process succeeds.
+    """
+    def __init__(self, args_func, patchfile):
+        self.patchfile = str(patchfile)
+        self.tmpfile = _patch_tmpfile(self.patchfile)
+        self.proc = subprocess.Popen(args_func(self.tmpfile))
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Returns False if the process is still running after timeout"""
+        try:
+            returncode = self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        if returncode != 0:
+            self._remove_output()
+            raise subprocess.CalledProcessError(returncode, self.proc.args)
+        os.replace(self.tmpfile, self.patchfile)
+        return True
+
+    def cancel(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self._remove_output()
+
+    def _remove_output(self):
+        if os.path.exists(self.tmpfile):
+            os.unlink(self.tmpfile)
+
+
+class PatchThread:
+    """Patch generation running in a thread of this process, with the interface of PatchProcess.
+
+    `generate(tmpfile, cancel)` writes the patch to tmpfile, and should stop with an exception
+    soon after the `cancel` event is set. `cancel()` waits for the thread, so the memory it uses
+    is released when it returns.
+    """
+    def __init__(self, generate, patchfile):
+        self.patchfile = str(patchfile)
+        self.tmpfile = _patch_tmpfile(self.patchfile)
+        self.cancelled = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(generate,), name='patch_thread', daemon=True)
+        self._thread.start()
+
+    def _run(self, generate):
+        try:
+            generate(self.tmpfile, self.cancelled)
+        except BaseException as e:
+            self._error = e
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Returns False if the thread is still running after timeout"""
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return False
+        if self._error is not None:
+            self._remove_output()
+            raise self._error
+        os.replace(self.tmpfile, self.patchfile)
+        return True
+
+    def cancel(self):
+        self.cancelled.set()
+        self._thread.join()
+        self._remove_output()
+
+    def _remove_output(self):
+        if os.path.exists(self.tmpfile):
+            os.unlink(self.tmpfile)
+
+
+def bsdiff_patch_memory(old_size: int, new_size: int) -> int:
+    """Approximate peak memory of bsdiff, dominated by suffix sorting the old file"""
+    return 17 * old_size + 2 * new_size
+
+try:
+    from .zstd_ctypes import compress as _zstd_compress_bytes, ZstdCompressWriter as _ZstdCompressWriter, estimate_stream_memory as _estimate_stream_memory
+    from .zstd_ctypes import train_dictionary as _train_dictionary, ZstdError as _ZstdError
+    def zstd_compress_file(infile, outfile, params: CompressionParameters = ZSTD_DEFAULT_PARAMS):
+        with open(infile, 'rb') as f, iohelper.safe_output_fileobj(outfile, 'wb') as out:
+            with _ZstdCompressWriter(out, params, pledged_size=os.fstat(f.fileno()).st_size) as zf:
+                shutil.copyfileobj(f, zf, 1048576)
+
+    def zstd_compress_bytes(data: bytes, params: CompressionParameters = ZSTD_DEFAULT_PARAMS, dictionary: bytes | None = None) -> bytes:
+        return _zstd_compress_bytes(data, params, dictionary)
+
+    def zstd_train_dictionary(samples: list[bytes], dict_size: int) -> bytes | None:
+        """Trains a dictionary for zstd_compress_bytes, None if the samples are not enough"""
+        try:
+            return _train_dictionary(samples, dict_size)
+        except _ZstdError:
+            return None
+
+    def zstd_stream_writer(fileobj, params: CompressionParameters = ZSTD_DEFAULT_PARAMS, pledged_size: int | None = None):
+        """Returns a file object that compresses everything written to it into fileobj"""
+        return _ZstdCompressWriter(fileobj, params, pledged_size)
+
+    def zstd_stream_memory(params: CompressionParameters = ZSTD_DEFAULT_PARAMS) -> int:
+        """Approximate memory used by zstd_stream_writer with params"""
+        return _estimate_stream_memory(params)
+except ImportError:
+    def zstd_compress_file(infile, outfile, params: CompressionParameters = ZSTD_DEFAULT_PARAMS):
+        with iohelper.safe_output_filename(outfile) as tmpfile:
+            subprocess.run([ZSTD_EXECUTABLE, '-q', *params.cli_args(), '-f', infile, '-o', tmpfile], check=True)
+
+    def zstd_compress_bytes(data: bytes, params: CompressionParameters = ZSTD_DEFAULT_PARAMS, dictionary: bytes | None = None) -> bytes:
+        args = [ZSTD_EXECUTABLE, '-q', *params.cli_args(), '-c', f'--stream-size={len(data)}']
+        if dictionary is None:
+            return subprocess.run(args, input=data, stdout=subprocess.PIPE, check=True).stdout
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dictfile = os.path.join(tmpdir, 'dictionary')
+            iohelper.write_file(dictfile, dictionary)
+            return subprocess.run([*args, '-D', dictfile], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+    def zstd_train_dictionary(samples: list[bytes], dict_size: int) -> bytes | None:
+        """Trains a dictionary for zstd_compress_bytes, None if the samples are not enough"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sample_dir = os.path.join(tmpdir, 'samples')
+            os.mkdir(sample_dir)
+            for i, sample in enumerate(samples):
+                iohelper.write_file(os.path.join(sample_dir, str(i)), sample)
+            dictfile = os.path.join(tmpdir, 'dictionary')
+            result = subprocess.run([ZSTD_EXECUTABLE, '-q', '--train', '-r', sample_dir, f'--maxdict={dict_size}', '-o', dictfile], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if result.returncode != 0:
+                return None
+            return iohelper.read_file(dictfile)
+
+    class _ZstdProcessWriter:
+        def __init__(self, fileobj, params: CompressionParameters, pledged_size: int | None):
+            fileobj.flush()
+            args = [ZSTD_EXECUTABLE, '-q', *params.cli_args(), '-c']
+            if pledged_size is not None:
+                args.append(f'--stream-size={pledged_size}')
+            try:
+                stdout = fileobj.fileno()
+            except (AttributeError, io.UnsupportedOperation):
+                # wrapped file objects (e.g. hashing) get the output through a pipe
+                stdout = subprocess.PIPE
+            self._proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=stdout)
+            self._copier = None
+            if stdout is subprocess.PIPE:
+                self._copier = threading.Thread(target=shutil.copyfileobj, args=(self._proc.stdout, fileobj, 1048576), daemon=True)
+                self._copier.start()
+            self._pos = 0
+        def __enter__(self):
+            return self
+        def __exit__(self, exc_type, exc_value, traceback):
+            if exc_type is None:
+                self.close()
+            else:
+                self._proc.kill()
+                self._proc.wait()
+                if self._copier is not None:
+                    self._copier.join()
+            return False
+        def tell(self):
+            return self._pos
+        def write(self, data):
+            written = self._proc.stdin.write(data)
+            self._pos += written
+            return written
+        def flush(self):
+            self._proc.stdin.flush()
+        def close(self):
+            self._proc.stdin.close()
+            if self._copier is not None:
+                self._copier.join()
+            if self._proc.wait() != 0:
+                raise subprocess.CalledProcessError(self._proc.returncode, self._proc.args)
+
+    def zstd_stream_writer(fileobj, params: CompressionParameters = ZSTD_DEFAULT_PARAMS, pledged_size: int | None = None):
+        """Returns a file object that compresses everything written to it into fileobj"""
+        return _ZstdProcessWriter(fileobj, params, pledged_size)
+
+    def zstd_stream_memory(params: CompressionParameters = ZSTD_DEFAULT_PARAMS) -> int:
+        """Approximate memory used by zstd_stream_writer with params"""
+        # coarse figures from libzstd estimates for unknown source size
+        size = (800 if params.level >= 20 else 100) * 1048576
+        if params.nb_workers:
+            size = params.nb_workers * (size + 2 * (params.job_size or 512 * 1048576))
+        return size
 
 try:
-    from .zstd_ctypes import compress as _zstd_compress_bytes
-    def zstd_compress_bytes(data: bytes) -> bytes:
-        return _zstd_compress_bytes(data, 22)
+    from .zstd_ctypes import PatchFromSource as _PatchFromSource, estimate_patch_memory as _estimate_patch_memory
+    def zstd_prepare_patch_source(orig_file, level: int = 22):
+        """Loads and indexes orig_file once for use with multiple zstd_generate_patch calls at level"""
+        return _PatchFromSource(iohelper.read_file(orig_file), level)
+
+    def zstd_generate_patch(orig_file, new_file, patchfile, source=None, level: int = 22):
+        if source is None:
+            source = zstd_prepare_patch_source(orig_file, level)
+        iohelper.write_file(str(patchfile), source.compress(iohelper.read_file(new_file)))
+
+    def zstd_start_patch(orig_file, new_file, patchfile, level: int = 22, prepare_source=None) -> PatchThread | PatchProcess:
+        """Starts zstd_generate_patch in a thread that can be cancelled, the source is prepared
+        in that thread with `prepare_source(orig_file, level)` (default zstd_prepare_patch_source)"""
+        def generate(tmpfile, cancel: threading.Event):
+            source = (prepare_source or zstd_prepare_patch_source)(orig_file, level)
+            iohelper.write_file(tmpfile, source.compress(iohelper.read_file(new_file), cancel))
+        return PatchThread(generate, patchfile)
+
+    def zstd_patch_memory(old_size: int, new_size: int, level: int = 22) -> int:
+        """Approximate peak memory of zstd_generate_patch"""
+        return _estimate_patch_memory(old_size, new_size, level)
 except ImportError:
-    def zstd_compress_bytes(data: bytes) -> bytes:
-        result = subprocess.run([ZSTD_EXECUTABLE, '-q', '--ultra', '-22', '-c', f'--stream-size={len(data)}'], input=data, stdout=subprocess.PIPE, check=True)
-        return result.stdout
+    def zstd_prepare_patch_source(orig_file, level: int = 22):
+        return None
+
+    def zstd_generate_patch(orig_file, new_file, patchfile, source=None, level: int = 22):
+        zstd_start_patch(orig_file, new_file, patchfile, level).wait()
+
+    def zstd_start_patch(orig_file, new_file, patchfile, level: int = 22, prepare_source=None) -> PatchThread | PatchProcess:
+        """Starts zstd_generate_patch in a subprocess that can be cancelled"""
+        return PatchProcess(lambda tmpfile: [ZSTD_EXECUTABLE, '-q', '--ultra', f'-{level}', '-f', '--patch-from', orig_file, new_file, '-o', tmpfile], patchfile)
+
+    def zstd_patch_memory(old_size: int, new_size: int, level: int = 22) -> int:
+        """Approximate peak memory of zstd_generate_patch"""
+        # match tables grow with the window up to the level 22 limits, lower levels search less of it
+        return min((48 if level >= 20 else 12) * max(old_size, new_size), 1536 * 1048576) + old_size + 2 * new_size
 
-def zstd_generate_patch(orig_file, new_file, patchfile):
-    with iohelper.safe_output_filename(patchfile) as tmpfile:
-        subprocess.run([ZSTD_EXECUTABLE, '-q', '--ultra', '-22', '-f', '--patch-from', orig_file, new_file, '-o', tmpfile], check=True)
+def bsdiff_start_patch(orig_file, new_file, patchfile) -> PatchProcess:
+    return PatchProcess(lambda tmpfile: [MAA_BSDIFF_EXECUTABLE, orig_file, new_file, tmpfile], patchfile)
 
 def bsdiff_generate_patch(orig_file, new_file, patchfile):
-    with iohelper.safe_output_filename(patchfile) as tmpfile:
-        subprocess.run([MAA_BSDIFF_EXECUTABLE, orig_file, new_file, tmpfile], check=True)
+    bsdiff_start_patch(orig_file, new_file, patchfile).wait()
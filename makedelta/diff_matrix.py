@@ -0,0 +1,91 @@
+import hashlib
+import sqlite3
+import typing
+
+from . import pkgdiff
+from . import pkgprov
+
+# sizes were keyed by package and version, and went stale when a version's zip was replaced
+create_table_sql = """
+DROP TABLE IF EXISTS "diff_size";
+CREATE TABLE "content_diff_size" (
+	"digest_a" TEXT,
+	"digest_b" TEXT,
+	"diff_size" INTEGER,
+	PRIMARY KEY ("digest_a", "digest_b")
+);
+"""
+
+def entries_digest(pkg: pkgprov.Package) -> str:
+    """Identifies the entry list of a package, changes whenever a rebuilt package differs in any entry"""
+    h = hashlib.sha256()
+    for x in sorted(pkg.get_entries(), key=lambda x: x.name):
+        h.update(f"{x.name}\0{x.size}\0{x.checksum_type}:{x.checksum.hex()}\n".encode('utf-8'))
+    return h.hexdigest()
+
+class DiffSizeMatrix:
+    """Symmetric matrix of `len(package_diff(a, b))` between package versions.
+
+    Sizes are computed on first use, and persisted in `db_path` (if given) when closed.
+    Persisted sizes are keyed by the entries digest of both packages, not by version.
+    """
+    def __init__(self, pkgs: typing.Mapping[str, pkgprov.Package], db_path=None):
+        self.pkgs = pkgs
+        self.sizes: dict[tuple[str, str], int] = {}
+        self.digests: dict[str, str] = {}
+        self.pending: list[tuple[str, str, int]] = []
+        self.conn = None
+        if db_path is not None:
+            self.conn = sqlite3.connect(db_path)
+            cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='content_diff_size';")
+            if not cursor.fetchone():
+                with self.conn:
+                    self.conn.executescript(create_table_sql)
+
+    def set_packages(self, pkgs: typing.Mapping[str, pkgprov.Package]):
+        """Switches to pkgs, sizes and digests are kept for versions that still have the same package object"""
+        changed = {version for version, pkg in self.pkgs.items() if pkgs.get(version) is not pkg}
+        self.digests = {k: v for k, v in self.digests.items() if k not in changed}
+        self.sizes = {k: v for k, v in self.sizes.items() if k[0] not in changed and k[1] not in changed}
+        self.pkgs = pkgs
+
+    def _digest(self, version: str) -> str:
+        digest = self.digests.get(version)
+        if digest is None:
+            digest = self.digests[version] = entries_digest(self.pkgs[version])
+        return digest
+
+    def _stored_size(self, digest_a: str, digest_b: str) -> int | None:
+        cursor = self.conn.execute("SELECT diff_size FROM content_diff_size WHERE digest_a = ? AND digest_b = ?;", (digest_a, digest_b))
+        result = cursor.fetchone()
+        return None if result is None else result[0]
+
+    def __getitem__(self, key: tuple[str, str]) -> int:
+        a, b = key
+        if a == b:
+            return 0
+        if a > b:
+            a, b = b, a
+        size = self.sizes.get((a, b))
+        if size is None and self.conn is None:
+            size = self.sizes[(a, b)] = pkgdiff.package_diff_size(self.pkgs[a], self.pkgs[b])
+        elif size is None:
+            digest_a, digest_b = sorted((self._digest(a), self._digest(b)))
+            size = self._stored_size(digest_a, digest_b)
+            if size is None:
+                size = pkgdiff.package_diff_size(self.pkgs[a], self.pkgs[b])
+                self.pending.append((digest_a, digest_b, size))
+            self.sizes[(a, b)] = size
+        return size
+
+    def flush(self):
+        if self.conn is not None and self.pending:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO content_diff_size VALUES (?, ?, ?)", self.pending)
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
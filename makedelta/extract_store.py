@@ -0,0 +1,182 @@
+import collections
+import dataclasses
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+import zlib
+
+from . import pkgprov
+from . import concurrent_cache
+from . import trace
+
+_has_memfd = hasattr(os, 'memfd_create')
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class ExtractedFile:
+    path: str
+    sha256: str
+
+
+def content_key(entry: pkgprov.PackageEntry) -> str:
+    """Identifies entry content across packages and versions, unless checksums collide"""
+    return f"{entry.checksum_type}-{entry.checksum.hex()}-{entry.size:x}"
+
+def _sha256_key(entry: pkgprov.PackageEntry, sha256: str) -> str:
+    return f"sha256-{sha256}-{entry.size:x}"
+
+def _copy_and_hash(src, dst) -> str:
+    h = hashlib.sha256()
+    buffer = bytearray(262144)
+    view = memoryview(buffer)
+    while True:
+        chunk_len = src.readinto(buffer)
+        if not chunk_len:
+            return h.hexdigest()
+        h.update(view[:chunk_len])
+        dst.write(view[:chunk_len])
+
+def _verify_and_hash(path: os.PathLike, entry: pkgprov.PackageEntry) -> str | None:
+    """Returns sha256 of path if its content matches entry"""
+    if entry.checksum_type not in ('crc32', 'sha256'):
+        return None
+    try:
+        if os.path.getsize(path) != entry.size:
+            return None
+        h = hashlib.sha256()
+        crc = 0
+        buffer = bytearray(262144)
+        view = memoryview(buffer)
+        with open(path, 'rb') as f:
+            while chunk_len := f.readinto(buffer):
+                h.update(view[:chunk_len])
+                if entry.checksum_type == 'crc32':
+                    crc = zlib.crc32(view[:chunk_len], crc)
+    except FileNotFoundError:
+        return None
+    if entry.checksum_type == 'crc32':
+        return h.hexdigest() if crc.to_bytes(4, 'big') == entry.checksum else None
+    return h.hexdigest() if h.digest() == entry.checksum else None
+
+
+class ExtractStore:
+    """Extracts package entries to paths that can be read by this process and external tools.
+
+    Extracted files are addressed by content (checksum and size), so byte-identical entries in
+    different packages and versions are extracted once and shared. Content extracted for another
+    entry, or left on disk by an earlier run, is only reused if its sha256 matches the entry's,
+    which is hashed from the package when the caller doesn't know it. Entries whose checksum
+    collides with different content are extracted separately, addressed by their sha256.
+
+    Entries up to `memory_entry_limit` bytes are kept in anonymous memory files (Linux only)
+    as long as the total stays within `memory_budget`. Memory files are exposed as
+    `/proc/<pid>/fd/<fd>` paths and live until `close()`, which also forgets all extracted
+    entries so the store can serve the next build with its full memory budget.
+    Other entries are written under `disk_dir`, where later runs reuse them after
+    verifying the content against the entry.
+
+    `stats` counts requests, extractions per tier, entries hashed to verify reused content,
+    collisions and bytes read and written.
+    """
+    def __init__(self, disk_dir: os.PathLike, memory_entry_limit: int, memory_budget: int):
+        self.disk_dir = pathlib.Path(disk_dir)
+        self.memory_entry_limit = memory_entry_limit if _has_memfd else 0
+        self.memory_budget = memory_budget
+        self.memory_used = 0
+        self._memory_fds = []
+        self._lock = threading.Lock()
+        self.stats = collections.Counter()
+        self._extract_once = concurrent_cache.once_cache_by(lambda key, *args: key)(self._extract)
+
+    def _count(self, **counts: int):
+        with self._lock:
+            self.stats.update(counts)
+
+    def extract(self, pkg: pkgprov.Package, entry: pkgprov.PackageEntry, sha256: str | None = None) -> ExtractedFile:
+        """Extracts entry, `sha256` of its content saves hashing it when verifying reused content"""
+        self._count(requests=1)
+        if sha256 is None and entry.checksum_type == 'sha256':
+            sha256 = entry.checksum.hex()
+        produced = []
+        extracted = self._extract_once(content_key(entry), pkg, entry, sha256, produced)
+        if produced:
+            return extracted
+        if sha256 is None:
+            sha256 = self._hash_entry(pkg, entry)
+        if extracted.sha256 == sha256:
+            return extracted
+        self._count(collisions=1)
+        return self._extract_once(_sha256_key(entry, sha256), pkg, entry, sha256, produced)
+
+    def _hash_entry(self, pkg: pkgprov.Package, entry: pkgprov.PackageEntry) -> str:
+        with trace.span("hash_entry", cpu=True, name=entry.name, version=pkg.version, size=entry.size):
+            self._count(hashed=1, read_bytes=entry.size)
+            h = hashlib.sha256()
+            with pkg.open_entry(entry) as zf:
+                while chunk := zf.read(262144):
+                    h.update(chunk)
+            return h.hexdigest()
+
+    def _reserve_memory(self, size: int) -> bool:
+        if size > self.memory_entry_limit:
+            return False
+        with self._lock:
+            if self.memory_used + size > self.memory_budget:
+                return False
+            self.memory_used += size
+            return True
+
+    def _extract_to_memory(self, pkg: pkgprov.Package, entry: pkgprov.PackageEntry) -> ExtractedFile:
+        fd = os.memfd_create(os.path.basename(entry.name), os.MFD_CLOEXEC)
+        try:
+            with open(fd, 'wb', closefd=False) as f:
+                with pkg.open_entry(entry) as zf:
+                    sha256 = _copy_and_hash(zf, f)
+        except:
+            os.close(fd)
+            raise
+        with self._lock:
+            self._memory_fds.append(fd)
+        # /proc/self would resolve to the external tool itself
+        return ExtractedFile(f'/proc/{os.getpid()}/fd/{fd}', sha256)
+
+    def _extract_to_disk(self, pkg: pkgprov.Package, entry: pkgprov.PackageEntry, extracted_file: pathlib.Path) -> ExtractedFile:
+        extracted_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='wb', dir=extracted_file.parent, prefix=extracted_file.name, delete=False) as f:
+            with pkg.open_entry(entry) as zf:
+                sha256 = _copy_and_hash(zf, f)
+        os.replace(f.name, extracted_file)
+        return ExtractedFile(str(extracted_file), sha256)
+
+    def _extract(self, key: str, pkg: pkgprov.Package, entry: pkgprov.PackageEntry, sha256: str | None, produced: list) -> ExtractedFile:
+        """Extracts entry as `key`, appends to `produced` so the caller knows the content is its own"""
+        produced.append(True)
+        with trace.span("extract", cpu=True, name=entry.name, version=pkg.version, size=entry.size) as span_args:
+            disk_path = self.disk_dir / key[:key.index('-') + 3] / key
+            if (disk_sha256 := _verify_and_hash(disk_path, entry)) is not None and disk_sha256 == (sha256 or self._hash_entry(pkg, entry)):
+                span_args["tier"] = "reused"
+                self._count(reused=1, read_bytes=entry.size)
+                return ExtractedFile(str(disk_path), disk_sha256)
+            if self._reserve_memory(entry.size):
+                span_args["tier"] = "memory"
+                self._count(memory=1, read_bytes=entry.size, written_bytes=entry.size)
+                try:
+                    return self._extract_to_memory(pkg, entry)
+                except:
+                    with self._lock:
+                        self.memory_used -= entry.size
+                    raise
+            span_args["tier"] = "disk"
+            self._count(disk=1, read_bytes=entry.size, written_bytes=entry.size)
+            return self._extract_to_disk(pkg, entry, disk_path)
+
+    def close(self):
+        """Closes memory files, paths returned so far must not be used afterwards"""
+        self._extract_once.cache_clear()
+        with self._lock:
+            for fd in self._memory_fds:
+                os.close(fd)
+            self._memory_fds.clear()
+            self.memory_used = 0
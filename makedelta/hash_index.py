@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+import typing
+
+from . import pkgprov
+
+create_table_sql = """
+CREATE TABLE "entry_hash" (
+	"package" TEXT,
+	"version" TEXT,
+	"name" TEXT,
+	"size" INTEGER,
+	"checksum" TEXT,
+	"sha256" TEXT,
+	PRIMARY KEY ("package", "version", "name", "size", "checksum")
+);
+"""
+
+# pending rows are committed in one transaction once there are this many
+_FLUSH_BATCH = 1000
+
+def _checksum_key(entry: pkgprov.PackageEntry):
+    return f"{entry.checksum_type}:{entry.checksum.hex()}"
+
+class HashIndex:
+    """Persistent sha256 of package entries, keyed by package, version, entry name, size and checksum.
+
+    Added hashes are buffered and committed in batches, `flush()` or `close()` commits the rest.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending: dict[tuple[str, str, str, int, str], str] = {}
+        cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='entry_hash';")
+        table_exists = cursor.fetchone()
+        if not table_exists:
+            with self.conn:
+                self.conn.executescript(create_table_sql)
+
+    def add(self, package: str, version: str, entry: pkgprov.PackageEntry, sha256: str):
+        self.add_many(package, version, [(entry, sha256)])
+
+    def add_many(self, package: str, version: str, hashes: typing.Iterable[tuple[pkgprov.PackageEntry, str]]):
+        with self.lock:
+            for entry, sha256 in hashes:
+                self.pending[(package, version, entry.name, entry.size, _checksum_key(entry))] = sha256
+            if len(self.pending) >= _FLUSH_BATCH:
+                self._flush()
+
+    def _flush(self):
+        if self.pending:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO entry_hash VALUES (?, ?, ?, ?, ?, ?)", ((*k, v) for k, v in self.pending.items()))
+            self.pending.clear()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def query(self, package: str, version: str, entry: pkgprov.PackageEntry) -> str | None:
+        key = (package, version, entry.name, entry.size, _checksum_key(entry))
+        with self.lock:
+            if (sha256 := self.pending.get(key)) is not None:
+                return sha256
+            cursor = self.conn.execute("SELECT sha256 FROM entry_hash WHERE package = ? AND version = ? AND name = ? AND size = ? AND checksum = ?;", key)
+            result = cursor.fetchone()
+        if result is None:
+            return None
+        return result[0]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
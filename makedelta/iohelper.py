@@ -1,8 +1,11 @@
+import errno
 import hashlib
 import tarfile
 import os
 import io
 import random
+import shutil
+import typing
 from collections.abc import Buffer
 from contextlib import contextmanager
 
@@ -66,3 +69,66 @@ def safe_output_fileobj(name: os.PathLike, mode: str = 'wb', *open_args, **open_
         if os.path.exists(tmpfile):
             os.unlink(tmpfile)
         raise
+
+class HashingWriter:
+    """Write-only file object passing data to fileobj while computing its sha256 and size"""
+    def __init__(self, fileobj: typing.BinaryIO):
+        self.fileobj = fileobj
+        self.size = 0
+        self._hash = hashlib.sha256()
+    def writable(self):
+        return True
+    def write(self, data: Buffer) -> int:
+        written = self.fileobj.write(data)
+        self._hash.update(memoryview(data)[:written])
+        self.size += written
+        return written
+    def flush(self):
+        self.fileobj.flush()
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+# errors of kernel copies on unsupported file systems or kernels, handled by the next method
+_KERNEL_COPY_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+def _kernel_copy(in_fd: int, out_fd: int, out_offset: int, size: int) -> int:
+    """Copies up to size bytes from the start of in_fd to out_offset in out_fd, returns bytes copied"""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        # file systems with reflinks (btrfs, XFS) share extents instead of copying when they can
+        try:
+            while copied < size:
+                n = os.copy_file_range(in_fd, out_fd, size - copied, copied, out_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+    if hasattr(os, 'sendfile'):
+        try:
+            os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+            while copied < size:
+                n = os.sendfile(out_fd, in_fd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                raise
+    return copied
+
+def append_file(dst: typing.BinaryIO, src: os.PathLike) -> int:
+    """Copies the content of src to the current position of dst without passing it through Python buffers
+    where possible, falls back to a buffered copy. Returns the size of src."""
+    dst.flush()
+    offset = dst.tell()
+    with open(src, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        copied = _kernel_copy(f.fileno(), dst.fileno(), offset, size)
+        dst.seek(offset + copied)
+        if copied < size:
+            f.seek(copied)
+            shutil.copyfileobj(f, dst, 1048576)
+    return size
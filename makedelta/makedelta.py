@@ -1,27 +1,39 @@
 
 import io
+import contextlib
+import mmap
+import operator
+import bisect
+import hashlib
 import json
-import pathlib
 import sys
-import tempfile
-import time
 import typing
 import functools
 import dataclasses
 import concurrent.futures
 import os
-import shutil
 import tarfile
+import threading
 import struct
+import time
 from collections import defaultdict
 
-from . import pkgdiff
 from . import manifest
 from . import iohelper
 from . import pkgprov
+from . import pkgdiff
 from . import concurrent_cache
 from . import dataproc
+from . import trace
+from . import metrics
+from . import extract_store
+from . import diff_matrix
+from . import compression_profiles
+from .hash_index import HashIndex
+from .zstd_params import CompressionParameters
 from .patch_cache import PatchCache
+from .patch_store import PatchBlobStore
+from .scheduler import MemoryBudgetExecutor
 
 from .model import AddFile, FileActionRecord, PatchFile, RemoveFile, ReplaceFile
 
@@ -29,10 +41,52 @@ assert sys.version_info >= (3, 11)  # for ZipFile(metadata_encoding)
 
 cache_dir = 'cache'
 patch_cache_dir = 'cache/patch_cache'
+entry_hash_db = 'cache/entry_hash.db'
+diff_size_db = 'cache/diff_size.db'
 temp_extract_dir = 'cache/pkg_extract'
 chunk_temp_dir = 'output/temp'
 outdir = 'output'
 
+# write a Chrome/Perfetto trace of the run to this file
+trace_output = os.environ.get("MAKEDELTA_TRACE")
+
+# patch generation and chunk compression jobs are admitted while their estimated memory fits in this budget
+# None for three quarters of physical memory
+job_memory_budget: int | None = None
+
+# least recently used patches are removed when the patch store grows over this size
+patch_store_budget = 16 * 1024 * 1048576
+# race zstd against bsdiff instead of always generating both
+# the other candidate is cancelled when a patch is under race_accept_ratio of the new file size,
+# or when it runs longer than race_time_factor times the first finished one (but at least race_min_wait seconds),
+# a candidate cancelled on time is recorded in the patch cache and not generated by later runs for race_abandoned_expiry seconds
+patch_race_mode = True
+race_accept_ratio = 0.002
+race_time_factor = 8.0
+race_min_wait = 10.0
+race_abandoned_expiry = 30 * 86400
+# part of patch store keys, change when patch generation changes, the zstd level is appended
+zstd_patch_params = 'patch-from'
+bsdiff_patch_params = ''
+
+# extracted entries up to this size are kept in memory instead of temp_extract_dir, within the total budget
+# entries kept in memory are not reused by later runs
+extract_memory_entry_limit = 64 * 1048576
+extract_memory_budget = 2048 * 1048576
+
+# levels, windows and threads of each artefact kind, selected with --profile
+compression_profile = compression_profiles.PROFILES["release"]
+# train a zstd dictionary on the small delta chunks of a target and compress them with it,
+# consumers must load the dictionary chunk named by the delta manifest
+chunk_dictionary = False
+chunk_dictionary_size = 32 * 1024
+# estimated content size of delta chunks that share the dictionary, larger chunks compress well on their own
+chunk_dictionary_member_limit = 1048576
+chunk_dictionary_min_members = 8
+# split the fallback chunks into zstd frames of about this content size at tar member boundaries, 0 for one frame
+# frames are compressed in parallel and indexed in the chunk manifest, so consumers can fetch single files
+chunk_frame_size = 0
+
 @dataclasses.dataclass(slots=True)
 class PackageContentDiff:
     base_version: list[str]
@@ -55,35 +109,156 @@ class CachedBinaryPatch:
     estimated_compressed_size: int
 
 
+class _FileTimeline:
+    """Versions in which a file differs from the target version, as ascending version ranks per content"""
+    __slots__ = ('ranks',)
+    def __init__(self):
+        self.ranks: dict[typing.Hashable, list[int]] = {}
+
+    def add(self, rank: int, dedup_key: typing.Hashable):
+        ranks = self.ranks.setdefault(dedup_key, [])
+        if ranks and ranks[-1] > rank:
+            bisect.insort(ranks, rank)
+        else:
+            ranks.append(rank)
+
+    def newest_before(self, dedup_key: typing.Hashable, rank: int) -> int | None:
+        """Newest version with this content that is newer than rank"""
+        ranks = self.ranks.get(dedup_key)
+        if ranks and ranks[0] < rank:
+            return ranks[0]
+        return None
+
+    def oldest_of_each_before(self, rank: int) -> list[int]:
+        """For each content seen in versions newer than rank, the oldest such version, oldest first"""
+        result = [ranks[bisect.bisect_left(ranks, rank) - 1] for ranks in self.ranks.values() if ranks[0] < rank]
+        result.sort(reverse=True)
+        return result
+
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class BuiltChunk:
+    uncompressed_size: int
+    sha256: str
+    """Of the compressed chunk file, computed while writing it"""
+    dictionary: bool = False
+    """Compressed with the dictionary chunk of the package"""
+    frames: list[manifest.ChunkFrame] | None = None
+    """Frame index of chunks split into independent frames"""
+
+
+@dataclasses.dataclass(slots=True)
+class DeltaTarget:
+    versions: list[str]
+    """Target version first, then previous versions"""
+    nonlinear_versions: list[str]
+
+
+@dataclasses.dataclass(slots=True)
+class DeltaBuild:
+    """Per-target state of a run, caches and worker pools are shared between targets and variants"""
+    variant: str | None
+    pkgs: dict[str, pkgprov.Package]
+    latest: str
+    previous: list[str]
+    """Sorted previous versions"""
+    report_suffix: str
+    report_file: typing.TextIO
+    metrics: metrics.BuildMetrics
+    delta_records: list[PackageContentDiff] = dataclasses.field(default_factory=list)
+    unchanged_names: list[str] = dataclasses.field(default_factory=list)
+    patch_strategy: dict[PatchFile, CachedBinaryPatch] = dataclasses.field(default_factory=dict)
+    chunks: list[tuple[manifest.ChunkTarget, str, concurrent.futures.Future[BuiltChunk]]] = dataclasses.field(default_factory=list)
+    """Chunk target, chunk file and the job building it"""
+
 @dataclasses.dataclass(slots=True)
-class _FileChangeRecord:
-    since_version: str
-    dedup_key: typing.Hashable
+class BuildSession:
+    """State kept between builds of a long-running process, see makedelta.watch.
+
+    Extracted files stay until `close()`, and the diff size matrix of each variant keeps
+    the sizes and entries digests of packages that are still open. Built chunks are reused
+    while their file is unchanged; compression settings must not change within a session.
+    """
+    diff_sizes: dict[str | None, diff_matrix.DiffSizeMatrix] = dataclasses.field(default_factory=dict)
+    chunks: dict[str, tuple[str, BuiltChunk | None, tuple[int, int] | None]] = dataclasses.field(default_factory=dict)
+    """Built chunks by key, with the size and mtime of their file when built"""
+
+    def reusable_chunks(self) -> dict[str, tuple[str, concurrent.futures.Future[BuiltChunk | None]]]:
+        """Built chunks whose file is unchanged, as completed jobs for `submit_chunks`"""
+        result = {}
+        for key, (chunkfile, built, stat) in self.chunks.items():
+            if _file_stat(chunkfile) == stat:
+                future = concurrent.futures.Future()
+                future.set_result(built)
+                result[key] = (chunkfile, future)
+        return result
+
+    def add_chunks(self, shared_chunks: dict[str, tuple[str, concurrent.futures.Future[BuiltChunk | None]]]):
+        for key, (chunkfile, future) in shared_chunks.items():
+            self.chunks[key] = (chunkfile, future.result(), _file_stat(chunkfile))
+
+    def close(self):
+        for x in self.diff_sizes.values():
+            x.close()
+        self.diff_sizes.clear()
+        self.chunks.clear()
+        release_extracted_files()
+
+def _file_stat(name: str) -> tuple[int, int] | None:
+    try:
+        st = os.stat(name)
+    except FileNotFoundError:
+        return None
+    # chunk files are replaced, not rewritten in place
+    return st.st_size, st.st_mtime_ns
 
 lru_cached_sha256_file = functools.lru_cache(maxsize=None)(iohelper.sha256_file)
-lru_cached_pkgdiff = functools.lru_cache(maxsize=640)(pkgdiff.package_diff)
+# prepared patch sources hold the indexed reference file, keep a few for patching to multiple targets
+cached_zstd_patch_source = concurrent_cache.once_lru_cache(maxsize=4)(dataproc.zstd_prepare_patch_source)
+extracted_files = extract_store.ExtractStore(temp_extract_dir, extract_memory_entry_limit, extract_memory_budget)
+# opened by main, sha256 of extracted entries are recorded here for later runs
+entry_hash_index: HashIndex | None = None
+# replaced for each build, saved as delta_report.json
+build_metrics = metrics.BuildMetrics()
+# opened by main, holds generated patch files
+patch_store: PatchBlobStore | None = None
 
 
 
-def sort_versions(versions, nonlinear_versions, zips):
+@trace.traced("sort_versions")
+def sort_versions(versions, nonlinear_versions, zips, diff_sizes: diff_matrix.DiffSizeMatrix | None = None):
     # TODO: automatically find versions not from this channel
     local_versions = [x for x in versions if x not in nonlinear_versions]
+    if diff_sizes is None:
+        diff_sizes = diff_matrix.DiffSizeMatrix(zips)
 
-    def calc_weighted_avgdiff(version_list):
-        diffsize = [len(lru_cached_pkgdiff(zips[a], zips[b])) for a, b in zip(version_list[:-1], version_list[1:])]
-        weighted_avgdiff = sum(x * (len(diffsize)-i)/len(diffsize) for i, x in enumerate(diffsize))
-        return weighted_avgdiff
-
+    # the weighted average diff of a list with n pairs is sum(diff[j] * (n - j)) / n,
+    # all insertion points give n pairs, so compare the sums and only recompute the pairs around the insertion point
     while nonlinear_versions:
         version_to_insert = nonlinear_versions.pop()
-        weighted_avgdiff_after_insert = []
-        for i in range(len(local_versions)+1):
-            new_version_list = local_versions[:]
-            new_version_list.insert(i, version_to_insert)
-            weighted_avgdiff_after_insert.append(calc_weighted_avgdiff(new_version_list))
-        best_insert = weighted_avgdiff_after_insert.index(min(weighted_avgdiff_after_insert))
+        n = len(local_versions)
+        pair_diff = [diff_sizes[a, b] for a, b in zip(local_versions[:-1], local_versions[1:])]
+        neighbour_diff = [diff_sizes[x, version_to_insert] for x in local_versions]
+        # pairs before the insertion point keep their index
+        prefix = [0]
+        for j, d in enumerate(pair_diff):
+            prefix.append(prefix[-1] + d * (n - j))
+        # pairs after the insertion point move to the next index
+        suffix = [0] * (len(pair_diff) + 1)
+        for j in reversed(range(len(pair_diff))):
+            suffix[j] = suffix[j + 1] + pair_diff[j] * (n - j - 1)
+        best_insert = 0
+        best_cost = None
+        for i in range(n + 1):
+            cost = prefix[max(i - 1, 0)] + suffix[min(i, len(pair_diff))]
+            if i > 0:
+                cost += neighbour_diff[i - 1] * (n - i + 1)
+            if i < n:
+                cost += neighbour_diff[i] * (n - i)
+            if best_cost is None or cost < best_cost:
+                best_insert = i
+                best_cost = cost
         local_versions.insert(best_insert, version_to_insert)
-    
 
     sorted_versions = local_versions[:]
     return sorted_versions
@@ -91,6 +266,21 @@ def sort_versions(versions, nonlinear_versions, zips):
 def need_binary_patch(entry: pkgprov.PackageEntry):
     return entry.name.endswith('.dll') or entry.name.endswith('.exe')
 
+def release_extracted_files():
+    """Closes the memory files of extracted entries and forgets everything cached by their paths"""
+    extracted_files.close()
+    _concurrent_extract_entry.cache_clear()
+    cached_zstd_patch_source.cache_clear()
+    lru_cached_sha256_file.cache_clear()
+
+def reset_caches():
+    """Forgets everything cached in this process, so the next build starts as cold as a new process"""
+    global extracted_files
+    release_extracted_files()
+    concurrent_entry_sha256.cache_clear()
+    pkgdiff.entry_table.cache_clear()
+    extracted_files = extract_store.ExtractStore(temp_extract_dir, extract_memory_entry_limit, extract_memory_budget)
+
 def _package_full_name(pkg: pkgprov.Package):
     components = [pkg.name, pkg.version]
     if pkg.variant:
@@ -98,59 +288,213 @@ def _package_full_name(pkg: pkgprov.Package):
     return '-'.join(components)
 
 @concurrent_cache.once_cache
-def concurrent_extract_file(pkg: pkgprov.Package, name: str):
-    version = pkg.version
+def _concurrent_extract_entry(pkg: pkgprov.Package, name: str) -> extract_store.ExtractedFile:
     zipinfo = pkg.get_entry(name)
-    extract_targetdir = pathlib.Path(temp_extract_dir) / _package_full_name(pkg) / pathlib.Path(version)
-    arcpath = pathlib.Path(name)
-    if arcpath.is_absolute():
-        raise ValueError("path must be relative")
-    if '..' in arcpath.parts:
-        raise ValueError("path traversal not allowed")
-    if arcpath.is_reserved():
-        raise ValueError("invalid path in this system: " + name)
-    extracted_file = extract_targetdir / arcpath
-    extracted_file.parent.mkdir(parents=True, exist_ok=True)
-    with tempfile.NamedTemporaryFile(mode='wb', dir=extracted_file.parent, prefix=extracted_file.name, delete=False) as f:
-        with pkg.open_entry(zipinfo) as zf:
-            shutil.copyfileobj(zf, f, 262144)
-    os.utime(f.name, (time.time(), zipinfo.mtime))
-    os.replace(f.name, extracted_file)
-    result = str(extracted_file)
+    known_sha256 = None
+    if entry_hash_index is not None:
+        known_sha256 = entry_hash_index.query(_package_full_name(pkg), pkg.version, zipinfo)
+    # shared between packages with identical content, a known sha256 saves hashing the entry to verify that
+    result = extracted_files.extract(pkg, zipinfo, known_sha256)
+    if entry_hash_index is not None and result.sha256 != known_sha256:
+        entry_hash_index.add(_package_full_name(pkg), pkg.version, zipinfo, result.sha256)
     return result
 
+def concurrent_extract_file(pkg: pkgprov.Package, name: str) -> str:
+    return _concurrent_extract_entry(pkg, name).path
 
-def _entry_based_random(oldcrc: pkgprov.PackageEntry):
-    return f"{oldcrc.size:08X}{oldcrc.checksum[:4].hex().upper()}"
-
-def _patch_filename(patchfile: PatchFile, oldent: pkgprov.PackageEntry, newent: pkgprov.PackageEntry, extname: str):
-    filename = f'{os.path.basename(patchfile.path)}-{_entry_based_random(oldent)}-{_entry_based_random(newent)}' + extname
-    return os.path.join(patch_cache_dir, patchfile.from_version, filename)
-
-def make_patch_zstd(patchfile: PatchFile, oldent: pkgprov.PackageEntry, newent: pkgprov.PackageEntry, to_version_: str, orig_file_: os.PathLike, new_file_: os.PathLike) -> CachedBinaryPatch:
-    patchfilename = _patch_filename(patchfile, oldent, newent, '.zst')
+@concurrent_cache.once_cache
+@trace.traced("sha256")
+def concurrent_entry_sha256(pkg: pkgprov.Package, name: str) -> str:
+    """sha256 of a package entry, from the persistent index if possible"""
+    if entry_hash_index is not None:
+        sha256 = entry_hash_index.query(_package_full_name(pkg), pkg.version, pkg.get_entry(name))
+        if sha256 is not None:
+            build_metrics.count("entry_hash.hit")
+            return sha256
+    build_metrics.count("entry_hash.miss")
+    return _concurrent_extract_entry(pkg, name).sha256
+
+
+def _patch_blob(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package, patch_type: str, params: str, extname: str):
+    old_sha256 = concurrent_entry_sha256(old_pkg, patchfile.path)
+    new_sha256 = concurrent_entry_sha256(new_pkg, patchfile.path)
+    key = patch_store.blob_key(old_sha256, new_sha256, patch_type, params)
+    return key, patch_store.path(key, extname)
+
+def _zstd_blob(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package):
+    level = compression_profile.params("patch", new_pkg.get_entry(patchfile.path).size).level
+    blob_key, patchfilename = _patch_blob(patchfile, old_pkg, new_pkg, "zstd", f'{zstd_patch_params}:{level}', '.zst')
+    return blob_key, patchfilename, level
+
+def _start_patch_zstd(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package):
+    """Returns blob key, patch file name and the running patch job, or None if the patch is already stored"""
+    blob_key, patchfilename, level = _zstd_blob(patchfile, old_pkg, new_pkg)
+    job = None
     if not os.path.exists(patchfilename):
         os.makedirs(os.path.dirname(patchfilename), exist_ok=True)
-        dataproc.zstd_generate_patch(orig_file_, new_file_, patchfilename)
+        orig_file = concurrent_extract_file(old_pkg, patchfile.path)
+        new_file = concurrent_extract_file(new_pkg, patchfile.path)
+        job = dataproc.zstd_start_patch(orig_file, new_file, patchfilename, level, cached_zstd_patch_source)
+    return blob_key, patchfilename, job
+
+def _finish_patch_zstd(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package, blob_key: str, patchfilename: str, generated: bool):
+    newent = new_pkg.get_entry(patchfile.path)
+    if generated:
+        build_metrics.add_io("patch", read=old_pkg.get_entry(patchfile.path).size + newent.size, written=os.path.getsize(patchfilename))
     patchsize = os.path.getsize(patchfilename)
 
     # zstd minimum encoded stream is ~100 bytes per input MiB: https://github.com/facebook/zstd/issues/2576#issuecomment-818927743
     # the output file can be further compressed if it hits this limit
     # since we are including the patch file in compressed tar, estimate compressed size for patch type selection
-    nested_patchfilename = patchfilename + '.zst'
-    if patchsize < os.path.getsize(new_file_) * 0.0002:
+    if patchsize < newent.size * 0.0002:
+        nested_params = compression_profile.params("nested_patch", patchsize)
+        nested_patchfilename = f'{patchfilename}.{nested_params.level}.zst'
         if not os.path.exists(nested_patchfilename):
-            dataproc.zstd_compress_file(patchfilename, nested_patchfilename)
+            dataproc.zstd_compress_file(patchfilename, nested_patchfilename, nested_params)
         patchsize = os.path.getsize(nested_patchfilename)
+    patch_store.touch(blob_key)
 
-    return CachedBinaryPatch(patchfile, to_version_, "zstd", patchfilename, patchsize)
+    return CachedBinaryPatch(patchfile, new_pkg.version, "zstd", patchfilename, patchsize)
 
-def make_patch_bsdiff(patchfile: PatchFile, oldent: pkgprov.PackageEntry, newent: pkgprov.PackageEntry, to_version_: str, orig_file_: os.PathLike, new_file_: os.PathLike) -> CachedBinaryPatch:
-    patchfilename = _patch_filename(patchfile, oldent, newent, '.bsdiffx')
+def make_patch_zstd(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package) -> CachedBinaryPatch:
+    blob_key, patchfilename, level = _zstd_blob(patchfile, old_pkg, new_pkg)
+    generated = not os.path.exists(patchfilename)
+    if generated:
+        os.makedirs(os.path.dirname(patchfilename), exist_ok=True)
+        orig_file = concurrent_extract_file(old_pkg, patchfile.path)
+        new_file = concurrent_extract_file(new_pkg, patchfile.path)
+        dataproc.zstd_generate_patch(orig_file, new_file, patchfilename, cached_zstd_patch_source(orig_file, level), level)
+    return _finish_patch_zstd(patchfile, old_pkg, new_pkg, blob_key, patchfilename, generated)
+
+def _start_patch_bsdiff(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package):
+    """Returns blob key, patch file name and the running process, or None if the patch is already stored"""
+    blob_key, patchfilename = _patch_blob(patchfile, old_pkg, new_pkg, "bsdiff", bsdiff_patch_params, '.bsdiffx')
+    proc = None
     if not os.path.exists(patchfilename):
         os.makedirs(os.path.dirname(patchfilename), exist_ok=True)
-        dataproc.bsdiff_generate_patch(orig_file_, new_file_, patchfilename)
-    return CachedBinaryPatch(patchfile, to_version_, "bsdiff", patchfilename, os.path.getsize(patchfilename))
+        orig_file = concurrent_extract_file(old_pkg, patchfile.path)
+        new_file = concurrent_extract_file(new_pkg, patchfile.path)
+        proc = dataproc.bsdiff_start_patch(orig_file, new_file, patchfilename)
+    return blob_key, patchfilename, proc
+
+def _finish_patch_bsdiff(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package, blob_key: str, patchfilename: str, generated: bool):
+    if generated:
+        build_metrics.add_io("patch", read=old_pkg.get_entry(patchfile.path).size + new_pkg.get_entry(patchfile.path).size, written=os.path.getsize(patchfilename))
+    patch_store.touch(blob_key)
+    return CachedBinaryPatch(patchfile, new_pkg.version, "bsdiff", patchfilename, os.path.getsize(patchfilename))
+
+def make_patch_bsdiff(patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package) -> CachedBinaryPatch:
+    blob_key, patchfilename, proc = _start_patch_bsdiff(patchfile, old_pkg, new_pkg)
+    if proc is not None:
+        proc.wait()
+    return _finish_patch_bsdiff(patchfile, old_pkg, new_pkg, blob_key, patchfilename, proc is not None)
+
+def _patch_span(patch_type: str, patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package):
+    return trace.span(f"{patch_type} patch", cpu=True, file=patchfile.path, from_version=old_pkg.version, to_version=new_pkg.version,
+                      old_size=old_pkg.get_entry(patchfile.path).size, new_size=new_pkg.get_entry(patchfile.path).size)
+
+def patch_job_memory(patch_type: str, patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package) -> int:
+    """Estimated peak memory of generating a patch of patch_type"""
+    old_size = old_pkg.get_entry(patchfile.path).size
+    new_size = new_pkg.get_entry(patchfile.path).size
+    if patch_type == "zstd":
+        return dataproc.zstd_patch_memory(old_size, new_size, compression_profile.params("patch", new_size).level)
+    elif patch_type == "bsdiff":
+        return dataproc.bsdiff_patch_memory(old_size, new_size)
+    return 0
+
+def _wins_race(patch_size: int, new_entry: pkgprov.PackageEntry):
+    return patch_size <= new_entry.size * race_accept_ratio
+
+def abandoned_patch_type(patch_type: str) -> str:
+    """PatchCache type recording that patch_type lost a race on time, so later runs don't retry it until race_abandoned_expiry"""
+    return f"{patch_type}:abandoned"
+
+# the bsdiff process starts first, zstd prepares its source in its own thread
+_race_candidates = {"bsdiff": (_start_patch_bsdiff, _finish_patch_bsdiff), "zstd": (_start_patch_zstd, _finish_patch_zstd)}
+# seconds between checks of the running candidates
+_race_poll_interval = 0.05
+
+class PatchRace:
+    """zstd and bsdiff candidates of a patch, each generated by a job of its own with `run(patch_type)`.
+
+    A patch under race_accept_ratio of the new file size ends the race and the other candidate is
+    cancelled without being given up on, its size is known to lose. Once one candidate finished,
+    the other is given up on when it runs race_time_factor times longer since it started (but at
+    least race_min_wait seconds). When the race is decided, `on_decided(results, abandoned_types)`
+    is called and `future` gets the finished patches, a cancelled job returns once its candidate stopped.
+    """
+    def __init__(self, patchfile: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package, on_decided: typing.Callable[[list[CachedBinaryPatch], list[str]], None]):
+        self.patchfile = patchfile
+        self.old_pkg = old_pkg
+        self.new_pkg = new_pkg
+        self.on_decided = on_decided
+        self.future: concurrent.futures.Future[list[CachedBinaryPatch]] = concurrent.futures.Future()
+        # jobs running the candidates, queued ones are cancelled when the race is decided
+        self.jobs: list[concurrent.futures.Future] = []
+        self._lock = threading.Lock()
+        self._decided = threading.Event()
+        self._pending = set(_race_candidates)
+        self._results: list[CachedBinaryPatch] = []
+        self._abandoned: list[str] = []
+        self._time_limit = None
+
+    def _generate(self, patch_type: str) -> tuple[CachedBinaryPatch | None, bool, float]:
+        """Returns the patch or None, whether the candidate was given up on, and the time it took"""
+        start_patch, finish_patch = _race_candidates[patch_type]
+        start_time = time.monotonic()
+        blob_key, patchfilename, job = start_patch(self.patchfile, self.old_pkg, self.new_pkg)
+        if job is not None:
+            while not job.wait(_race_poll_interval):
+                if self._decided.is_set():
+                    job.cancel()
+                    return None, False, 0
+                if self._time_limit is not None and time.monotonic() - start_time >= self._time_limit:
+                    job.cancel()
+                    return None, True, 0
+        return finish_patch(self.patchfile, self.old_pkg, self.new_pkg, blob_key, patchfilename, job is not None), False, time.monotonic() - start_time
+
+    def run(self, patch_type: str):
+        with _patch_span(patch_type, self.patchfile, self.old_pkg, self.new_pkg) as span_args:
+            try:
+                result, abandoned, elapsed = (None, False, 0) if self._decided.is_set() else self._generate(patch_type)
+            except BaseException as e:
+                self._decide(e)
+                raise
+            span_args["patch_size"] = result.estimated_compressed_size if result is not None else None
+            span_args["abandoned"] = abandoned
+        with self._lock:
+            self._pending.discard(patch_type)
+            if self._decided.is_set():
+                return
+            if result is not None:
+                self._results.append(result)
+                if _wins_race(result.estimated_compressed_size, self.new_pkg.get_entry(self.patchfile.path)):
+                    self._pending.clear()
+                elif self._time_limit is None:
+                    self._time_limit = max(race_min_wait, elapsed * race_time_factor)
+            if abandoned:
+                self._abandoned.append(patch_type)
+            if self._pending:
+                return
+        self._decide()
+
+    def _decide(self, error: BaseException | None = None):
+        with self._lock:
+            if self._decided.is_set():
+                return
+            self._decided.set()
+        for job in self.jobs:
+            job.cancel()
+        if error is None:
+            try:
+                self.on_decided(self._results, self._abandoned)
+            except BaseException as e:
+                error = e
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(self._results)
 
 # FIXME: the batch version doesn't perform better than single file version even in batch mode
 # def make_patch_bsdiff_batch(patchfile: PatchFile, orig_file_: os.PathLike, oldcrc: int, new_version_file_crc: list[tuple[str, os.PathLike, int]]) -> list[GeneratedPatchFile]:
@@ -175,51 +519,18 @@ def make_patch_bsdiff(patchfile: PatchFile, oldent: pkgprov.PackageEntry, newent
 #     return results
 
 
-def find_best_patch(patch_cache: PatchCache, pkgs: dict[str, pkgprov.Package], delta_records: list[PackageContentDiff], latest_version, sorted_previous_versions: list[str]) -> dict[PatchFile, CachedBinaryPatch]:
-    each_patch: defaultdict[PatchFile, list[CachedBinaryPatch]] = defaultdict(list)
-
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
-    completed_jobs = 0
-    future_count = 0
-
-    single_futures: list[concurrent.futures.Future[CachedBinaryPatch]] = []
-    batch_futures: list[concurrent.futures.Future[list[CachedBinaryPatch]]] = []
-
-    def future_callback(future):
-        nonlocal completed_jobs
-        completed_jobs += 1
-        report_progress()
-
-    def report_progress():
-        sys.stderr.write(f"\rfind_best_patch: {completed_jobs}/{future_count}")
-        sys.stderr.flush()
-    
-    def as_future(callable, *args, **kwargs):
-        nonlocal future_count
-        future_count += 1
-        future = executor.submit(callable, *args, **kwargs)
-        future.add_done_callback(future_callback)
-        return future
-
-    file_changelog: defaultdict[str, list[_FileChangeRecord]] = defaultdict(list)
-    file_hash_to_version_map: defaultdict[tuple[str, typing.Hashable], list[str]] = defaultdict(list)
+def _patch_candidates(pkgs: dict[str, pkgprov.Package], delta_records: list[PackageContentDiff], latest_version, sorted_previous_versions: list[str], each_patch: defaultdict[PatchFile, list[CachedBinaryPatch]]):
+    """Target versions worth patching to for each PatchFile, copies (A -> B -> A) go to each_patch directly"""
+    # 0 is the newest previous version
+    version_rank = {version: rank for rank, version in enumerate(sorted_previous_versions)}
+    file_timelines: defaultdict[str, _FileTimeline] = defaultdict(_FileTimeline)
 
-    for delta_record in reversed(delta_records):
+    for delta_record in delta_records:
         for patch_file in delta_record.actions:
             if not isinstance(patch_file, PatchFile):
                 continue
             file_info = pkgs[patch_file.from_version].get_entry(patch_file.path)
-            file_dedup_key = file_info
-            # if file_dedup_key not in file_changeset[patch_file.path]:
-            #     file_changeset[patch_file.path].add(file_dedup_key)
-            file_changelog[patch_file.path].append(_FileChangeRecord(patch_file.from_version, file_dedup_key))
-            file_hash_to_version_map[(patch_file.path, file_dedup_key)].append(patch_file.from_version)
-
-
-    for filename in file_changelog:
-        file_info = pkgs[latest_version].get_entry(filename)
-        file_dedup_key = file_info
-        file_hash_to_version_map[(filename, file_dedup_key)].append(latest_version)
+            file_timelines[patch_file.path].add(version_rank[patch_file.from_version], file_info)
 
     # for each source version:
     #  find all files need to patch
@@ -227,81 +538,137 @@ def find_best_patch(patch_cache: PatchCache, pkgs: dict[str, pkgprov.Package], d
     #  dedup target versions
     #  find smallest patch among target versions
 
+    # (patch_file, target version, old sha256, new sha256)
+    patch_candidates: list[tuple[PatchFile, str, str, str]] = []
 
     for delta_record in delta_records:
         for patch_file in delta_record.actions:
             if not isinstance(patch_file, PatchFile):
                 continue
             source_file_info = pkgs[patch_file.from_version].get_entry(patch_file.path)
-            source_file_dedup_key = source_file_info
-            target_versions = [latest_version]
-            source_version_index = sorted_previous_versions.index(patch_file.from_version)
-
-            for change_record in file_changelog[patch_file.path]:
-                # don't patch to older version
-                if sorted_previous_versions.index(change_record.since_version) >= source_version_index:
-                    continue
-                if change_record.since_version == patch_file.from_version:
-                    continue
-                if change_record.since_version not in target_versions:
-                    target_versions.append(change_record.since_version)
-            
+            timeline = file_timelines[patch_file.path]
+            source_rank = version_rank[patch_file.from_version]
+
             # find if we can forward to a newer version
             # to handle case like A -> B -> A
-            versions_with_source_file = [x for x in file_hash_to_version_map[(patch_file.path, source_file_dedup_key)] if x in target_versions]
-
-            if versions_with_source_file:
-                forward_to_version = versions_with_source_file[-1]
-                each_patch[patch_file].append(CachedBinaryPatch(patch_file, forward_to_version, "copy", None, 0))
+            forward_rank = timeline.newest_before(source_file_info, source_rank)
+            if forward_rank is not None:
+                each_patch[patch_file].append(CachedBinaryPatch(patch_file, sorted_previous_versions[forward_rank], "copy", None, 0))
                 continue
 
-            # dedup target versions based on file content
-            # for same content, only keep the latest version
-            dedup_set = set()
-            dedupped_target_versions = []
-            for version in target_versions:
-                target_file_info = pkgs[version].get_entry(patch_file.path)
-                target_file_dedup_key = target_file_info
-                if target_file_dedup_key in dedup_set:
-                    continue
-                dedup_set.add(target_file_dedup_key)
-                dedupped_target_versions.append(version)
-            
+            # newer versions that changed the file, for same content, only keep the oldest version
+            # patching to older version is not useful
+            target_versions = [latest_version, *(sorted_previous_versions[x] for x in timeline.oldest_of_each_before(source_rank))]
+
             # find best patch for each dedupped target version
-            for version in dedupped_target_versions:
-                target_file_info = pkgs[version].get_entry(patch_file.path)
-                target_file_dedup_key = target_file_info
-                orig_file = concurrent_extract_file(pkgs[patch_file.from_version], patch_file.path)
-                new_file = concurrent_extract_file(pkgs[version], patch_file.path)
-                old_sha256 = lru_cached_sha256_file(orig_file)
-                new_sha256 = lru_cached_sha256_file(new_file)
-                if (size := patch_cache.query(old_sha256, new_sha256, "zstd")) is not None:
-                    each_patch[patch_file].append(CachedBinaryPatch(patch_file, version, "zstd", None, size))
-                else:
-                    single_futures.append(as_future(make_patch_zstd, patch_file, source_file_dedup_key, target_file_dedup_key, version, orig_file, new_file))
-                if (size := patch_cache.query(old_sha256, new_sha256, "bsdiff")) is not None:
-                    each_patch[patch_file].append(CachedBinaryPatch(patch_file, version, "bsdiff", None, size))
-                else:
-                    single_futures.append(as_future(make_patch_bsdiff, patch_file, source_file_dedup_key, target_file_dedup_key, version, orig_file, new_file))
+            for version in target_versions:
+                old_sha256 = concurrent_entry_sha256(pkgs[patch_file.from_version], patch_file.path)
+                new_sha256 = concurrent_entry_sha256(pkgs[version], patch_file.path)
+                patch_candidates.append((patch_file, version, old_sha256, new_sha256))
+    return patch_candidates
 
-    report_progress()
 
-    def process_future_result(result: CachedBinaryPatch):
-        each_patch[result.patch_file].append(result)
-        oldfile = concurrent_extract_file(pkgs[result.patch_file.from_version], result.patch_file.path)
-        newfile = concurrent_extract_file(pkgs[result.to_version], result.patch_file.path)
-        old_sha256 = lru_cached_sha256_file(oldfile)
-        new_sha256 = lru_cached_sha256_file(newfile)
+@trace.traced("find_best_patch")
+def find_best_patch(patch_cache: PatchCache, targets: list["DeltaBuild"]) -> list[dict[PatchFile, CachedBinaryPatch]]:
+    """Best patch for each PatchFile of each target, all patch jobs of all targets share one worker pool.
+
+    Patches between the same file contents are generated once, even when several targets or variants need them.
+    """
+    each_patch: list[defaultdict[PatchFile, list[CachedBinaryPatch]]] = [defaultdict(list) for _ in targets]
+
+    executor = MemoryBudgetExecutor(os.cpu_count(), job_memory_budget, 'patch_worker')
+    completed_jobs = 0
+    future_count = 0
+
+    # (old sha256, new sha256, job kind) -> future, shared between targets
+    jobs: dict[tuple[str, str, str], concurrent.futures.Future] = {}
+    # (target index, patch_file, target version, future)
+    waiters: list[tuple[int, PatchFile, str, concurrent.futures.Future]] = []
+
+    def future_callback(future):
+        nonlocal completed_jobs
+        completed_jobs += 1
+        report_progress()
+
+    def report_progress():
+        sys.stderr.write(f"\rfind_best_patch: {completed_jobs}/{future_count}, {executor.status()}  ")
+        sys.stderr.flush()
+    
+    def as_future(memory: int, callable, *args, **kwargs):
+        nonlocal future_count
+        future_count += 1
+        future = executor.submit(memory, callable, *args, **kwargs)
+        future.add_done_callback(future_callback)
+        return future
+
+    def shared_future(key: tuple[str, str, str], memory: int, callable, *args):
+        if key not in jobs:
+            jobs[key] = as_future(memory, callable, *args)
+        return jobs[key]
+
+    def make_and_record_patch(make_patch, patch_file: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package, old_sha256: str, new_sha256: str):
+        with _patch_span("zstd" if make_patch is make_patch_zstd else "bsdiff", patch_file, old_pkg, new_pkg) as span_args:
+            result = make_patch(patch_file, old_pkg, new_pkg)
+            span_args["patch_size"] = result.estimated_compressed_size
         patch_cache.add_patch(old_sha256, new_sha256, result.type, result.estimated_compressed_size)
+        return [result]
+
+    def race_future(patch_file: PatchFile, old_pkg: pkgprov.Package, new_pkg: pkgprov.Package, old_sha256: str, new_sha256: str):
+        """Races the candidates of a patch, each admitted by the executor with its own memory estimate"""
+        key = (old_sha256, new_sha256, "race")
+        if key in jobs:
+            return jobs[key]
+        def record(results: list[CachedBinaryPatch], abandoned: list[str]):
+            build_metrics.count("patch_race.abandoned", len(abandoned))
+            patch_cache.add_many([
+                *((old_sha256, new_sha256, x.type, x.estimated_compressed_size) for x in results),
+                *((old_sha256, new_sha256, abandoned_patch_type(x), 0) for x in abandoned),
+            ])
+        race = PatchRace(patch_file, old_pkg, new_pkg, record)
+        race.jobs = [as_future(patch_job_memory(x, patch_file, old_pkg, new_pkg), race.run, x) for x in _race_candidates]
+        jobs[key] = race.future
+        return race.future
+
+    patch_candidates = [
+        (i, *candidate)
+        for i, target in enumerate(targets)
+        for candidate in _patch_candidates(target.pkgs, target.delta_records, target.latest, target.previous, each_patch[i])
+    ]
+
+    patch_makers = {"zstd": make_patch_zstd, "bsdiff": make_patch_bsdiff}
+    known_sizes = patch_cache.query_many((old_sha256, new_sha256, patch_type) for _, _, _, old_sha256, new_sha256 in patch_candidates for patch_type in patch_makers)
+    # abandoned candidates are retried once their records expire
+    known_abandoned = patch_cache.query_many(((old_sha256, new_sha256, abandoned_patch_type(patch_type)) for _, _, _, old_sha256, new_sha256 in patch_candidates for patch_type in patch_makers),
+                                             int(time.time()) - race_abandoned_expiry)
+    for i, patch_file, version, old_sha256, new_sha256 in patch_candidates:
+        pkgs = targets[i].pkgs
+        old_pkg, new_pkg = pkgs[patch_file.from_version], pkgs[version]
+        new_entry = new_pkg.get_entry(patch_file.path)
+        sizes = {patch_type: known_sizes.get((old_sha256, new_sha256, patch_type)) for patch_type in patch_makers}
+        abandoned = {x for x in patch_makers if (old_sha256, new_sha256, abandoned_patch_type(x)) in known_abandoned}
+        build_metrics.count("patch_cache.hit", sum(x is not None for x in sizes.values()))
+        build_metrics.count("patch_cache.miss", sum(x is None for x in sizes.values()))
+        if patch_race_mode and all(x is None for x in sizes.values()) and not abandoned:
+            waiters.append((i, patch_file, version, race_future(patch_file, old_pkg, new_pkg, old_sha256, new_sha256)))
+            continue
+        for patch_type, make_patch in patch_makers.items():
+            if (size := sizes[patch_type]) is not None:
+                each_patch[i][patch_file].append(CachedBinaryPatch(patch_file, version, patch_type, None, size))
+            elif patch_race_mode and (patch_type in abandoned or any(x is not None and _wins_race(x, new_entry) for x in sizes.values())):
+                # lost a race in an earlier run
+                continue
+            else:
+                # results are recorded by the worker as soon as each patch is made
+                memory = patch_job_memory(patch_type, patch_file, old_pkg, new_pkg)
+                waiters.append((i, patch_file, version, shared_future((old_sha256, new_sha256, patch_type), memory, make_and_record_patch, make_patch, patch_file, old_pkg, new_pkg, old_sha256, new_sha256)))
+
+    report_progress()
 
     try:
-        for future in single_futures:
-            result = future.result()
-            process_future_result(result)
-        for future in batch_futures:
-            results = future.result()
-            for result in results:
-                process_future_result(result)
+        for i, patch_file, version, future in waiters:
+            for result in future.result():
+                # a shared job may have been submitted for another target, or another version with the same content
+                each_patch[i][patch_file].append(CachedBinaryPatch(patch_file, version, result.type, result.cached_deltafile, result.estimated_compressed_size))
     except KeyboardInterrupt:
         sys.stderr.write("\n")
         sys.stderr.flush()
@@ -313,35 +680,46 @@ def find_best_patch(patch_cache: PatchCache, pkgs: dict[str, pkgprov.Package], d
 
     sys.stderr.write("\n")
 
-    resolved_patch ={k: min(vs, key=lambda x: x.estimated_compressed_size) for k, vs in each_patch.items()}
+    resolved_patches = [{k: min(vs, key=lambda x: x.estimated_compressed_size) for k, vs in patches.items()} for patches in each_patch]
+
+    for target, patches, resolved_patch in zip(targets, each_patch, resolved_patches):
+        for k, vs in patches.items():
+            for x in vs:
+                # sizes from PatchCache have no file yet
+                target.metrics.add_patch_candidate(k.path, k.from_version, x.to_version, x.type, x.estimated_compressed_size, x.cached_deltafile is None and x.type != "copy")
+            chosen = resolved_patch[k]
+            target.metrics.chosen_patches[(k.path, k.from_version)] = {"to_version": chosen.to_version, "type": chosen.type, "size": chosen.estimated_compressed_size}
 
-    def deferred_patch_creation(entry: CachedBinaryPatch):
-        if entry.cached_deltafile is None:
-            oldent = pkgs[entry.patch_file.from_version].get_entry(entry.patch_file.path)
-            newent = pkgs[entry.to_version].get_entry(entry.patch_file.path)
-            oldfile = concurrent_extract_file(pkgs[entry.patch_file.from_version], entry.patch_file.path)
-            newfile = concurrent_extract_file(pkgs[entry.to_version], entry.patch_file.path)
+    def deferred_patch_creation(pkgs: dict[str, pkgprov.Package], entry: CachedBinaryPatch):
+        old_pkg = pkgs[entry.patch_file.from_version]
+        new_pkg = pkgs[entry.to_version]
+        with _patch_span(entry.type, entry.patch_file, old_pkg, new_pkg):
             if entry.type == "zstd":
-                result = make_patch_zstd(entry.patch_file, oldent, newent, entry.to_version, oldfile, newfile)
+                result = make_patch_zstd(entry.patch_file, old_pkg, new_pkg)
             elif entry.type == "bsdiff":
-                result = make_patch_bsdiff(entry.patch_file, oldent, newent, entry.to_version, oldfile, newfile)
-            elif entry.type == "copy":
-                result = None
+                result = make_patch_bsdiff(entry.patch_file, old_pkg, new_pkg)
             else:
                 raise ValueError("Unknown patch type")
-            entry.cached_deltafile = result.cached_deltafile
-
-    deferred_futures = []
-    for item in resolved_patch.values():
-        if item.cached_deltafile is None and item.type != "copy":
-            deferred_futures.append(as_future(deferred_patch_creation, item))
+        return result.cached_deltafile
+
+    deferred_jobs: dict[tuple[str, str, str], concurrent.futures.Future[os.PathLike]] = {}
+    deferred_entries: list[tuple[CachedBinaryPatch, concurrent.futures.Future[os.PathLike]]] = []
+    for target, resolved_patch in zip(targets, resolved_patches):
+        pkgs = target.pkgs
+        for item in resolved_patch.values():
+            if item.cached_deltafile is None and item.type != "copy":
+                old_pkg, new_pkg = pkgs[item.patch_file.from_version], pkgs[item.to_version]
+                key = (concurrent_entry_sha256(old_pkg, item.patch_file.path), concurrent_entry_sha256(new_pkg, item.patch_file.path), item.type)
+                if key not in deferred_jobs:
+                    deferred_jobs[key] = as_future(patch_job_memory(item.type, item.patch_file, old_pkg, new_pkg), deferred_patch_creation, pkgs, item)
+                deferred_entries.append((item, deferred_jobs[key]))
     
-    for future in deferred_futures:
+    for item, future in deferred_entries:
         # collect exceptions
-        future.result()
+        item.cached_deltafile = future.result()
     
     executor.shutdown(wait=True)
-    return resolved_patch
+    return resolved_patches
 
 
 class AmalgamatedPatch:
@@ -350,16 +728,36 @@ class AmalgamatedPatch:
         self.chunks = []
         self.offset = 0
         self.for_version = for_version
-    def add_chunk(self, target: manifest.ChunkTarget, compressed_chunk: os.PathLike):
+        self.manifest_chunk_size = 0
+        self.dictionary_index = None
+    def add_chunk(self, target: manifest.ChunkTarget, compressed_chunk: os.PathLike, sha256: str | None = None, dictionary: bool = False, frames: list[manifest.ChunkFrame] | None = None):
         size = os.path.getsize(compressed_chunk)
-        chunk_schema: manifest.Chunk = {"target": target, "offset": self.offset, "size": size, "hash": "sha256:" + lru_cached_sha256_file(compressed_chunk)}
+        if sha256 is None:
+            sha256 = lru_cached_sha256_file(compressed_chunk)
+        chunk_schema: manifest.Chunk = {"target": target, "offset": self.offset, "size": size, "hash": "sha256:" + sha256}
+        if dictionary:
+            chunk_schema["dictionary"] = True
+        if frames is not None:
+            chunk_schema["frames"] = frames
+        if target == "dictionary":
+            self.dictionary_index = len(self.chunks)
         self.chunks.append((chunk_schema, compressed_chunk))
         self.offset += size
+    def download_size(self, version: str) -> int:
+        """Bytes a client on version fetches after build(): the header and manifest, chunks targeting version and the dictionary they use"""
+        chunks = [x for x, _ in self.chunks if isinstance(x["target"], list) and version in x["target"]]
+        size = self.manifest_chunk_size + sum(x["size"] for x in chunks)
+        if any(x.get("dictionary") for x in chunks):
+            size += self.chunks[self.dictionary_index][0]["size"]
+        return size
+    @trace.traced("amalgamate")
     def build(self, outfile: os.PathLike):
         delta_manifest: manifest.DeltaPackageManifest = {
             "for_version": self.for_version,
             "chunks": [x[0] for x in self.chunks]
         }
+        if self.dictionary_index is not None:
+            delta_manifest["dictionary"] = self.dictionary_index
         bio = io.BytesIO()            
         tf = tarfile.open(fileobj=bio, mode='w', format=tarfile.PAX_FORMAT)
         manifest_bytes = json.dumps(self.manifest, indent=None).encode('utf-8')
@@ -367,22 +765,23 @@ class AmalgamatedPatch:
         iohelper.write_tar_file(tf, f'.maa_update/packages/{self.manifest["name"]}/manifest.json', manifest_bytes)
         iohelper.write_tar_file(tf, f'.maa_update/delta/{self.manifest["name"]}/{self.manifest["version"]}/delta_manifest.json', delta_manifest_bytes)
         manifest_chunk = bio.getvalue()
-        compressed_manifest_chunk = dataproc.zstd_compress_bytes(manifest_chunk)
+        compressed_manifest_chunk = dataproc.zstd_compress_bytes(manifest_chunk, compression_profile.params("manifest", len(manifest_chunk)))
 
         header = b"\x5A\x2A\x4D\x18\x08\x00\x00\x00MUE1" + struct.pack('<I', len(compressed_manifest_chunk))
 
+        self.manifest_chunk_size = len(header) + len(compressed_manifest_chunk)
         with iohelper.safe_output_fileobj(outfile, 'wb') as f:
             f.write(header)
             f.write(compressed_manifest_chunk)
             for _, chunkfile in self.chunks:
-                with open(chunkfile, 'rb') as cf:
-                    shutil.copyfileobj(cf, f)
+                iohelper.append_file(f, chunkfile)
 
 
+@trace.traced("generate_file_history")
 def generate_file_history(version_order: list[str], packages: typing.Mapping[str, pkgprov.Package]):
     latest, *previous = version_order
-    latest_entries = set(packages[latest].get_entries())
-    latest_names = set(x.name for x in latest_entries)
+    latest_table = pkgdiff.entry_table(packages[latest])
+    latest_names = latest_table.name_set()
 
     global_replaced_names = set()
     global_removed_names = set()
@@ -395,8 +794,7 @@ def generate_file_history(version_order: list[str], packages: typing.Mapping[str
     delta_records: list[PackageContentDiff] = []
 
     for version in previous:
-        current_entries = packages[version].get_entries()
-        current_names = set(x.name for x in current_entries)
+        current_table = pkgdiff.entry_table(packages[version])
 
         # set to keep track of changed files between this version and latest version
         changed_entries = set()
@@ -405,11 +803,9 @@ def generate_file_history(version_order: list[str], packages: typing.Mapping[str
         assert version in for_version
         actions = []
         # print(f"To update from {version} or older:")
-        for entry in current_entries:
+        # entries matching (filename, EntryHashable) in latest are common files and skipped
+        for entry in current_table.entries_not_in(latest_table):
             entry_name = entry.name
-            if entry in latest_entries:
-                # (filename, EntryHashable) matched - common file
-                continue
             if entry_name in latest_names:
                 # file in current version, but content changed
                 if need_binary_patch(entry):
@@ -430,7 +826,7 @@ def generate_file_history(version_order: list[str], packages: typing.Mapping[str
                     actions.append(RemoveFile(entry_name))
         
         # find names in latest but not current - i.e. new files
-        new_names = latest_names - current_names
+        new_names = latest_table.names_not_in(current_table)
         for entry_name in sorted(list(new_names)):
             if entry_name not in global_replaced_names:
                 actions.append(AddFile(entry_name))
@@ -447,63 +843,66 @@ def generate_file_history(version_order: list[str], packages: typing.Mapping[str
     unchanged_names = sorted(latest_names - changed_names)
     return PackageContentVersionHistory(delta_records, unchanged_names)
 
-def copy_from_pkg_to_tar(zipfile_: pkgprov.Package, name: str, tarfile_: tarfile.TarFile):
+def copy_from_pkg_to_tar(zipfile_: pkgprov.Package, name: str, tarfile_: tarfile.TarFile, extracted_file: os.PathLike | None = None):
     file_info = zipfile_.get_entry(name)
     ti = tarfile.TarInfo(name)
     ti.size = file_info.size
     ti.mtime = file_info.mtime
     ti.mode = file_info.mode
-    with zipfile_.open_entry(name) as f:
+    with zipfile_.open_entry(name) if extracted_file is None else open(extracted_file, 'rb') as f:
         tarfile_.addfile(ti, f)
 
 
-def main(package_provider: pkgprov.PackageProvider, package_name: str, package_variant: str | None, versions: list[str], nonlinear_versions: list[str]):
-    pkgs = { x: package_provider.open_package(package_name, x, package_variant) for x in versions }
+def main(package_provider: pkgprov.PackageProvider, package_name: str, package_variant: str | None | list[str | None], versions: list[str], nonlinear_versions: list[str], extra_targets: typing.Sequence[DeltaTarget] = (),
+         session: BuildSession | None = None):
+    """Builds delta packages for versions[0] and extra_targets, package_variant may be a list to build several variants"""
+    variants = package_variant if isinstance(package_variant, list) else [package_variant]
+    if trace_output:
+        trace.enable()
+    try:
+        build_deltas(package_provider, package_name, variants, [DeltaTarget(versions, nonlinear_versions), *extra_targets], session)
+    finally:
+        if trace_output:
+            trace.save(trace_output)
+
+def build_delta(package_provider: pkgprov.PackageProvider, package_name: str, package_variant: str | None, versions: list[str], nonlinear_versions: list[str]):
+    build_deltas(package_provider, package_name, [package_variant], [DeltaTarget(versions, nonlinear_versions)])
 
-    report_file = open(os.path.join(outdir, 'delta_report.txt'), 'w', encoding='utf-8')
+def plan_target(pkgs: dict[str, pkgprov.Package], package_variant: str | None, target: DeltaTarget, diff_sizes: diff_matrix.DiffSizeMatrix, report_suffix: str) -> DeltaBuild:
+    latest, *previous = target.versions
+    report_file = open(os.path.join(outdir, f'delta_report{report_suffix}.txt'), 'w', encoding='utf-8')
 
     def print_and_report(*args, **kwargs):
         print(*args, **kwargs)
         if report_file is not sys.stdout:
             print(*args, **kwargs, file=report_file)
 
-    def report(*args, **kwargs):
-        print(*args, **kwargs, file=report_file)
-
-    latest, *previous = versions
-
-    package_manifest: manifest.PackageManifest = {
-        "name": package_name,
-        "version": latest,
-        "variant": package_variant,
-    }
-
+    if package_variant:
+        print_and_report("Variant:", package_variant)
     print_and_report("Target version:", latest)
     print_and_report("Previous versions:")
     for version in previous:
         print_and_report(f"  {version}")
-    
-    previous = sort_versions(previous, nonlinear_versions, pkgs)
+
+    previous = sort_versions(previous, list(target.nonlinear_versions), pkgs, diff_sizes)
 
     print_and_report("Sorted previous versions:")
     for version in previous:
         print_and_report(f"  {version}")
 
-    report("")
+    print("", file=report_file)
 
+    build = DeltaBuild(package_variant, pkgs, latest, previous, report_suffix, report_file, metrics.BuildMetrics())
     file_history = generate_file_history([latest, *previous], pkgs)
+    build.delta_records = file_history.version_changes
+    build.unchanged_names = file_history.unchanged_entries
+    return build
 
-    delta_records = file_history.version_changes
-    unchanged_names = file_history.unchanged_entries
-
-    patch_cache_db = patch_cache_dir + '.db'
-    patch_cache = PatchCache(patch_cache_db)
-
-    patch_strategy = find_best_patch(patch_cache, pkgs, delta_records, latest, previous)
-
-    patch_cache.close()
+def report_patch_strategy(build: DeltaBuild):
+    def report(*args, **kwargs):
+        print(*args, **kwargs, file=build.report_file)
 
-    for delta_record in delta_records:
+    for delta_record in build.delta_records:
         report(f"To update from version {delta_record.base_version}")
         for action in delta_record.actions:
             report(f"  {action}")
@@ -512,142 +911,475 @@ def main(package_provider: pkgprov.PackageProvider, package_name: str, package_v
     # pprint.pprint(delta_records)
     report("Binary patch strategy:")
     patchfile_to_str: typing.Callable[[PatchFile]] = lambda patch_file: f"{patch_file.from_version}/{patch_file.path}"
-    keys = sorted(patch_strategy.keys(), key=lambda x: previous.index(x.from_version))
+    version_rank = {version: rank for rank, version in enumerate(build.previous)}
+    keys = sorted(build.patch_strategy.keys(), key=lambda x: version_rank[x.from_version])
     for key in keys:
-        gpf = patch_strategy[key]
+        gpf = build.patch_strategy[key]
         report(f"  {patchfile_to_str(key)} \t->\t {gpf.to_version} \t({gpf.type}, est. compressed {iohelper.format_size(gpf.estimated_compressed_size)})")
     
     report("Unchanged files:")
-    for keep_name in unchanged_names:
+    for keep_name in build.unchanged_names:
             report(f"  KEEP     {keep_name}")
 
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
-
-    chunk_count = len(delta_records) + 3  # header + versions + patch fallback + unchanged files
+def _chunk_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def _derived_future(future: concurrent.futures.Future, fn) -> concurrent.futures.Future:
+    derived = concurrent.futures.Future()
+    def done(f):
+        try:
+            derived.set_result(fn(f.result()))
+        except BaseException as e:
+            derived.set_exception(e)
+    future.add_done_callback(done)
+    return derived
+
+class _FrameJoiner:
+    """Joins the frame files of a chunk in frame order, each frame as soon as it and the ones
+    before it are written, so copying and hashing the chunk overlap with compressing later frames.
+
+    `future` completes with the BuiltChunk of the joined chunk.
+    """
+    def __init__(self, chunkfile: str, frames: list[list[str]], frame_futures: list[concurrent.futures.Future[BuiltChunk]]):
+        self.chunkfile = chunkfile
+        self.frames = frames
+        self.frame_futures = frame_futures
+        self.future = concurrent.futures.Future()
+        self._index: list[manifest.ChunkFrame] = []
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._output = contextlib.ExitStack()
+        self._outfile = None
+        self._lock = threading.Lock()
+        self._joining = False
+        for future in frame_futures:
+            future.add_done_callback(self._frame_done)
+
+    def _frame_done(self, _):
+        # one thread joins at a time, frames completing meanwhile are picked up by its loop
+        with self._lock:
+            if self._joining or self.future.done():
+                return
+            self._joining = True
+        try:
+            while True:
+                with self._lock:
+                    i = len(self._index)
+                    if i == len(self.frame_futures) or not self.frame_futures[i].done():
+                        self._joining = False
+                        break
+                self._append(i, self.frame_futures[i].result())
+            if i == len(self.frame_futures):
+                self._output.close()
+                built_frames = [x.result() for x in self.frame_futures]
+                self.future.set_result(BuiltChunk(sum(x.uncompressed_size for x in built_frames), self._hash.hexdigest(), frames=self._index))
+        except BaseException as e:
+            self._output.__exit__(type(e), e, e.__traceback__)
+            self.future.set_exception(e)
+
+    def _append(self, i: int, built: BuiltChunk):
+        if self._outfile is None:
+            print("joining chunk frames", self.chunkfile, flush=True)
+            self._outfile = self._output.enter_context(iohelper.safe_output_fileobj(self.chunkfile, 'wb'))
+        framefile = f'{self.chunkfile}.{i}'
+        with open(framefile, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size:
+                # the frame was just written, hash it from the page cache without copying
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    self._hash.update(m)
+        iohelper.append_file(self._outfile, framefile)
+        os.unlink(framefile)
+        self._index.append({"offset": self._size, "size": size, "hash": "sha256:" + built.sha256, "files": self.frames[i]})
+        self._size += size
+
+def _plan_frames(pkg: pkgprov.Package, names: list[str], frame_size: int) -> list[list[str]]:
+    """Splits names into runs of about frame_size bytes of content, a larger file gets a frame of its own"""
+    frames = [[]]
+    current = 0
+    for name in names:
+        size = pkg.get_entry(name).size
+        if frame_size and frames[-1] and current + size > frame_size:
+            frames.append([])
+            current = 0
+        frames[-1].append(name)
+        current += size
+    return frames
+
+def submit_chunks(executor: MemoryBudgetExecutor, package_name: str, build: DeltaBuild, shared_chunks: dict[str, tuple[str, concurrent.futures.Future[BuiltChunk]]]) -> list[concurrent.futures.Future[BuiltChunk]]:
+    """Queues the chunk jobs of a target and adds them to build.chunks in package order.
+
+    Chunks are keyed by their content, a chunk already queued for another target or variant is reused.
+    """
+    pkgs = build.pkgs
+    latest = build.latest
+    latest_pkg = pkgs[latest]
+    patch_strategy = build.patch_strategy
+    delta_records = build.delta_records
+    unchanged_names = build.unchanged_names
+
+    chunk_count = len(delta_records) + 3  # header + versions + patch fallback + unchanged files, the dictionary is 0
     seq_length = len(str(chunk_count))
     def format_chunkseq(seq):
         return ("0" * seq_length + str(seq))[-seq_length:]
 
-    os.makedirs(chunk_temp_dir, exist_ok=True)
+    target_chunk_dir = f"{chunk_temp_dir}/{latest}{'-' + build.variant if build.variant else ''}"
+    os.makedirs(target_chunk_dir, exist_ok=True)
 
+    futures = []
+    def submit(target: manifest.ChunkTarget, chunkfile: str, key: str, memory: int, fn, *args):
+        if key not in shared_chunks:
+            shared_chunks[key] = (chunkfile, executor.submit(memory, fn, chunkfile, *args))
+            futures.append(shared_chunks[key][1])
+        build.chunks.append((target, *shared_chunks[key]))
 
-    def create_delta_chunk(chunkfile, delta_record: PackageContentDiff):
-        print("creating delta chunk", chunkfile, flush=True)
-        patch_base = delta_record.patch_base_version
+    def entry_keys(names: list[str]):
+        entries = (latest_pkg.get_entry(x) for x in names)
+        return [(x.name, extract_store.content_key(x), x.mtime, x.mode) for x in entries]
+
+    def delta_chunk_contents(delta_record: PackageContentDiff):
         chunk_manifest : manifest.ChunkManifest = {
-            "patch_base": patch_base,
+            "patch_base": delta_record.patch_base_version,
             "base": delta_record.base_version,
             "patch_files": [],
             "remove_files": [],
         }
-        with iohelper.safe_output_fileobj(chunkfile, 'wb') as outfile:
-            tf = tarfile.open(fileobj=outfile, mode='w', format=tarfile.PAX_FORMAT)
-            pending_files: list[tuple[str, str]] = []
-            for action in delta_record.actions:
-                if isinstance(action, RemoveFile):
-                    chunk_manifest["remove_files"].append(action.path)
-                elif isinstance(action, PatchFile):
-                    ti = tarfile.TarInfo(action.path)
-                    patch = patch_strategy[action]
-                    if patch.cached_deltafile is not None:
-                        ti.size = os.path.getsize(patch.cached_deltafile)
-                    old_file = concurrent_extract_file(pkgs[action.from_version], action.path)
-                    old_size = os.path.getsize(old_file)
-                    old_hash = "sha256:" + lru_cached_sha256_file(old_file)
-
-                    if patch.type == "copy":
-                        new_size = old_size
-                        new_hash = old_hash
-                    else:
-                        new_file = concurrent_extract_file(pkgs[patch.to_version], action.path)
-                        new_size = os.path.getsize(new_file)
-                        new_hash = "sha256:" + lru_cached_sha256_file(new_file)
-
-                    if patch.cached_deltafile is not None:
-                        patch_hash = lru_cached_sha256_file(patch.cached_deltafile)
-                        archive_path = f".maa_update/temp/{os.path.basename(action.path)}.{patch_hash[:8]}.{patch.type}"
-                        pending_files.append((patch.cached_deltafile, archive_path))
-                    else:
-                        archive_path = ""
-
-                    pf: manifest.PatchFile = {
-                        "file": action.path,
-                        "patch": archive_path,
-                        "patch_type": patch.type,
-                        "old_hash": old_hash,
-                        "old_size": old_size,
-                        "new_version": patch.to_version,
-                        "new_hash": new_hash,
-                        "new_size": new_size,
-                    }
-                    chunk_manifest["patch_files"].append(pf)
-            iohelper.write_tar_file(tf, f'.maa_update/delta/{package_name}/{patch_base}/chunk_manifest.json', json.dumps(chunk_manifest, indent=None).encode('utf-8'))
-            for filename, archive_path in pending_files:
-                tf.add(filename, arcname=archive_path)
-            for action in delta_record.actions:
-                if isinstance(action, AddFile) or isinstance(action, ReplaceFile):
-                    copy_from_pkg_to_tar(pkgs[latest], action.path, tf)
-            # don't close the tarfile to avoid writing EOF mark
-        dataproc.zstd_compress_file(chunkfile, f'{chunkfile}.zst')
+        pending_files: list[tuple[str, str]] = []
+        for action in delta_record.actions:
+            if isinstance(action, RemoveFile):
+                chunk_manifest["remove_files"].append(action.path)
+            elif isinstance(action, PatchFile):
+                patch = patch_strategy[action]
+                old_size = pkgs[action.from_version].get_entry(action.path).size
+                old_hash = "sha256:" + concurrent_entry_sha256(pkgs[action.from_version], action.path)
+
+                if patch.type == "copy":
+                    new_size = old_size
+                    new_hash = old_hash
+                else:
+                    new_size = pkgs[patch.to_version].get_entry(action.path).size
+                    new_hash = "sha256:" + concurrent_entry_sha256(pkgs[patch.to_version], action.path)
 
-    delta_chunks = []
-    futures = []
+                if patch.cached_deltafile is not None:
+                    patch_hash = lru_cached_sha256_file(patch.cached_deltafile)
+                    archive_path = f".maa_update/temp/{os.path.basename(action.path)}.{patch_hash[:8]}.{patch.type}"
+                    pending_files.append((patch.cached_deltafile, archive_path))
+                else:
+                    archive_path = ""
+
+                pf: manifest.PatchFile = {
+                    "file": action.path,
+                    "patch": archive_path,
+                    "patch_type": patch.type,
+                    "old_hash": old_hash,
+                    "old_size": old_size,
+                    "new_version": patch.to_version,
+                    "new_hash": new_hash,
+                    "new_size": new_size,
+                }
+                chunk_manifest["patch_files"].append(pf)
+        added_names = [x.path for x in delta_record.actions if isinstance(x, AddFile) or isinstance(x, ReplaceFile)]
+        return chunk_manifest, pending_files, added_names
+
+    def write_delta_tar(fileobj, chunk_manifest: manifest.ChunkManifest, pending_files: list[tuple[str, str]], added_names: list[str]) -> list[int]:
+        """Writes the tar stream of a delta chunk without EOF mark, returns the end offset of each member"""
+        tf = tarfile.open(fileobj=fileobj, mode='w', format=tarfile.PAX_FORMAT)
+        iohelper.write_tar_file(tf, f'.maa_update/delta/{package_name}/{chunk_manifest["patch_base"]}/chunk_manifest.json', json.dumps(chunk_manifest, indent=None).encode('utf-8'))
+        offsets = [tf.offset]
+        for filename, archive_path in pending_files:
+            tf.add(filename, arcname=archive_path)
+            offsets.append(tf.offset)
+        for name in added_names:
+            copy_from_pkg_to_tar(latest_pkg, name, tf)
+            offsets.append(tf.offset)
+        return offsets
+
+    def estimated_size(pending_files: list[tuple[str, str]], added_names: list[str]):
+        return sum(os.path.getsize(x) for x, _ in pending_files) + sum(latest_pkg.get_entry(x).size for x in added_names)
+
+    @trace.traced("delta chunk", cpu=True)
+    def create_delta_chunk(chunkfile, params: CompressionParameters, chunk_manifest: manifest.ChunkManifest, pending_files: list[tuple[str, str]], added_names: list[str]):
+        print("creating delta chunk", chunkfile, flush=True)
+        with iohelper.safe_output_fileobj(chunkfile, 'wb') as outfile:
+            hashed = iohelper.HashingWriter(outfile)
+            with dataproc.zstd_stream_writer(hashed, params) as zf:
+                write_delta_tar(zf, chunk_manifest, pending_files, added_names)
+                uncompressed_size = zf.tell()
+        return BuiltChunk(uncompressed_size, hashed.hexdigest())
+
+    @trace.traced("dictionary chunk", cpu=True)
+    def create_dictionary_chunks(dictfile, members: list[tuple[str, manifest.ChunkManifest, list[tuple[str, str]], list[str]]]) -> list[BuiltChunk | None]:
+        """Builds the dictionary chunk and the delta chunks compressed with it.
+
+        The dictionary is trained on the tar members of the chunks and only kept if it makes the
+        chunks and itself smaller than the chunks compressed alone, otherwise the dictionary chunk is None.
+        """
+        print("creating dictionary chunk", dictfile, flush=True)
+        contents = []
+        samples = []
+        for _, *args in members:
+            bio = io.BytesIO()
+            offsets = write_delta_tar(bio, *args)
+            data = bio.getvalue()
+            contents.append(data)
+            samples.extend(data[start:end] for start, end in zip([0, *offsets], offsets))
+        plain = [dataproc.zstd_compress_bytes(x, compression_profile.params("delta_chunk", len(x))) for x in contents]
+        compressed = plain
+        dictionary = dataproc.zstd_train_dictionary(samples, min(chunk_dictionary_size, sum(map(len, contents)) // 10))
+        if dictionary is not None:
+            dictionary_frame = dataproc.zstd_compress_bytes(dictionary, compression_profile.params("delta_chunk", len(dictionary)))
+            with_dictionary = [dataproc.zstd_compress_bytes(x, compression_profile.params("delta_chunk", len(x)), dictionary) for x in contents]
+            if len(dictionary_frame) + sum(map(len, with_dictionary)) < sum(map(len, plain)):
+                compressed = with_dictionary
+            else:
+                dictionary = None
+        built = [None]
+        if dictionary is not None:
+            iohelper.write_file(dictfile, dictionary_frame)
+            built[0] = BuiltChunk(len(dictionary), hashlib.sha256(dictionary_frame).hexdigest())
+        for (chunkfile, *_), data, frame in zip(members, contents, compressed):
+            iohelper.write_file(chunkfile, frame)
+            built.append(BuiltChunk(len(data), hashlib.sha256(frame).hexdigest(), dictionary is not None))
+        return built
 
     # create delta chunks
+    delta_chunks = []
     for seq, delta_record in enumerate(delta_records, 1):
-        chunkfile = f'{chunk_temp_dir}/{format_chunkseq(seq)}-{delta_record.patch_base_version}.tar'
-        delta_chunks.append(chunkfile + '.zst')
-        futures.append(executor.submit(create_delta_chunk, chunkfile, delta_record))
+        chunkfile = f'{target_chunk_dir}/{format_chunkseq(seq)}-{delta_record.patch_base_version}.tar.zst'
+        chunk_manifest, pending_files, added_names = delta_chunk_contents(delta_record)
+        key = _chunk_key("delta", package_name, chunk_manifest, pending_files, entry_keys(added_names))
+        delta_chunks.append((delta_record.base_version, chunkfile, key, (chunk_manifest, pending_files, added_names)))
+
+    # small chunks share a dictionary, it is stored before them so a streaming consumer has it first
+    group = {}
+    if chunk_dictionary:
+        group = {x[2]: x for x in delta_chunks if estimated_size(*x[3][1:]) <= chunk_dictionary_member_limit}
+        if len(group) < chunk_dictionary_min_members:
+            group = {}
+    if group:
+        group_key = _chunk_key("dictionary", list(group))
+        if group_key not in shared_chunks or any(_chunk_key(group_key, key) not in shared_chunks for key in group):
+            dictfile = f'{target_chunk_dir}/{format_chunkseq(0)}-dictionary.zst'
+            members = [(chunkfile, *args) for _, chunkfile, _, args in group.values()]
+            # rendered chunks are held in memory with their compressed copies
+            memory = 3 * sum(estimated_size(*args[2:]) for args in members) + dataproc.zstd_stream_memory(compression_profile.params("delta_chunk", chunk_dictionary_member_limit))
+            group_future = executor.submit(memory, create_dictionary_chunks, dictfile, members)
+            futures.append(group_future)
+            shared_chunks[group_key] = (dictfile, _derived_future(group_future, operator.itemgetter(0)))
+            for i, (_, chunkfile, key, _) in enumerate(group.values(), 1):
+                shared_chunks[_chunk_key(group_key, key)] = (chunkfile, _derived_future(group_future, operator.itemgetter(i)))
+        build.chunks.append(("dictionary", *shared_chunks[group_key]))
+    for target, chunkfile, key, args in delta_chunks:
+        if key in group:
+            build.chunks.append((target, *shared_chunks[_chunk_key(group_key, key)]))
+        else:
+            params = compression_profile.params("delta_chunk", estimated_size(*args[1:]))
+            submit(target, chunkfile, key, dataproc.zstd_stream_memory(params), create_delta_chunk, params, *args)
+
+    @trace.traced("chunk frame", cpu=True)
+    def create_chunk_frame(framefile, params: CompressionParameters, names: list[str], extract: bool, eof: bool):
+        with iohelper.safe_output_fileobj(framefile, 'wb') as outfile:
+            hashed = iohelper.HashingWriter(outfile)
+            with dataproc.zstd_stream_writer(hashed, params) as zf:
+                tf = tarfile.open(fileobj=zf, mode='w', format=tarfile.PAX_FORMAT)
+                for filename in names:
+                    copy_from_pkg_to_tar(latest_pkg, filename, tf, concurrent_extract_file(latest_pkg, filename) if extract else None)
+                if eof:
+                    tf.close()
+                uncompressed_size = zf.tell()
+        return BuiltChunk(uncompressed_size, hashed.hexdigest())
+
+    def submit_frames(target: manifest.ChunkTarget, chunkfile: str, key: str, frames: list[list[str]], extract: bool, eof: bool):
+        if key not in shared_chunks:
+            print("creating", len(frames), "chunk frames", chunkfile, flush=True)
+            frame_futures = []
+            for i, names in enumerate(frames):
+                # frames run in parallel on the chunk workers instead of zstd threads
+                params = compression_profile.params("fallback_chunk", sum(latest_pkg.get_entry(x).size for x in names))
+                params = dataclasses.replace(params, nb_workers=0, job_size=0)
+                frame_eof = eof and i == len(frames) - 1
+                frame_futures.append(executor.submit(dataproc.zstd_stream_memory(params), create_chunk_frame, f'{chunkfile}.{i}', params, names, extract, frame_eof))
+            shared_chunks[key] = (chunkfile, _FrameJoiner(chunkfile, frames, frame_futures).future)
+            futures.append(shared_chunks[key][1])
+        build.chunks.append((target, *shared_chunks[key]))
 
     # create fallback patch chunk
-    patch_fallback_chunk = f'{chunk_temp_dir}/{format_chunkseq(chunk_count - 1)}-delta-fallback.tar'
-    compressed_patch_fallback_chunk = patch_fallback_chunk + '.zst'
-
-    def create_patch_fallback_chunk():
-        patched_files = sorted(set(x.path for x in patch_strategy))
-        print("creating patch fallback chunk", patch_fallback_chunk, flush=True)
-        with iohelper.safe_output_fileobj(patch_fallback_chunk, 'wb') as outfile:
-            tf = tarfile.open(fileobj=outfile, mode='w', format=tarfile.PAX_FORMAT)
-            for filename in patched_files:
-                cached_file = concurrent_extract_file(pkgs[latest], filename)
-                tf.add(cached_file, arcname=filename)
-            # don't close the tarfile to avoid writing EOF mark
-        dataproc.zstd_compress_file(patch_fallback_chunk, patch_fallback_chunk + '.zst')
-    futures.append(executor.submit(create_patch_fallback_chunk))
+    patched_files = sorted(set(x.path for x in patch_strategy))
 
-    # create unchanged files chunk
-    unchanged_chunk = f'{chunk_temp_dir}/{format_chunkseq(chunk_count)}-delta-unchanged.tar'
-    compressed_unchanged_chunk = unchanged_chunk + '.zst'
-    def create_unchanged_chunk():
-        print("creating unchanged chunk", unchanged_chunk, flush=True)
-        with iohelper.safe_output_fileobj(unchanged_chunk, 'wb') as outfile:
-            tf = tarfile.open(fileobj=outfile, mode='w', format=tarfile.PAX_FORMAT)
-            for filename in unchanged_names:
-                copy_from_pkg_to_tar(pkgs[latest], filename, tf)
-            # write EOF mark for the last chunk
-            tf.close()
-        dataproc.zstd_compress_file(unchanged_chunk, unchanged_chunk + '.zst')
-    futures.append(executor.submit(create_unchanged_chunk))
-
-    for future in futures:
-        # collect exceptions
-        future.result()
-    executor.shutdown(wait=True)
-
-
-    print("Creating delta package")
-
-    amal = AmalgamatedPatch(package_manifest, previous)
-
-    for i, delta_record in enumerate(delta_records):
-        chunkfile = delta_chunks[i]
-        target = delta_records[i].base_version
-        amal.add_chunk(target, chunkfile)
-    
-    amal.add_chunk("patch_fallback", compressed_patch_fallback_chunk)
-    amal.add_chunk("fallback", compressed_unchanged_chunk)
+    @trace.traced("patch fallback chunk", cpu=True)
+    def create_patch_fallback_chunk(chunkfile, params: CompressionParameters):
+        print("creating patch fallback chunk", chunkfile, flush=True)
+        with iohelper.safe_output_fileobj(chunkfile, 'wb') as outfile:
+            hashed = iohelper.HashingWriter(outfile)
+            with dataproc.zstd_stream_writer(hashed, params) as zf:
+                tf = tarfile.open(fileobj=zf, mode='w', format=tarfile.PAX_FORMAT)
+                for filename in patched_files:
+                    cached_file = concurrent_extract_file(latest_pkg, filename)
+                    copy_from_pkg_to_tar(latest_pkg, filename, tf, cached_file)
+                # don't close the tarfile to avoid writing EOF mark
+                uncompressed_size = zf.tell()
+        return BuiltChunk(uncompressed_size, hashed.hexdigest())
+    chunkfile = f'{target_chunk_dir}/{format_chunkseq(chunk_count - 1)}-delta-fallback.tar.zst'
+    key = _chunk_key("patch_fallback", entry_keys(patched_files))
+    frames = _plan_frames(latest_pkg, patched_files, chunk_frame_size)
+    if len(frames) > 1:
+        submit_frames("patch_fallback", chunkfile, key, frames, extract=True, eof=False)
+    else:
+        params = compression_profile.params("fallback_chunk", sum(latest_pkg.get_entry(x).size for x in patched_files))
+        submit("patch_fallback", chunkfile, key, dataproc.zstd_stream_memory(params), create_patch_fallback_chunk, params)
 
-    amal.build(os.path.join(outdir, f"{package_name}-{latest}{'-' + package_variant if package_variant else ''}-delta.tar.zst"))
+    # create unchanged files chunk
+    @trace.traced("unchanged chunk", cpu=True)
+    def create_unchanged_chunk(chunkfile, params: CompressionParameters):
+        print("creating unchanged chunk", chunkfile, flush=True)
+        with iohelper.safe_output_fileobj(chunkfile, 'wb') as outfile:
+            hashed = iohelper.HashingWriter(outfile)
+            with dataproc.zstd_stream_writer(hashed, params) as zf:
+                tf = tarfile.open(fileobj=zf, mode='w', format=tarfile.PAX_FORMAT)
+                for filename in unchanged_names:
+                    copy_from_pkg_to_tar(latest_pkg, filename, tf)
+                # write EOF mark for the last chunk
+                tf.close()
+                uncompressed_size = zf.tell()
+        return BuiltChunk(uncompressed_size, hashed.hexdigest())
+    chunkfile = f'{target_chunk_dir}/{format_chunkseq(chunk_count)}-delta-unchanged.tar.zst'
+    key = _chunk_key("fallback", entry_keys(unchanged_names))
+    frames = _plan_frames(latest_pkg, unchanged_names, chunk_frame_size)
+    if len(frames) > 1:
+        submit_frames("fallback", chunkfile, key, frames, extract=False, eof=True)
+    else:
+        params = compression_profile.params("fallback_chunk", sum(latest_pkg.get_entry(x).size for x in unchanged_names))
+        submit("fallback", chunkfile, key, dataproc.zstd_stream_memory(params), create_unchanged_chunk, params)
+
+    return futures
+
+def amalgamate_target(build: DeltaBuild, package_name: str):
+    package_manifest: manifest.PackageManifest = {
+        "name": package_name,
+        "version": build.latest,
+        "variant": build.variant,
+    }
+    amal = AmalgamatedPatch(package_manifest, build.previous)
+    # a dictionary chunk is None when compressing without it was smaller
+    built_chunks = [(target, chunkfile, future.result()) for target, chunkfile, future in build.chunks if future.result() is not None]
+    for target, chunkfile, built in built_chunks:
+        amal.add_chunk(target, chunkfile, built.sha256, built.dictionary, built.frames)
+
+    delta_package_file = os.path.join(outdir, f"{package_name}-{build.latest}{'-' + build.variant if build.variant else ''}-delta.tar.zst")
+    amal.build(delta_package_file)
+
+    target_metrics = build.metrics
+    for (chunk_schema, chunkfile), (_, _, built) in zip(amal.chunks, built_chunks):
+        uncompressed_size = built.uncompressed_size
+        target_metrics.add_chunk(os.path.basename(chunkfile), chunk_schema["target"], chunk_schema["size"], uncompressed_size)
+        target_metrics.add_io("chunk", read=uncompressed_size, written=chunk_schema["size"])
+    target_metrics.add_io("amalgamate", read=amal.offset, written=os.path.getsize(delta_package_file))
+    target_metrics.download_sizes = {version: amal.download_size(version) for version in build.previous}
+    # counters and I/O of shared work cover the whole run
+    target_metrics.merge(build_metrics)
+    target_metrics.save(os.path.join(outdir, f'delta_report{build.report_suffix}.json'))
+    build.report_file.close()
+
+def build_deltas(package_provider: pkgprov.PackageProvider, package_name: str, package_variants: list[str | None], targets: list[DeltaTarget],
+                 session: BuildSession | None = None):
+    """Builds a delta package for each target and variant.
+
+    Packages, extracted files, hashes, diff sizes, patches and chunks are shared between targets,
+    entries with the same content are also shared between variants.
+    Patch and chunk jobs of all targets run in the same worker pools.
+    Extracted files are released at the end unless the build is part of `session`.
+    """
+    global entry_hash_index, patch_store, build_metrics
+    latest_versions = [x.versions[0] for x in targets]
+    if len(set(latest_versions)) != len(latest_versions):
+        raise ValueError(f"duplicate target versions: {latest_versions}")
+    if len(set(package_variants)) != len(package_variants):
+        raise ValueError(f"duplicate variants: {package_variants}")
+    build_metrics = metrics.BuildMetrics()
+    patch_cache = blob_cache = None
+    try:
+        extract_stats_before = extracted_files.stats.copy()
+        pkgs_by_variant = {
+            variant: { x: package_provider.open_package(package_name, x, variant) for target in targets for x in target.versions }
+            for variant in package_variants
+        }
+        all_pkgs = [pkg for pkgs in pkgs_by_variant.values() for pkg in pkgs.values()]
+        # load entry lists in the background, first use of a package only waits for its own
+        loader = concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(all_pkgs)), thread_name_prefix='package_loader')
+        for pkg in all_pkgs:
+            loader.submit(pkg.get_entries)
+        loader.shutdown(wait=False)
+        entry_hash_index = HashIndex(entry_hash_db)
+
+        builds: list[DeltaBuild] = []
+        for variant, pkgs in pkgs_by_variant.items():
+            if session is not None and variant in session.diff_sizes:
+                diff_sizes = session.diff_sizes[variant]
+                diff_sizes.set_packages(pkgs)
+            else:
+                diff_sizes = diff_matrix.DiffSizeMatrix(pkgs, diff_size_db)
+            for target in targets:
+                # a single target of a single variant keeps the plain report names
+                suffix_parts = [target.versions[0] if len(targets) > 1 else None, variant if len(package_variants) > 1 else None]
+                report_suffix = ''.join(f'-{x}' for x in suffix_parts if x)
+                builds.append(plan_target(pkgs, variant, target, diff_sizes, report_suffix))
+            if session is not None:
+                diff_sizes.flush()
+                session.diff_sizes[variant] = diff_sizes
+            else:
+                diff_sizes.close()
+
+        # zstd patch sizes depend on the profile, keep them apart so a preview run doesn't skew release patch choices,
+        # blobs of all profiles share one directory and are tracked in the release database to share one budget
+        patch_cache = PatchCache(patch_cache_dir + '.db')
+        blob_cache = patch_cache
+        if compression_profile.name != "release":
+            patch_cache = PatchCache(patch_cache_dir + f'-{compression_profile.name}.db')
+        patch_store = PatchBlobStore(patch_cache_dir, blob_cache, patch_store_budget)
+
+        for build, patch_strategy in zip(builds, find_best_patch(patch_cache, builds)):
+            build.patch_strategy = patch_strategy
+            report_patch_strategy(build)
+
+        executor = MemoryBudgetExecutor(os.cpu_count(), job_memory_budget, 'chunk_worker')
+        shared_chunks = session.reusable_chunks() if session is not None else {}
+        reusable = set(shared_chunks)
+        futures = [future for build in builds for future in submit_chunks(executor, package_name, build, shared_chunks)]
+        for future in futures:
+            # collect exceptions
+            future.result()
+        executor.shutdown(wait=True)
+        references = [id(future) for x in builds for _, _, future in x.chunks]
+        build_metrics.count("chunk.shared", len(references) - len(set(references)))
+        build_metrics.count("chunk.reused", len({id(shared_chunks[x][1]) for x in reusable} & set(references)))
+        if session is not None:
+            session.add_chunks(shared_chunks)
+
+        freed = patch_store.evict()
+        if freed:
+            print(f"Evicted {iohelper.format_size(freed)} from patch store")
+
+        extract_stats = extracted_files.stats - extract_stats_before
+        build_metrics.counters.update({f"extract.{k}": v for k, v in extract_stats.items() if not k.endswith("_bytes")})
+        build_metrics.add_io("extract", read=extract_stats["read_bytes"], written=extract_stats["written_bytes"])
+
+        for build in builds:
+            print(f"Creating delta package {build.latest}{' ' + build.variant if build.variant else ''}")
+            amalgamate_target(build, package_name)
+    finally:
+        patch_store = None
+        # closing twice is harmless when the release database is both
+        if patch_cache is not None:
+            patch_cache.close()
+        if blob_cache is not None:
+            blob_cache.close()
+        # commits buffered hashes, also of failed builds
+        if entry_hash_index is not None:
+            entry_hash_index.close()
+            entry_hash_index = None
+        # memory files and paths derived from them are only valid within a build or session
+        if session is None:
+            release_extracted_files()
 
     
 
@@ -2,7 +2,16 @@ from typing import TypedDict, Literal, NotRequired
 
 PatchType = Literal["zstd", "bsdiff", "copy"]
 
-ChunkTarget = list[str] | Literal["patch_fallback", "fallback"]
+ChunkTarget = list[str] | Literal["patch_fallback", "fallback", "dictionary"]
+
+class ChunkFrame(TypedDict):
+    offset: int
+    """The offset of the compressed frame, relative to the start of the chunk"""
+    size: int
+    """The size of the compressed frame"""
+    hash: str
+    files: list[str]
+    """The tar members in this frame, in order"""
 
 class Chunk(TypedDict):
     target: ChunkTarget
@@ -11,12 +20,20 @@ class Chunk(TypedDict):
     * If target is a sequence of strings, this chunk can be applied to any of the versions in the list.
     * If target is "patch_fallback", this chunk contains complete files as fallback for binary patching.
     * If target is "fallback", this chunk contains all extra files to make a complete package.
+    * If target is "dictionary", this chunk is the zstd dictionary of the package, see `DeltaPackageManifest.dictionary`.
     """
     offset: int
     """The offset of the compressed chunk in the package file, relative to the offset of manifest chunk"""
     size: int
     """The size of the compressed chunk"""
     hash: str
+    dictionary: NotRequired[bool]
+    """If true, this chunk is compressed with the dictionary of the package and can't be decompressed without it"""
+    frames: NotRequired[list[ChunkFrame]]
+    """If present, this chunk is a sequence of independent zstd frames, split at tar member boundaries.
+
+    Concatenated frames decompress to the same tar stream as a single frame would.
+    Consumer MAY fetch and decompress only the frames holding the files it needs."""
 
 class PackageManifest(TypedDict):
     """The package manifest
@@ -71,6 +88,10 @@ class DeltaPackageManifest(TypedDict):
     Consumer SHOULD stop processing the rest of the delta package if the current version is not in this list.
     If the package is streamed from a remote machine, consumer MAY stop receiving more data from remote."""
     chunks: list[Chunk]
+    dictionary: NotRequired[int]
+    """The index in `chunks` of the chunk holding the zstd dictionary, compressed as a regular zstd frame.
+
+    It is stored before the chunks that use it. Consumer MUST load it before decompressing a chunk with `dictionary` set."""
 
 class PatchFile(TypedDict):
     file: str
@@ -0,0 +1,71 @@
+import collections
+import json
+import os
+import threading
+
+def _ratio(hits: int, total: int) -> float | None:
+    return hits / total if total else None
+
+class BuildMetrics:
+    """Sizes, cache statistics and I/O volume of a build, saved as JSON next to delta_report.txt"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.io = collections.defaultdict(collections.Counter)
+        self.chunks = []
+        self.patch_candidates = collections.defaultdict(list)
+        self.chosen_patches = {}
+        self.download_sizes = {}
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += n
+
+    def add_io(self, stage: str, read: int = 0, written: int = 0):
+        with self._lock:
+            self.io[stage]["read"] += read
+            self.io[stage]["written"] += written
+
+    def add_chunk(self, name: str, target, compressed_size: int, uncompressed_size: int):
+        with self._lock:
+            self.chunks.append({"name": name, "target": target, "compressed_size": compressed_size, "uncompressed_size": uncompressed_size})
+
+    def add_patch_candidate(self, path: str, from_version: str, to_version: str, patch_type: str, size: int, cached: bool):
+        with self._lock:
+            self.patch_candidates[(path, from_version)].append({"to_version": to_version, "type": patch_type, "size": size, "cached": cached})
+
+    def merge(self, other: "BuildMetrics"):
+        """Adds counters and I/O of other, e.g. run-wide totals to the metrics of one target"""
+        with other._lock:
+            counters = other.counters.copy()
+            io = {stage: x.copy() for stage, x in other.io.items()}
+        with self._lock:
+            self.counters.update(counters)
+            for stage, x in io.items():
+                self.io[stage].update(x)
+
+    def hit_rates(self) -> dict[str, float | None]:
+        c = self.counters
+        return {
+            "patch_cache": _ratio(c["patch_cache.hit"], c["patch_cache.hit"] + c["patch_cache.miss"]),
+            "entry_hash_index": _ratio(c["entry_hash.hit"], c["entry_hash.hit"] + c["entry_hash.miss"]),
+            "extraction": _ratio(c["extract.requests"] - c["extract.memory"] - c["extract.disk"], c["extract.requests"]),
+        }
+
+    def to_json(self) -> dict:
+        with self._lock:
+            return {
+                "chunks": self.chunks,
+                "patches": [
+                    {"file": path, "from_version": from_version, "chosen": self.chosen_patches.get((path, from_version)), "candidates": candidates}
+                    for (path, from_version), candidates in self.patch_candidates.items()
+                ],
+                "counters": dict(self.counters),
+                "hit_rates": self.hit_rates(),
+                "io": {stage: dict(x) for stage, x in self.io.items()},
+                "download_sizes": self.download_sizes,
+            }
+
+    def save(self, path: os.PathLike):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(), f, indent=1)
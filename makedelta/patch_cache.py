@@ -1,5 +1,17 @@
+import itertools
 import sqlite3
+import threading
 import time
+import typing
+
+create_blob_table_sql = """
+CREATE TABLE IF NOT EXISTS "patch_blob" (
+	"blob_key" TEXT PRIMARY KEY,
+	"size" INTEGER,
+	"last_access" INTEGER
+);
+CREATE INDEX IF NOT EXISTS "blob_access" ON "patch_blob" ("last_access");
+"""
 
 create_table_sql = """
 CREATE TABLE "patch_cache" (
@@ -9,36 +21,127 @@ CREATE TABLE "patch_cache" (
 	"patch_size" INTEGER,
     "timestamp" INTEGER
 );
-CREATE INDEX "cache_index" ON "patch_cache" (
+"""
+
+# older databases may hold duplicate keys, keep the latest row before adding the unique key
+create_unique_key_sql = """
+DROP INDEX IF EXISTS "cache_index";
+DELETE FROM "patch_cache" WHERE rowid NOT IN (
+	SELECT MAX(rowid) FROM "patch_cache" GROUP BY "from_sha256", "to_sha256", "patch_type"
+);
+CREATE UNIQUE INDEX "cache_key" ON "patch_cache" (
 	"from_sha256",
 	"to_sha256",
 	"patch_type"
 );
 """
 
+upsert_sql = """
+INSERT INTO patch_cache VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (from_sha256, to_sha256, patch_type) DO UPDATE SET patch_size = excluded.patch_size, timestamp = excluded.timestamp;
+"""
+
+# stay below SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds
+_QUERY_BATCH = 300
+
+PatchKey = tuple[str, str, str]
+
 class PatchCache:
+    """Estimated patch sizes keyed by (from_sha256, to_sha256, patch_type),
+    and size and last access time of stored patch blobs.
+
+    Safe to use from multiple threads, each thread gets its own connection.
+    """
     def __init__(self, db_path):
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path)
-        cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='patch_cache';")
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        conn = self.conn
+        conn.execute("PRAGMA journal_mode=WAL;")
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='patch_cache';")
         table_exists = cursor.fetchone()
         if not table_exists:
-            with self.conn:
-                self.conn.executescript(create_table_sql)
+            with conn:
+                conn.executescript(create_table_sql)
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name='cache_key';")
+        if not cursor.fetchone():
+            with conn:
+                conn.executescript(create_unique_key_sql)
+        with conn:
+            conn.executescript(create_blob_table_sql)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
 
     def add_patch(self, from_sha256: str, to_sha256: str, patch_type: str, patch_size: int, timestamp: int | None = None):
+        self.add_many([(from_sha256, to_sha256, patch_type, patch_size)], timestamp)
+
+    def add_many(self, patches: typing.Iterable[tuple[str, str, str, int]], timestamp: int | None = None):
+        """Records (from_sha256, to_sha256, patch_type, patch_size) tuples in one transaction"""
         if timestamp is None:
             timestamp = int(time.time())
-        with self.conn:
-            self.conn.execute("INSERT INTO patch_cache VALUES (?, ?, ?, ?, ?)", (from_sha256, to_sha256, patch_type, patch_size, timestamp))
+        conn = self.conn
+        with conn:
+            conn.executemany(upsert_sql, ((*x, timestamp) for x in patches))
 
     def query(self, from_sha256: str, to_sha256: str, patch_type: str) -> int | None:
-        cursor = self.conn.execute("SELECT patch_size FROM patch_cache WHERE from_sha256 = ? AND to_sha256 = ? AND patch_type = ?;", (from_sha256, to_sha256, patch_type))
-        result = cursor.fetchone()
-        if result is None:
-            return None
-        return result[0]
+        return self.query_many([(from_sha256, to_sha256, patch_type)]).get((from_sha256, to_sha256, patch_type))
 
-    def close(self):
-        self.conn.close()
+    def query_many(self, keys: typing.Iterable[PatchKey], min_timestamp: int | None = None) -> dict[PatchKey, int]:
+        """Returns the known sizes among (from_sha256, to_sha256, patch_type) keys, recorded at or after min_timestamp if given"""
+        result = {}
+        conn = self.conn
+        keys = list(dict.fromkeys(keys))
+        for start in range(0, len(keys), _QUERY_BATCH):
+            batch = keys[start:start + _QUERY_BATCH]
+            values = ', '.join(['(?, ?, ?)'] * len(batch))
+            cursor = conn.execute(f"SELECT from_sha256, to_sha256, patch_type, patch_size FROM patch_cache WHERE (from_sha256, to_sha256, patch_type) IN (VALUES {values}) AND timestamp >= ?;",
+                                  [*itertools.chain.from_iterable(batch), min_timestamp or 0])
+            for from_sha256, to_sha256, patch_type, patch_size in cursor:
+                result[(from_sha256, to_sha256, patch_type)] = patch_size
+        return result
+
+    def touch_blob(self, blob_key: str, size: int, timestamp: int | None = None):
+        if timestamp is None:
+            timestamp = int(time.time())
+        self.touch_blobs([(blob_key, size, timestamp)])
 
+    def touch_blobs(self, blobs: typing.Iterable[tuple[str, int, int]]):
+        """Records (blob_key, size, last_access) tuples in one transaction"""
+        conn = self.conn
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO patch_blob VALUES (?, ?, ?)", blobs)
+
+    def blob_keys(self) -> set[str]:
+        return {x for x, in self.conn.execute("SELECT blob_key FROM patch_blob;")}
+
+    def blobs_over_budget(self, budget: int) -> list[tuple[str, int]]:
+        """Returns least recently used (blob_key, size) that need to go for the rest to fit in budget"""
+        cursor = self.conn.execute("SELECT blob_key, size FROM patch_blob ORDER BY last_access DESC, rowid DESC;")
+        total = 0
+        result = []
+        for blob_key, size in cursor:
+            total += size
+            if total > budget:
+                result.append((blob_key, size))
+        return result
+
+    def remove_blobs(self, blob_keys: typing.Iterable[str]):
+        conn = self.conn
+        with conn:
+            conn.executemany("DELETE FROM patch_blob WHERE blob_key = ?", ((x,) for x in blob_keys))
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
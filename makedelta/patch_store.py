@@ -0,0 +1,79 @@
+import collections
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+
+from .patch_cache import PatchCache
+
+_blob_dir = re.compile('[0-9a-f]{2}')
+# written once the store directory only holds tracked blobs
+_LAYOUT_MARKER = '.tracked'
+
+class PatchBlobStore:
+    """Patch files addressed by (old sha256, new sha256, patch type, parameters).
+
+    Blobs are tracked in `PatchCache` with their last access time. `evict()` removes least
+    recently used blobs until the store fits in `budget` bytes. All builds sharing `root` must
+    track blobs in the same `PatchCache`, or blobs of the others are never evicted.
+    """
+    def __init__(self, root: os.PathLike, cache: PatchCache, budget: int):
+        self.root = pathlib.Path(root)
+        self.cache = cache
+        self.budget = budget
+        if self.root.is_dir() and not (self.root / _LAYOUT_MARKER).exists():
+            self._track_all()
+
+    def _track_all(self):
+        """One-time cleanup of a store written by older versions.
+
+        Patches of the per-version layout (`<from_version>/<name>-<crc>...`) are removed, blobs
+        tracked in other databases (e.g. one per compression profile) are tracked here.
+        """
+        tracked = self.cache.blob_keys()
+        untracked: dict[str, list[int]] = collections.defaultdict(lambda: [0, 0])
+        for entry in os.scandir(self.root):
+            if not entry.is_dir():
+                continue
+            if not _blob_dir.fullmatch(entry.name):
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            for file in os.scandir(entry.path):
+                key = file.name[:64]
+                if key not in tracked:
+                    st = file.stat()
+                    untracked[key][0] += st.st_size
+                    untracked[key][1] = max(untracked[key][1], int(st.st_mtime))
+        self.cache.touch_blobs((key, size, mtime) for key, (size, mtime) in untracked.items())
+        (self.root / _LAYOUT_MARKER).touch()
+
+    @staticmethod
+    def blob_key(old_sha256: str, new_sha256: str, patch_type: str, params: str) -> str:
+        return hashlib.sha256(f"{old_sha256}:{new_sha256}:{patch_type}:{params}".encode()).hexdigest()
+
+    def path(self, key: str, extname: str) -> str:
+        return str(self.root / key[:2] / key) + extname
+
+    def _blob_files(self, key: str) -> list[pathlib.Path]:
+        # a blob may have companion files sharing its name as prefix (e.g. nested compression)
+        return list((self.root / key[:2]).glob(key + '*'))
+
+    def touch(self, key: str):
+        """Records an access to the blob and its current size on disk"""
+        size = 0
+        for file in self._blob_files(key):
+            size += file.stat().st_size
+        self.cache.touch_blob(key, size)
+
+    def evict(self) -> int:
+        """Removes least recently used blobs over budget, returns freed bytes"""
+        freed = 0
+        keys = []
+        for key, size in self.cache.blobs_over_budget(self.budget):
+            for file in self._blob_files(key):
+                file.unlink(missing_ok=True)
+            keys.append(key)
+            freed += size
+        self.cache.remove_blobs(keys)
+        return freed
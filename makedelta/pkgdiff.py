@@ -1,7 +1,9 @@
 import sys
 import dataclasses
+import threading
 
 from . import pkgprov
+from . import concurrent_cache
 
 @dataclasses.dataclass
 class PackageDiff:
@@ -13,24 +15,83 @@ class PackageDiff:
     def __len__(self):
         return len(self.a_only) + len(self.b_only) + len(self.ab_diff)
 
-def package_diff(a: pkgprov.Package, b: pkgprov.Package) -> PackageDiff:
-    old_entries = set(a.get_entries())
-    new_entries = set(b.get_entries())
 
-    a_names = set(x.name for x in old_entries)
-    b_names = set(x.name for x in new_entries)
+class _Interner:
+    """Maps hashable values to dense integer IDs shared by all entry tables"""
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        self.lock = threading.Lock()
+
+    def intern(self, value) -> int:
+        id_ = self.ids.get(value)
+        if id_ is None:
+            with self.lock:
+                id_ = self.ids.setdefault(value, len(self.values))
+                if id_ == len(self.values):
+                    self.values.append(value)
+        return id_
+
+    def lookup(self, ids) -> set:
+        return set(map(self.values.__getitem__, ids))
+
+_names = _Interner()
+_checksums = _Interner()
+
+# row key layout: name ID | checksum ID (32 bits) | size (64 bits)
+_NAME_SHIFT = 96
+
+class EntryTable:
+    """Interned view of a package's entries.
+
+    Rows follow `get_entries()` order. Each row is packed into a single integer key that
+    compares equal exactly when the `PackageEntry` values do, so set algebra between tables
+    runs over integers instead of hashing entries.
+    """
+    __slots__ = ('entries', 'names', 'keys', 'row_of_key')
 
-    unchanged_entries = old_entries & new_entries
-    unchanged_names = set(x.name for x in unchanged_entries)
+    def __init__(self, entries: list[pkgprov.PackageEntry]):
+        self.entries = entries
+        name_ids = [_names.intern(x.name) for x in entries]
+        keys = [(n << 32 | _checksums.intern((x.checksum_type, x.checksum))) << 64 | x.size for n, x in zip(name_ids, entries)]
+        self.names = frozenset(name_ids)
+        self.keys = frozenset(keys)
+        self.row_of_key = dict(zip(keys, range(len(keys))))
 
-    # maybe changed or unchanged
-    common_names = a_names & b_names
+    def entries_not_in(self, other: 'EntryTable') -> list[pkgprov.PackageEntry]:
+        """Entries of this table without an equal entry in other, in table order"""
+        rows = sorted(self.row_of_key[k] for k in self.keys - other.keys)
+        return [self.entries[i] for i in rows]
 
-    only_a = a_names - common_names
-    only_b = b_names - common_names
-    changed_names = common_names - unchanged_names
+    def names_not_in(self, other: 'EntryTable') -> set[str]:
+        return _names.lookup(self.names - other.names)
+
+    def name_set(self) -> set[str]:
+        return _names.lookup(self.names)
+
+@concurrent_cache.once_cache
+def entry_table(pkg: pkgprov.Package) -> EntryTable:
+    return EntryTable(pkg.get_entries())
+
+def _diff_ids(a: EntryTable, b: EntryTable):
+    # only entries missing from the other side are visited in Python
+    only_a = a.names - b.names
+    only_b = b.names - a.names
+    changed = {k >> _NAME_SHIFT for k in a.keys - b.keys}
+    changed -= only_a
+    return only_a, only_b, changed
+
+def table_diff(a: EntryTable, b: EntryTable) -> PackageDiff:
+    only_a, only_b, changed = _diff_ids(a, b)
+    unchanged = (a.names & b.names) - changed
+    return PackageDiff(_names.lookup(only_a), _names.lookup(only_b), _names.lookup(changed), _names.lookup(unchanged))
+
+def package_diff(a: pkgprov.Package, b: pkgprov.Package) -> PackageDiff:
+    return table_diff(entry_table(a), entry_table(b))
 
-    return PackageDiff(only_a, only_b, changed_names, unchanged_names)
+def package_diff_size(a: pkgprov.Package, b: pkgprov.Package) -> int:
+    """`len(package_diff(a, b))` without materializing the name sets"""
+    return sum(map(len, _diff_ids(entry_table(a), entry_table(b))))
 
 def main():
     if len(sys.argv) != 3:
@@ -4,6 +4,9 @@ import zipfile
 import os
 import calendar
 import struct
+import threading
+
+from . import trace
 
 class PackageProvider(Protocol):
     def open_package(self, package_name: str, version: str, variant: Optional[str]) -> 'Package':
@@ -30,16 +33,37 @@ class PackageEntry:
     mode: int = dataclasses.field(compare=False)
 
 class ZipPackage:
-    def __init__(self, zipf: os.PathLike | zipfile.ZipFile, name, version, variant):
+    """Package backed by a zip file.
+
+    The central directory is only parsed on first use. With `index`, parsed entry lists are
+    reused across runs and the zip is only opened to read entry content.
+    """
+    def __init__(self, zipf: os.PathLike | zipfile.ZipFile, name, version, variant, index=None):
         if isinstance(zipf, zipfile.ZipFile):
-            self.zipf = zipf
+            self._zipf = zipf
+            self.path = zipf.filename
         else:
-            self.zipf = zipfile.ZipFile(zipf, "r", metadata_encoding="utf-8")
+            self._zipf = None
+            self.path = zipf
         self.name = name
         self.version = version
         self.variant = variant
-        self.entries = []
-        self.entries_map = {}
+        self.index = index
+        self._entries = None
+        self._entries_map = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @property
+    def zipf(self) -> zipfile.ZipFile:
+        if self._zipf is None:
+            with self._lock:
+                if self._zipf is None:
+                    self._zipf = zipfile.ZipFile(self.path, "r", metadata_encoding="utf-8")
+        return self._zipf
+
+    def _read_entries(self):
+        entries = []
         for x in self.zipf.infolist():
             if x.is_dir():
                 continue
@@ -47,9 +71,39 @@ class ZipPackage:
             if mode == 0:
                 mode = 0o100644
             mtime = calendar.timegm(x.date_time)
-            entry = PackageEntry(x.filename, x.file_size, "crc32", struct.pack('>I', x.CRC), mtime, mode)
-            self.entries.append(entry)
-            self.entries_map[x.filename] = entry
+            entries.append(PackageEntry(x.filename, x.file_size, "crc32", struct.pack('>I', x.CRC), mtime, mode))
+        return entries
+
+    def _load_entries(self):
+        with self._load_lock:
+            if self._entries is None:
+                self._read_or_query_entries()
+
+    def _read_or_query_entries(self):
+        with trace.span("open package", version=self.version) as span_args:
+            entries = None
+            if self.index is not None and self.path is not None:
+                entries = self.index.query(self.path)
+            span_args["indexed"] = entries is not None
+            if entries is None:
+                entries = self._read_entries()
+                if self.index is not None and self.path is not None:
+                    self.index.add(self.path, entries)
+        self._entries_map = { x.name: x for x in entries }
+        self._entries = entries
+
+    @property
+    def entries(self) -> list['PackageEntry']:
+        if self._entries is None:
+            self._load_entries()
+        return self._entries
+
+    @property
+    def entries_map(self) -> dict[str, 'PackageEntry']:
+        if self._entries is None:
+            self._load_entries()
+        return self._entries_map
+
     def get_entry(self, name):
         return self.entries_map[name]
     def get_entries(self):
@@ -58,3 +112,28 @@ class ZipPackage:
         if isinstance(entry, PackageEntry):
             entry = entry.name
         return self.zipf.open(entry)
+
+class ZipDirectoryProvider:
+    """Provides zip packages from files named by `pattern`, formatted with package name, version and variant"""
+    def __init__(self, pattern: str, index=None):
+        self.pattern = pattern
+        self.index = index
+    def open_package(self, package_name: str, version: str, variant: Optional[str]):
+        filename = self.pattern.format(name=package_name, version=version, variant=variant)
+        return ZipPackage(filename, package_name, version, variant, self.index)
+
+class CachedPackageProvider:
+    """Returns the same package object for repeated opens, so entry lists and caches keyed by
+    package stay warm across builds in one process"""
+    def __init__(self, provider: PackageProvider):
+        self.provider = provider
+        self.packages: dict[tuple[str, str, Optional[str]], Package] = {}
+    def open_package(self, package_name: str, version: str, variant: Optional[str]):
+        key = (package_name, version, variant)
+        pkg = self.packages.get(key)
+        if pkg is None:
+            pkg = self.packages[key] = self.provider.open_package(package_name, version, variant)
+        return pkg
+    def discard(self, package_name: str, version: str, variant: Optional[str]):
+        """Forgets a package whose content changed, the next open gets a new package object"""
+        self.packages.pop((package_name, version, variant), None)
@@ -1,9 +1,29 @@
 from typing import Optional
 from . import pkgprov
+from . import concurrent_cache
+from .zip_index import ZipIndex
+
+zip_index_db = 'cache/zip_index.db'
+# any variant with a zip here can be built, e.g. win-x64, win-arm64, linux-x64
+package_pattern = 'testdata/{name}-{version}-{variant}.zip'
+
+_zip_index: ZipIndex | None = None
+
+@concurrent_cache.once_cache
+def _provider():
+    global _zip_index
+    _zip_index = ZipIndex(zip_index_db)
+    return pkgprov.ZipDirectoryProvider(package_pattern, _zip_index)
+
+def close():
+    """Closes the zip index, packages opened before must have loaded their entries"""
+    global _zip_index
+    _provider.cache_clear()
+    if _zip_index is not None:
+        _zip_index.close()
+        _zip_index = None
 
 def open_package(package_name: str, version: str, variant: Optional[str]):
     assert package_name == 'MAA'
-    assert variant == 'win-x64'
-    filename = f"testdata/MAA-{version}-win-x64.zip"
-    return pkgprov.ZipPackage(filename, package_name, version, variant)
-
+    assert variant is not None
+    return _provider().open_package(package_name, version, variant)
@@ -0,0 +1,126 @@
+import bisect
+import concurrent.futures
+import itertools
+import os
+import threading
+
+def default_memory_budget() -> int:
+    """Three quarters of physical memory, or 8 GiB where it can't be queried"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 3 // 4
+    except (AttributeError, ValueError, OSError):
+        return 8 * 1024 * 1048576
+
+
+class MemoryBudgetExecutor:
+    """Thread pool that admits jobs against a memory budget.
+
+    Each job is submitted with an estimate of its peak memory. Pending jobs are started
+    largest first, and only while the estimates of running jobs fit in `memory_budget`.
+    When the largest pending job doesn't fit, the largest one that fits starts instead, at most
+    `max_overtakes` times, after that the budget is held for the largest job until it fits.
+    A job larger than the whole budget runs alone.
+    """
+    def __init__(self, max_workers: int | None = None, memory_budget: int | None = None, name: str = "MemoryBudgetExecutor", max_overtakes: int = 16):
+        self.name = name
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.memory_budget = memory_budget if memory_budget is not None else default_memory_budget()
+        self.max_overtakes = max_overtakes
+        self.memory_in_use = 0
+        self.running = 0
+        # sorted largest first, sequence keeps submission order among equal sizes
+        self._queue = []
+        # sequence of the blocked largest job and how many jobs started before it
+        self._overtaken = (None, 0)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = []
+
+    def submit(self, memory: int, fn, /, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new jobs after shutdown")
+            bisect.insort(self._queue, (-memory, next(self._seq), future, fn, args, kwargs))
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker, name=f"{self.name}_{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return future
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def status(self) -> str:
+        with self._cond:
+            return f"running {self.running} ({self.memory_in_use / 1073741824:.1f}/{self.memory_budget / 1073741824:.1f} GiB), queued {len(self._queue)}"
+
+    def _admissible(self) -> int | None:
+        """Index of the pending job to start now, None if none can start"""
+        head_memory, head_seq = -self._queue[0][0], self._queue[0][1]
+        if self.running == 0 or self.memory_in_use + head_memory <= self.memory_budget:
+            return 0
+        seq, overtaken = self._overtaken
+        if seq != head_seq:
+            overtaken = 0
+        if overtaken >= self.max_overtakes:
+            return None
+        # first (largest) job that fits in the rest of the budget
+        index = bisect.bisect_left(self._queue, (self.memory_in_use - self.memory_budget,))
+        if index == len(self._queue):
+            return None
+        self._overtaken = (head_seq, overtaken + 1)
+        return index
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    if (index := self._admissible()) is not None:
+                        negative_memory, _, future, fn, args, kwargs = self._queue.pop(index)
+                        memory = -negative_memory
+                        self.memory_in_use += memory
+                        self.running += 1
+                        return memory, future, fn, args, kwargs
+                elif self._shutdown:
+                    return None
+                self._cond.wait()
+
+    def _worker(self):
+        while (job := self._next_job()) is not None:
+            memory, future, fn, args, kwargs = job
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args, **kwargs)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._cond:
+                    self.memory_in_use -= memory
+                    self.running -= 1
+                    self._cond.notify_all()
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        with self._cond:
+            self._shutdown = True
+            if cancel_futures:
+                for _, _, future, _, _, _ in self._queue:
+                    future.cancel()
+                self._queue.clear()
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
+        return False
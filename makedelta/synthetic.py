@@ -0,0 +1,119 @@
+import dataclasses
+import os
+import random
+import zipfile
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class SyntheticSpec:
+    """Shape of a synthetic package version series"""
+    file_count: int = 500
+    """Files in the first version"""
+    binary_ratio: float = 0.2
+    """Share of files that get binary patches (.dll/.exe), the rest are replaced when changed"""
+    mean_size: int = 65536
+    versions: int = 8
+    """Mainline versions, excluding branches"""
+    mutation_rate: float = 0.3
+    """Chance of each file changing in a version"""
+    mutation_span: float = 0.01
+    """Share of a mutated binary file that is rewritten"""
+    add_rate: float = 0.01
+    remove_rate: float = 0.005
+    rename_rate: float = 0.005
+    branch_every: int = 3
+    """A non-linear hotfix version is branched off every n mainline versions, 0 for none"""
+    seed: int = 1
+
+
+@dataclasses.dataclass(slots=True)
+class SyntheticSeries:
+    versions: list[str]
+    """Newest mainline version first, as in version_list_all.txt"""
+    nonlinear_versions: list[str]
+    pattern: str
+    """Zip file name pattern for pkgprov.ZipDirectoryProvider"""
+
+
+class _Generator:
+    def __init__(self, spec: SyntheticSpec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.serial = 0
+
+    def new_name(self) -> str:
+        self.serial += 1
+        directory = f"dir{self.rng.randrange(max(self.spec.file_count // 50, 1))}"
+        if self.rng.random() < self.spec.binary_ratio:
+            return f"{directory}/lib{self.serial}.{self.rng.choice(('dll', 'exe'))}"
+        return f"{directory}/res{self.serial}.{self.rng.choice(('json', 'png', 'txt'))}"
+
+    def new_content(self) -> bytes:
+        size = max(int(self.rng.expovariate(1 / self.spec.mean_size)), 1)
+        return self.rng.randbytes(size)
+
+    def mutate(self, name: str, content: bytes) -> bytes:
+        if not (name.endswith('.dll') or name.endswith('.exe')):
+            return self.new_content()
+        data = bytearray(content)
+        remaining = max(int(len(data) * self.spec.mutation_span), 1)
+        while remaining > 0:
+            length = min(self.rng.randint(1, 256), remaining)
+            pos = self.rng.randrange(len(data) + 1)
+            if self.rng.random() < 0.5:
+                data[pos:pos + length] = self.rng.randbytes(length)
+            else:
+                data[pos:pos] = self.rng.randbytes(length)
+            remaining -= length
+        return bytes(data)
+
+    def evolve(self, files: dict[str, bytes], scale: float = 1.0) -> dict[str, bytes]:
+        spec = self.spec
+        result = {}
+        for name, content in files.items():
+            r = self.rng.random()
+            if r < spec.remove_rate * scale:
+                continue
+            if r < (spec.remove_rate + spec.rename_rate) * scale:
+                result[self.new_name()] = content
+            elif self.rng.random() < spec.mutation_rate * scale:
+                result[name] = self.mutate(name, content)
+            else:
+                result[name] = content
+        for _ in range(int(len(files) * spec.add_rate * scale + self.rng.random())):
+            result[self.new_name()] = self.new_content()
+        return result
+
+
+def _write_zip(filename: str, files: dict[str, bytes]):
+    tmpfile = filename + '.tmp'
+    with zipfile.ZipFile(tmpfile, 'w', zipfile.ZIP_STORED) as zf:
+        for name in sorted(files):
+            # fixed timestamps keep the output byte-identical between runs
+            zf.writestr(zipfile.ZipInfo(name, (2020, 1, 1, 0, 0, 0)), files[name])
+    os.replace(tmpfile, filename)
+
+def generate_series(spec: SyntheticSpec, outdir: os.PathLike, package_name: str = 'SYN') -> SyntheticSeries:
+    """Writes a version series of zip packages to outdir, the same spec always gives the same files"""
+    os.makedirs(outdir, exist_ok=True)
+    pattern = os.path.join(outdir, '{name}-{version}.zip')
+    gen = _Generator(spec)
+    files = {gen.new_name(): gen.new_content() for _ in range(spec.file_count)}
+    mainline = []
+    nonlinear: list[str] = []
+    for i in range(spec.versions):
+        if i:
+            files = gen.evolve(files)
+        version = f"v1.{i}.0"
+        mainline.append(version)
+        _write_zip(pattern.format(name=package_name, version=version), files)
+        if spec.branch_every and i % spec.branch_every == spec.branch_every - 1 and i < spec.versions - 1:
+            # a hotfix on top of this version that mainline never merges
+            hotfix = f"v1.{i}.1"
+            nonlinear.append(hotfix)
+            _write_zip(pattern.format(name=package_name, version=hotfix), gen.evolve(files, 0.2))
+    versions = []
+    for version in reversed(mainline):
+        # hotfixes are listed next to their base, like release history does
+        versions.extend(x for x in nonlinear if x.startswith(version[:-1]))
+        versions.append(version)
+    return SyntheticSeries(versions, nonlinear, pattern)
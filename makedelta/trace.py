@@ -0,0 +1,73 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# None while tracing is disabled
+_events: list[dict] | None = None
+_thread_names: dict[int, str] = {}
+_lock = threading.Lock()
+_origin = time.perf_counter_ns()
+
+def enable():
+    global _events, _origin
+    with _lock:
+        _events = []
+        _thread_names.clear()
+        _origin = time.perf_counter_ns()
+
+def enabled() -> bool:
+    return _events is not None
+
+@contextlib.contextmanager
+def span(name: str, /, *, cat: str = 'makedelta', cpu: bool = False, **args):
+    """Records a complete event around the block.
+
+    Yields the args dict, values added to it before the block exits are recorded too.
+    With `cpu`, CPU time of the calling thread is recorded as `cpu_ms`.
+    """
+    if _events is None:
+        yield args
+        return
+    start = time.perf_counter_ns()
+    cpu_start = time.thread_time_ns() if cpu else 0
+    try:
+        yield args
+    finally:
+        end = time.perf_counter_ns()
+        if cpu:
+            args['cpu_ms'] = (time.thread_time_ns() - cpu_start) / 1e6
+        thread = threading.current_thread()
+        event = {"name": name, "cat": cat, "ph": "X", "ts": (start - _origin) / 1000, "dur": (end - start) / 1000,
+                 "pid": os.getpid(), "tid": thread.native_id, "args": args}
+        with _lock:
+            if _events is not None:
+                _events.append(event)
+                _thread_names.setdefault(thread.native_id, thread.name)
+
+def traced(name: str, cat: str = 'makedelta', cpu: bool = False):
+    """Decorator recording a span for each call"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, cat=cat, cpu=cpu):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def events() -> list[dict]:
+    """Complete events recorded so far"""
+    with _lock:
+        return list(_events or ())
+
+def save(path: os.PathLike):
+    """Writes recorded events as Chrome trace JSON, viewable in Perfetto or chrome://tracing"""
+    with _lock:
+        events = list(_events or ())
+        thread_names = dict(_thread_names)
+    pid = os.getpid()
+    metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}} for tid, name in thread_names.items()]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
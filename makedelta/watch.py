@@ -0,0 +1,151 @@
+"""Long-running mode that builds a delta package whenever a new version lands in a drop directory.
+
+    python -m makedelta.watch <drop_dir> <versions.txt> <nonlinear_versions.txt> [<versions.txt> <nonlinear_versions.txt> ...] [--pattern PATTERN] [--interval SECONDS] [--profile PROFILE]
+
+Each pair of lists is a target, as in `python -m makedelta`. Packages, extracted entries and diff
+sizes stay between builds, so entry lists, entry tables, hashes and diff sizes are only computed
+for the new version. A new version that is in no list is prepended to the first versions.txt.
+Only the targets whose version list includes a new or replaced version are built.
+
+A replaced zip of a known version is reopened. Patches and chunks are keyed by content,
+so only pairs involving changed entries are generated again.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+from . import compression_profiles
+from . import makedelta
+from . import pkgprov
+from .zip_index import ZipIndex
+
+def _pattern_regex(pattern: str, package_name: str, variant: str | None) -> re.Pattern:
+    head, sep, tail = pattern.partition('{version}')
+    if not sep:
+        raise ValueError("pattern must contain {version}")
+    def literal(x):
+        return re.escape(x.format(name=package_name, variant=variant))
+    return re.compile(literal(head) + '(?P<version>.+)' + literal(tail))
+
+def _read_list(path) -> list[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [x.strip() for x in f if x.strip()]
+
+def _write_list(path, items: list[str]):
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(items) + '\n')
+    os.replace(tmpfile, path)
+
+
+class DropDirectoryWatcher:
+    """Polls a directory for package zips of versions not seen before, and for replaced zips of known versions.
+
+    A zip is only reported once its size and mtime stayed the same for one poll, so files still
+    being copied are skipped. Zips of known versions present at the first poll are not reported.
+    """
+    def __init__(self, drop_dir: str, regex: re.Pattern, known_versions):
+        self.drop_dir = drop_dir
+        self.regex = regex
+        self.known_versions = set(known_versions)
+        # size and mtime of reported and initially present zips
+        self._stats: dict[str, tuple[int, int]] = {}
+        self._pending: dict[str, tuple[int, int]] = {}
+
+    def poll(self) -> tuple[list[str], list[str]]:
+        """Returns new versions and versions with a replaced zip, in order of modification time"""
+        ready = []
+        seen = {}
+        for entry in os.scandir(self.drop_dir):
+            m = self.regex.fullmatch(entry.name)
+            if not m or not entry.is_file():
+                continue
+            version = m.group('version')
+            st = entry.stat()
+            stat = (st.st_size, st.st_mtime_ns)
+            if version in self.known_versions and self._stats.setdefault(version, stat) == stat:
+                continue
+            seen[version] = stat
+            if self._pending.get(version) == stat:
+                ready.append((st.st_mtime_ns, version))
+        ready.sort()
+        versions = [x[1] for x in ready]
+        self._pending = {k: v for k, v in seen.items() if k not in versions}
+        new_versions = [x for x in versions if x not in self.known_versions]
+        replaced_versions = [x for x in versions if x in self.known_versions]
+        self.known_versions.update(versions)
+        self._stats.update((x, seen[x]) for x in versions)
+        return new_versions, replaced_versions
+
+
+def watch(provider: pkgprov.PackageProvider, watcher: DropDirectoryWatcher, package_name: str, package_variant: str | None,
+          lists: list[tuple[str, str]], interval: float):
+    """Builds the targets of `lists`, pairs of versions.txt and nonlinear_versions.txt, affected by each drop"""
+    provider = pkgprov.CachedPackageProvider(provider)
+    session = makedelta.BuildSession()
+    # load known versions up front, so the first build only waits for the new one
+    for version in dict.fromkeys(x for versions_file, _ in lists for x in _read_list(versions_file)):
+        provider.open_package(package_name, version, package_variant).get_entries()
+    print("Watching for new versions", flush=True)
+    try:
+        while True:
+            new_versions, replaced_versions = watcher.poll()
+            for version in replaced_versions:
+                provider.discard(package_name, version, package_variant)
+            targets = [makedelta.DeltaTarget(_read_list(a), _read_list(b)) for a, b in lists]
+            listed = {x for target in targets for x in target.versions}
+            if unlisted := [x for x in new_versions if x not in listed]:
+                # newest first, the last new version becomes the target of the first list
+                targets[0].versions = [*reversed(unlisted), *targets[0].versions]
+                _write_list(lists[0][0], targets[0].versions)
+                print(f"New versions: {', '.join(unlisted)}", flush=True)
+            if replaced_versions:
+                print(f"Replaced versions: {', '.join(replaced_versions)}", flush=True)
+            changed = {*new_versions, *replaced_versions}
+            affected = [x for x in targets if changed.intersection(x.versions)]
+            if affected:
+                names = ', '.join(x.versions[0] for x in affected)
+                print(f"Building delta for {names}", flush=True)
+                start = time.monotonic()
+                try:
+                    makedelta.main(provider, package_name, package_variant, affected[0].versions, affected[0].nonlinear_versions, affected[1:], session)
+                except Exception as e:
+                    # keep watching, the next drop retries with the full version lists
+                    print(f"Build for {names} failed: {e!r}", file=sys.stderr, flush=True)
+                else:
+                    print(f"Built delta for {names} in {time.monotonic() - start:.1f}s", flush=True)
+            time.sleep(interval)
+    finally:
+        session.close()
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m makedelta.watch', description='Build delta packages as new versions are dropped')
+    parser.add_argument('drop_dir')
+    parser.add_argument('lists', nargs='+', help='version list and nonlinear version list of each target, new versions go to the first')
+    parser.add_argument('--name', default='MAA')
+    parser.add_argument('--variant', default='win-x64')
+    parser.add_argument('--pattern', default='{name}-{version}-{variant}.zip', help='package file name in drop_dir')
+    parser.add_argument('--interval', type=float, default=10)
+    parser.add_argument('--profile', choices=list(compression_profiles.PROFILES), default='release', help='compression profile (default: release)')
+    args = parser.parse_args()
+    if len(args.lists) % 2:
+        parser.error("version lists must come in pairs")
+    makedelta.compression_profile = compression_profiles.PROFILES[args.profile]
+
+    variant = args.variant or None
+    index = ZipIndex(os.path.join(makedelta.cache_dir, 'zip_index.db'))
+    provider = pkgprov.ZipDirectoryProvider(os.path.join(args.drop_dir, args.pattern), index)
+    lists = list(zip(args.lists[0::2], args.lists[1::2]))
+    known_versions = [x for versions_file, _ in lists for x in _read_list(versions_file)]
+    watcher = DropDirectoryWatcher(args.drop_dir, _pattern_regex(args.pattern, args.name, variant), known_versions)
+    try:
+        watch(provider, watcher, args.name, variant, lists, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.close()
+
+if __name__ == '__main__':
+    main()
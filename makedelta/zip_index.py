@@ -0,0 +1,50 @@
+import json
+import os
+import sqlite3
+import threading
+
+from . import pkgprov
+
+create_table_sql = """
+CREATE TABLE "zip_entries" (
+	"path" TEXT,
+	"size" INTEGER,
+	"mtime_ns" INTEGER,
+	"entries" TEXT,
+	PRIMARY KEY ("path")
+);
+"""
+
+def _zip_key(path: os.PathLike):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+class ZipIndex:
+    """Persistent entry lists of zip files, keyed by path, size and mtime"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='zip_entries';")
+        table_exists = cursor.fetchone()
+        if not table_exists:
+            with self.conn:
+                self.conn.executescript(create_table_sql)
+
+    def query(self, path: os.PathLike) -> list[pkgprov.PackageEntry] | None:
+        key = _zip_key(path)
+        with self.lock:
+            cursor = self.conn.execute("SELECT entries FROM zip_entries WHERE path = ? AND size = ? AND mtime_ns = ?;", key)
+            result = cursor.fetchone()
+        if result is None:
+            return None
+        return [pkgprov.PackageEntry(name, size, checksum_type, bytes.fromhex(checksum), mtime, mode) for name, size, checksum_type, checksum, mtime, mode in json.loads(result[0])]
+
+    def add(self, path: os.PathLike, entries: list[pkgprov.PackageEntry]):
+        key = _zip_key(path)
+        data = json.dumps([(x.name, x.size, x.checksum_type, x.checksum.hex(), x.mtime, x.mode) for x in entries], ensure_ascii=False, separators=(',', ':'))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO zip_entries VALUES (?, ?, ?, ?)", (*key, data))
+
+    def close(self):
+        self.conn.close()
@@ -1,18 +1,86 @@
 import ctypes
 import ctypes.util
+import io
+import threading
+import typing
 
 from collections.abc import Buffer
 
 from . import ctypes_buffer
+from .zstd_params import CompressionParameters
 
 CLEVEL_DEFAULT = 3
 CLEVEL_MAX = 22
 
+WINDOWLOG_MIN = 10
+WINDOWLOG_MAX = 31 if ctypes.sizeof(ctypes.c_size_t) == 8 else 30
+
 _libname = ctypes.util.find_library('zstd') or ctypes.util.find_library('libzstd')
 if not _libname:
     raise ImportError('zstd library not found')
 _lib = ctypes.CDLL(_libname)
 
+# ZSTD_cParameter
+_ZSTD_c_compressionLevel = 100
+_ZSTD_c_windowLog = 101
+_ZSTD_c_enableLongDistanceMatching = 160
+_ZSTD_c_checksumFlag = 201
+_ZSTD_c_nbWorkers = 400
+_ZSTD_c_jobSize = 401
+
+# ZSTD_dParameter
+_ZSTD_d_windowLogMax = 100
+
+# ZSTD_EndDirective
+_ZSTD_e_continue = 0
+_ZSTD_e_end = 2
+
+# ZSTD_ResetDirective
+_ZSTD_reset_session_and_parameters = 3
+
+# ZSTD_dictLoadMethod_e
+_ZSTD_dlm_byRef = 1
+
+# ZSTD_dictContentType_e
+_ZSTD_dct_rawContent = 1
+
+# ZSTD_strategy
+_ZSTD_btlazy2 = 6
+
+
+class _ZSTD_compressionParameters(ctypes.Structure):
+    _fields_ = [
+        ('windowLog', ctypes.c_uint),
+        ('chainLog', ctypes.c_uint),
+        ('hashLog', ctypes.c_uint),
+        ('searchLog', ctypes.c_uint),
+        ('minMatch', ctypes.c_uint),
+        ('targetLength', ctypes.c_uint),
+        ('strategy', ctypes.c_int),
+    ]
+
+class _ZSTD_inBuffer(ctypes.Structure):
+    _fields_ = [
+        ('src', ctypes.c_void_p),
+        ('size', ctypes.c_size_t),
+        ('pos', ctypes.c_size_t),
+    ]
+
+class _ZSTD_outBuffer(ctypes.Structure):
+    _fields_ = [
+        ('dst', ctypes.c_void_p),
+        ('size', ctypes.c_size_t),
+        ('pos', ctypes.c_size_t),
+    ]
+
+class _ZSTD_customMem(ctypes.Structure):
+    _fields_ = [
+        ('customAlloc', ctypes.c_void_p),
+        ('customFree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+    ]
+
+
 _ZSTD_compress = _lib.ZSTD_compress
 _ZSTD_compress.restype = ctypes.c_size_t
 _ZSTD_compress.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
@@ -21,13 +89,457 @@ _ZSTD_compressBound = _lib.ZSTD_compressBound
 _ZSTD_compressBound.restype = ctypes.c_size_t
 _ZSTD_compressBound.argtypes = [ctypes.c_size_t]
 
+_ZSTD_isError = _lib.ZSTD_isError
+_ZSTD_isError.restype = ctypes.c_uint
+_ZSTD_isError.argtypes = [ctypes.c_size_t]
+
+_ZSTD_getErrorName = _lib.ZSTD_getErrorName
+_ZSTD_getErrorName.restype = ctypes.c_char_p
+_ZSTD_getErrorName.argtypes = [ctypes.c_size_t]
+
+_ZSTD_createCCtx = _lib.ZSTD_createCCtx
+_ZSTD_createCCtx.restype = ctypes.c_void_p
+_ZSTD_createCCtx.argtypes = []
+
+_ZSTD_freeCCtx = _lib.ZSTD_freeCCtx
+_ZSTD_freeCCtx.restype = ctypes.c_size_t
+_ZSTD_freeCCtx.argtypes = [ctypes.c_void_p]
+
+_ZSTD_CCtx_reset = _lib.ZSTD_CCtx_reset
+_ZSTD_CCtx_reset.restype = ctypes.c_size_t
+_ZSTD_CCtx_reset.argtypes = [ctypes.c_void_p, ctypes.c_int]
+
+_ZSTD_CCtx_setParameter = _lib.ZSTD_CCtx_setParameter
+_ZSTD_CCtx_setParameter.restype = ctypes.c_size_t
+_ZSTD_CCtx_setParameter.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+
+_ZSTD_CCtx_setPledgedSrcSize = _lib.ZSTD_CCtx_setPledgedSrcSize
+_ZSTD_CCtx_setPledgedSrcSize.restype = ctypes.c_size_t
+_ZSTD_CCtx_setPledgedSrcSize.argtypes = [ctypes.c_void_p, ctypes.c_ulonglong]
+
+_ZSTD_CCtx_loadDictionary = _lib.ZSTD_CCtx_loadDictionary
+_ZSTD_CCtx_loadDictionary.restype = ctypes.c_size_t
+_ZSTD_CCtx_loadDictionary.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+
+_ZSTD_CCtx_refCDict = _lib.ZSTD_CCtx_refCDict
+_ZSTD_CCtx_refCDict.restype = ctypes.c_size_t
+_ZSTD_CCtx_refCDict.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+
+_ZSTD_compress2 = _lib.ZSTD_compress2
+_ZSTD_compress2.restype = ctypes.c_size_t
+_ZSTD_compress2.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t]
+
+_ZSTD_compressStream2 = _lib.ZSTD_compressStream2
+_ZSTD_compressStream2.restype = ctypes.c_size_t
+_ZSTD_compressStream2.argtypes = [ctypes.c_void_p, ctypes.POINTER(_ZSTD_outBuffer), ctypes.POINTER(_ZSTD_inBuffer), ctypes.c_int]
+
+_ZSTD_CStreamOutSize = _lib.ZSTD_CStreamOutSize
+_ZSTD_CStreamOutSize.restype = ctypes.c_size_t
+_ZSTD_CStreamOutSize.argtypes = []
+
+_ZSTD_createDCtx = _lib.ZSTD_createDCtx
+_ZSTD_createDCtx.restype = ctypes.c_void_p
+_ZSTD_createDCtx.argtypes = []
+
+_ZSTD_freeDCtx = _lib.ZSTD_freeDCtx
+_ZSTD_freeDCtx.restype = ctypes.c_size_t
+_ZSTD_freeDCtx.argtypes = [ctypes.c_void_p]
+
+_ZSTD_DCtx_setParameter = _lib.ZSTD_DCtx_setParameter
+_ZSTD_DCtx_setParameter.restype = ctypes.c_size_t
+_ZSTD_DCtx_setParameter.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+
+_ZSTD_DCtx_loadDictionary = _lib.ZSTD_DCtx_loadDictionary
+_ZSTD_DCtx_loadDictionary.restype = ctypes.c_size_t
+_ZSTD_DCtx_loadDictionary.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+
+_ZSTD_DCtx_refPrefix = _lib.ZSTD_DCtx_refPrefix
+_ZSTD_DCtx_refPrefix.restype = ctypes.c_size_t
+_ZSTD_DCtx_refPrefix.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+
+_ZSTD_decompressStream = _lib.ZSTD_decompressStream
+_ZSTD_decompressStream.restype = ctypes.c_size_t
+_ZSTD_decompressStream.argtypes = [ctypes.c_void_p, ctypes.POINTER(_ZSTD_outBuffer), ctypes.POINTER(_ZSTD_inBuffer)]
+
+_ZSTD_DStreamInSize = _lib.ZSTD_DStreamInSize
+_ZSTD_DStreamInSize.restype = ctypes.c_size_t
+_ZSTD_DStreamInSize.argtypes = []
+
+_ZSTD_getCParams = _lib.ZSTD_getCParams
+_ZSTD_getCParams.restype = _ZSTD_compressionParameters
+_ZSTD_getCParams.argtypes = [ctypes.c_int, ctypes.c_ulonglong, ctypes.c_size_t]
+
+_ZSTD_createCDict_advanced = _lib.ZSTD_createCDict_advanced
+_ZSTD_createCDict_advanced.restype = ctypes.c_void_p
+_ZSTD_createCDict_advanced.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, _ZSTD_compressionParameters, _ZSTD_customMem]
+
+_ZSTD_freeCDict = _lib.ZSTD_freeCDict
+_ZSTD_freeCDict.restype = ctypes.c_size_t
+_ZSTD_freeCDict.argtypes = [ctypes.c_void_p]
+
+_ZSTD_estimateCStreamSize_usingCParams = _lib.ZSTD_estimateCStreamSize_usingCParams
+_ZSTD_estimateCStreamSize_usingCParams.restype = ctypes.c_size_t
+_ZSTD_estimateCStreamSize_usingCParams.argtypes = [_ZSTD_compressionParameters]
+
+_ZSTD_estimateCCtxSize_usingCParams = _lib.ZSTD_estimateCCtxSize_usingCParams
+_ZSTD_estimateCCtxSize_usingCParams.restype = ctypes.c_size_t
+_ZSTD_estimateCCtxSize_usingCParams.argtypes = [_ZSTD_compressionParameters]
+
+_ZSTD_estimateCDictSize_advanced = _lib.ZSTD_estimateCDictSize_advanced
+_ZSTD_estimateCDictSize_advanced.restype = ctypes.c_size_t
+_ZSTD_estimateCDictSize_advanced.argtypes = [ctypes.c_size_t, _ZSTD_compressionParameters, ctypes.c_int]
+
+_ZDICT_trainFromBuffer = _lib.ZDICT_trainFromBuffer
+_ZDICT_trainFromBuffer.restype = ctypes.c_size_t
+_ZDICT_trainFromBuffer.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.POINTER(ctypes.c_size_t), ctypes.c_uint]
+
+_ZDICT_isError = _lib.ZDICT_isError
+_ZDICT_isError.restype = ctypes.c_uint
+_ZDICT_isError.argtypes = [ctypes.c_size_t]
+
+_ZDICT_getErrorName = _lib.ZDICT_getErrorName
+_ZDICT_getErrorName.restype = ctypes.c_char_p
+_ZDICT_getErrorName.argtypes = [ctypes.c_size_t]
+
 _array_type = ctypes.c_uint8 * 0
 
 
-def compress(data: Buffer, level: int = CLEVEL_DEFAULT) -> bytearray:
+class ZstdError(Exception):
+    pass
+
+class ZstdCancelled(ZstdError):
+    pass
+
+def _check(result: int) -> int:
+    if _ZSTD_isError(result):
+        raise ZstdError(_ZSTD_getErrorName(result).decode())
+    return result
+
+
+class _CompressionContext:
+    __slots__ = ('_cctx',)
+    def __init__(self):
+        self._cctx = _ZSTD_createCCtx()
+        if not self._cctx:
+            raise MemoryError("ZSTD_createCCtx failed")
+    def __del__(self):
+        if self._cctx:
+            _ZSTD_freeCCtx(self._cctx)
+            self._cctx = None
+    @property
+    def _as_parameter_(self):
+        return self._cctx
+    def reset(self):
+        _check(_ZSTD_CCtx_reset(self, _ZSTD_reset_session_and_parameters))
+    def set_parameter(self, param: int, value: int):
+        _check(_ZSTD_CCtx_setParameter(self, param, value))
+    def set_parameters(self, params: CompressionParameters):
+        self.set_parameter(_ZSTD_c_compressionLevel, params.level)
+        self.set_parameter(_ZSTD_c_checksumFlag, int(params.checksum))
+        if params.window_log:
+            self.set_parameter(_ZSTD_c_windowLog, params.window_log)
+        if params.long_distance_matching:
+            self.set_parameter(_ZSTD_c_enableLongDistanceMatching, 1)
+        if params.nb_workers:
+            self.set_parameter(_ZSTD_c_nbWorkers, params.nb_workers)
+            if params.job_size:
+                self.set_parameter(_ZSTD_c_jobSize, params.job_size)
+    def set_pledged_size(self, size: int):
+        _check(_ZSTD_CCtx_setPledgedSrcSize(self, size))
+
+
+_local = threading.local()
+
+def _thread_cctx() -> _CompressionContext:
+    """Returns a compression context owned by the calling thread, reset to default parameters"""
+    cctx = getattr(_local, 'cctx', None)
+    if cctx is None:
+        cctx = _local.cctx = _CompressionContext()
+    cctx.reset()
+    return cctx
+
+def _highbit(value: int) -> int:
+    return max(value, 1).bit_length() - 1
+
+
+def compress(data: Buffer, level: int | CompressionParameters = CLEVEL_DEFAULT, dictionary: Buffer | None = None) -> bytearray:
     with ctypes_buffer.ctypes_simple_buffer(data) as inbuf:
         outbuflen = _ZSTD_compressBound(len(inbuf))
         out = bytearray(outbuflen)
-        outlen = _ZSTD_compress(_array_type.from_buffer(out), outbuflen, inbuf, len(inbuf), level)
+        if dictionary is not None and not isinstance(level, CompressionParameters):
+            level = CompressionParameters(level)
+        if isinstance(level, CompressionParameters):
+            cctx = _thread_cctx()
+            cctx.set_parameters(level)
+            if dictionary is not None:
+                # copied into the context, and dropped by the next reset
+                with ctypes_buffer.ctypes_simple_buffer(dictionary) as dictbuf:
+                    _check(_ZSTD_CCtx_loadDictionary(cctx, dictbuf, len(dictbuf)))
+            outlen = _check(_ZSTD_compress2(cctx, _array_type.from_buffer(out), outbuflen, inbuf, len(inbuf)))
+        else:
+            outlen = _check(_ZSTD_compress(_array_type.from_buffer(out), outbuflen, inbuf, len(inbuf), level))
     out = out[:outlen]
     return out
+
+
+def train_dictionary(samples: list[Buffer], dict_size: int) -> bytes:
+    """Trains a zstd dictionary of at most dict_size bytes, raises ZstdError if the samples are not enough"""
+    joined = b''.join(samples)
+    sizes = (ctypes.c_size_t * len(samples))(*(len(memoryview(x)) for x in samples))
+    out = bytearray(dict_size)
+    with ctypes_buffer.ctypes_simple_buffer(joined) as inbuf:
+        result = _ZDICT_trainFromBuffer(_array_type.from_buffer(out), dict_size, inbuf, sizes, len(samples))
+    if _ZDICT_isError(result):
+        raise ZstdError(_ZDICT_getErrorName(result).decode())
+    return bytes(out[:result])
+
+
+def estimate_stream_memory(params: CompressionParameters) -> int:
+    """Approximate memory used by a ZstdCompressWriter with params"""
+    cparams = _ZSTD_getCParams(params.level, 0, 0)
+    if params.window_log:
+        cparams.windowLog = params.window_log
+    size = _ZSTD_estimateCStreamSize_usingCParams(cparams)
+    if params.nb_workers:
+        # each worker has its own context, plus input and output buffers of a job
+        job_size = params.job_size or (4 << cparams.windowLog)
+        size = params.nb_workers * (size + 2 * job_size)
+    return size
+
+def estimate_patch_memory(old_size: int, new_size: int, level: int = CLEVEL_MAX) -> int:
+    """Approximate memory used by PatchFromSource and its compress call, including input and output buffers"""
+    dict_cparams = _ZSTD_getCParams(level, old_size, old_size)
+    cparams = _ZSTD_getCParams(level, new_size, old_size)
+    cparams.windowLog = min(max(_highbit(max(old_size, new_size)) + 1, WINDOWLOG_MIN), WINDOWLOG_MAX)
+    return (_ZSTD_estimateCDictSize_advanced(old_size, dict_cparams, _ZSTD_dlm_byRef) + _ZSTD_estimateCCtxSize_usingCParams(cparams)
+            + old_size + new_size + _ZSTD_compressBound(new_size))
+
+
+# input fed to the compressor between checks for cancellation
+_CANCEL_BLOCK = 1048576
+
+class PatchFromSource:
+    """Reference content for `zstd --patch-from` compatible patch generation.
+
+    The reference is loaded and indexed into a CDict once, and can then be used to
+    generate patches for any number of target contents, from any number of threads.
+    """
+    __slots__ = ('_data', '_buffer', '_cdict', 'level')
+    def __init__(self, data: Buffer, level: int = CLEVEL_MAX):
+        self._data = data
+        self._buffer = ctypes_buffer.ctypes_simple_buffer(data)
+        self.level = level
+        size = len(self._buffer)
+        # tables are sized for a target of similar size to the reference
+        cparams = _ZSTD_getCParams(level, size, size)
+        self._cdict = _ZSTD_createCDict_advanced(self._buffer, size, _ZSTD_dlm_byRef, _ZSTD_dct_rawContent, cparams, _ZSTD_customMem())
+        if not self._cdict:
+            self._buffer.close()
+            raise ZstdError("ZSTD_createCDict_advanced failed")
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __del__(self):
+        if getattr(self, '_cdict', None):
+            _ZSTD_freeCDict(self._cdict)
+            self._cdict = None
+        if getattr(self, '_buffer', None) is not None:
+            self._buffer.close()
+
+    def compress(self, data: Buffer, cancel: threading.Event | None = None) -> bytearray:
+        """Generates a patch from the reference to `data`, decodable with `zstd -d --patch-from`.
+
+        With `cancel`, input is fed in blocks and ZstdCancelled is raised once the event is set.
+        """
+        with ctypes_buffer.ctypes_simple_buffer(data) as inbuf:
+            cctx = _thread_cctx()
+            # same window adjustment as the zstd CLI in patch-from mode
+            file_window_log = _highbit(max(len(inbuf), len(self))) + 1
+            cparams = _ZSTD_getCParams(self.level, len(inbuf), len(self))
+            cycle_log = cparams.chainLog - (1 if cparams.strategy >= _ZSTD_btlazy2 else 0)
+            cctx.set_parameter(_ZSTD_c_compressionLevel, self.level)
+            cctx.set_parameter(_ZSTD_c_windowLog, min(max(file_window_log, WINDOWLOG_MIN), WINDOWLOG_MAX))
+            cctx.set_parameter(_ZSTD_c_checksumFlag, 1)
+            if file_window_log > cycle_log:
+                cctx.set_parameter(_ZSTD_c_enableLongDistanceMatching, 1)
+            _check(_ZSTD_CCtx_refCDict(cctx, self._cdict))
+            try:
+                outbuflen = _ZSTD_compressBound(len(inbuf))
+                out = bytearray(outbuflen)
+                if cancel is None:
+                    outlen = _check(_ZSTD_compress2(cctx, _array_type.from_buffer(out), outbuflen, inbuf, len(inbuf)))
+                else:
+                    outlen = self._compress_blocks(cctx, inbuf, out, cancel)
+            finally:
+                # drop the reference so the CDict can be freed independently of this thread's context
+                cctx.reset()
+        del out[outlen:]
+        return out
+
+    @staticmethod
+    def _compress_blocks(cctx: _CompressionContext, inbuf, out: bytearray, cancel: threading.Event) -> int:
+        cctx.set_pledged_size(len(inbuf))
+        outbuf = _ZSTD_outBuffer(ctypes.addressof(_array_type.from_buffer(out)), len(out), 0)
+        start = inbuf._as_parameter_
+        for offset in range(0, len(inbuf), _CANCEL_BLOCK):
+            if cancel.is_set():
+                raise ZstdCancelled("patch generation cancelled")
+            end = min(offset + _CANCEL_BLOCK, len(inbuf))
+            block = _ZSTD_inBuffer(start + offset, end - offset, 0)
+            while block.pos < block.size:
+                _check(_ZSTD_compressStream2(cctx, ctypes.byref(outbuf), ctypes.byref(block), _ZSTD_e_continue))
+        empty = _ZSTD_inBuffer(None, 0, 0)
+        # the output buffer holds a whole frame, so one call ends it
+        if _check(_ZSTD_compressStream2(cctx, ctypes.byref(outbuf), ctypes.byref(empty), _ZSTD_e_end)):
+            raise ZstdError("output buffer too small")
+        return outbuf.pos
+
+
+class ZstdCompressWriter:
+    """Write-only file object that compresses into a single zstd frame written to `fileobj`.
+
+    Memory usage is bounded by the compression context, regardless of the amount of data written.
+    `fileobj` is not closed by this object.
+
+    If `pledged_size` is given, it is recorded in the frame header and writing a different amount of data is an error.
+    """
+    def __init__(self, fileobj: typing.BinaryIO, level: int | CompressionParameters = CLEVEL_DEFAULT, pledged_size: int | None = None):
+        if not isinstance(level, CompressionParameters):
+            level = CompressionParameters(level)
+        self.fileobj = fileobj
+        self._cctx = _CompressionContext()
+        self._cctx.set_parameters(level)
+        if pledged_size is not None:
+            self._cctx.set_pledged_size(pledged_size)
+        self._outbuf = (ctypes.c_uint8 * _ZSTD_CStreamOutSize())()
+        self._pos = 0
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # discard the incomplete frame
+            self.closed = True
+            self._cctx = None
+        return False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        """Returns the number of uncompressed bytes written"""
+        return self._pos
+
+    def _compress(self, inbuf: _ZSTD_inBuffer, end_op: int):
+        outbuf = _ZSTD_outBuffer(ctypes.addressof(self._outbuf), len(self._outbuf), 0)
+        while True:
+            outbuf.pos = 0
+            remaining = _check(_ZSTD_compressStream2(self._cctx, ctypes.byref(outbuf), ctypes.byref(inbuf), end_op))
+            if outbuf.pos:
+                self.fileobj.write(memoryview(self._outbuf)[:outbuf.pos])
+            if end_op == _ZSTD_e_end:
+                if remaining == 0:
+                    return
+            elif inbuf.pos == inbuf.size:
+                return
+
+    def write(self, data: Buffer) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        with ctypes_buffer.ctypes_simple_buffer(data) as buf:
+            size = len(buf)
+            if size:
+                self._compress(_ZSTD_inBuffer(buf._as_parameter_, size, 0), _ZSTD_e_continue)
+        self._pos += size
+        return size
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self._compress(_ZSTD_inBuffer(None, 0, 0), _ZSTD_e_end)
+        self.closed = True
+        self._cctx = None
+        self.fileobj.flush()
+
+
+class ZstdDecompressReader(io.RawIOBase):
+    """Read-only file object that decompresses the zstd frames read from `fileobj`, concatenated frames in order.
+
+    `dictionary` is used for every frame. `prefix` is the reference content of a `--patch-from` patch,
+    it is only used for the first frame and must not change while reading.
+    `fileobj` is not closed by this object.
+    """
+    def __init__(self, fileobj: typing.BinaryIO, dictionary: Buffer | None = None, prefix: Buffer | None = None, window_log_max: int = WINDOWLOG_MAX):
+        self.fileobj = fileobj
+        self._dctx = _ZSTD_createDCtx()
+        if not self._dctx:
+            raise MemoryError("ZSTD_createDCtx failed")
+        self._prefix = None
+        _check(_ZSTD_DCtx_setParameter(self._dctx, _ZSTD_d_windowLogMax, window_log_max))
+        if dictionary is not None:
+            # copied into the context
+            with ctypes_buffer.ctypes_simple_buffer(dictionary) as dictbuf:
+                _check(_ZSTD_DCtx_loadDictionary(self._dctx, dictbuf, len(dictbuf)))
+        if prefix is not None:
+            self._prefix = ctypes_buffer.ctypes_simple_buffer(prefix)
+            _check(_ZSTD_DCtx_refPrefix(self._dctx, self._prefix, len(self._prefix)))
+        self._inbuf = (ctypes.c_uint8 * _ZSTD_DStreamInSize())()
+        self._in = _ZSTD_inBuffer(ctypes.addressof(self._inbuf), 0, 0)
+        self._input_eof = False
+        self._frame_complete = True
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        data = self.fileobj.read(len(self._inbuf))
+        if not data:
+            self._input_eof = True
+        ctypes.memmove(self._inbuf, data, len(data))
+        self._in.size = len(data)
+        self._in.pos = 0
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError("read from closed file")
+        with memoryview(b) as view, view.cast('B') as byte_view:
+            if not len(byte_view):
+                return 0
+            out = (ctypes.c_uint8 * len(byte_view)).from_buffer(byte_view)
+            try:
+                outbuf = _ZSTD_outBuffer(ctypes.addressof(out), len(byte_view), 0)
+                while True:
+                    if self._in.pos == self._in.size and not self._input_eof:
+                        self._fill()
+                    input_drained = self._in.pos == self._in.size
+                    if input_drained and self._frame_complete:
+                        return outbuf.pos
+                    # the context flushes output it still holds before taking more input
+                    remaining = _check(_ZSTD_decompressStream(self._dctx, ctypes.byref(outbuf), ctypes.byref(self._in)))
+                    self._frame_complete = remaining == 0
+                    if outbuf.pos:
+                        return outbuf.pos
+                    if input_drained:
+                        raise ZstdError("truncated zstd frame")
+            finally:
+                del out
+
+    def close(self):
+        if self._dctx:
+            _ZSTD_freeDCtx(self._dctx)
+            self._dctx = None
+        if self._prefix is not None:
+            self._prefix.close()
+            self._prefix = None
+        super().close()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,31 @@
+import dataclasses
+
+@dataclasses.dataclass(slots=True, frozen=True)
+class CompressionParameters:
+    """Advanced zstd compression parameters, usable with both zstd_ctypes and the zstd CLI.
+
+    Zero values leave the parameter at the library default for the compression level.
+    """
+    level: int = 3
+    nb_workers: int = 0
+    """Number of worker threads, 0 for single-threaded compression"""
+    job_size: int = 0
+    """Size of each job in multi-threaded compression"""
+    window_log: int = 0
+    """Decoders limit window_log to 27 by default, larger values need cooperation from consumer"""
+    long_distance_matching: bool = False
+    checksum: bool = True
+
+    def cli_args(self) -> list[str]:
+        args = ['--ultra', f'-{self.level}']
+        if self.nb_workers:
+            args.append(f'-T{self.nb_workers}')
+        if self.job_size:
+            args.append(f'-B{self.job_size}')
+        if self.long_distance_matching:
+            args.append(f'--long={self.window_log}' if self.window_log else '--long')
+        elif self.window_log:
+            args.append(f'--zstd=wlog={self.window_log}')
+        if not self.checksum:
+            args.append('--no-check')
+        return args
@@ -0,0 +1,111 @@
+"""Builds delta packages of synthetic versions and applies them to every version they support"""
+import dataclasses
+import os
+import shutil
+
+import pytest
+
+for tool in (os.environ.get("ZSTD", "zstd"), os.environ.get("MAA_BSDIFF", "maa_bsdiff"), os.environ.get("MAA_BSPATCH", "maa_bspatch")):
+    if not shutil.which(tool):
+        pytest.skip(f"{tool} not found", allow_module_level=True)
+
+from makedelta import apply
+from makedelta import apply_bench
+from makedelta import compression_profiles
+from makedelta import makedelta
+from makedelta import pkgprov
+from makedelta import synthetic
+from makedelta.zip_index import ZipIndex
+
+PACKAGE_NAME = 'SYN'
+# v1.3.0, v1.2.0, v1.1.1 (hotfix), v1.1.0, v1.0.0
+SPEC = synthetic.SyntheticSpec(file_count=60, mean_size=8192, versions=4, branch_every=2, mutation_rate=0.5)
+
+
+@pytest.fixture(scope='module')
+def series(tmp_path_factory) -> synthetic.SyntheticSeries:
+    return synthetic.generate_series(SPEC, tmp_path_factory.mktemp('testdata'), PACKAGE_NAME)
+
+
+@pytest.fixture
+def build_dir(tmp_path, monkeypatch):
+    """Runs the test in an empty working directory with cold caches"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(makedelta.cache_dir)
+    os.makedirs(makedelta.outdir)
+    monkeypatch.setattr(makedelta, 'compression_profile', compression_profiles.PROFILES['preview'])
+    makedelta.reset_caches()
+    yield tmp_path
+    makedelta.reset_caches()
+
+
+def build(pattern: str, variants: list[str | None], targets: list[makedelta.DeltaTarget]):
+    index = ZipIndex(os.path.join(makedelta.cache_dir, 'zip_index.db'))
+    try:
+        # planning consumes the nonlinear version lists
+        targets = [makedelta.DeltaTarget(list(x.versions), list(x.nonlinear_versions)) for x in targets]
+        makedelta.build_deltas(pkgprov.ZipDirectoryProvider(pattern, index), PACKAGE_NAME, variants, targets)
+    finally:
+        index.close()
+
+
+def check_applies(pattern: str, target: makedelta.DeltaTarget, variant: str | None = None) -> tuple[apply.DeltaPackage, list[dict]]:
+    """Checks the package of target and applies it to each previous version, compared with the zip of the target version.
+    Returns the package and the apply results."""
+    package_file = os.path.join(makedelta.outdir, f"{PACKAGE_NAME}-{target.versions[0]}{'-' + variant if variant else ''}-delta.tar.zst")
+    pkg = apply.check_delta_package(package_file)
+    assert sorted(pkg.delta_manifest["for_version"]) == sorted(target.versions[1:])
+    results = apply_bench.run(package_file, pattern, os.path.abspath('apply'), apply.bspatch_executable, None)
+    assert {x["version"]: x["verified"] for x in results} == {x: True for x in target.versions[1:]}
+    return pkg, results
+
+
+def test_single_target(series, build_dir):
+    target = makedelta.DeltaTarget(series.versions, series.nonlinear_versions)
+    build(series.pattern, [None], [target])
+    _, results = check_applies(series.pattern, target)
+    assert all(x["files_patched"] for x in results)
+
+
+def test_frame_size(series, build_dir, monkeypatch):
+    monkeypatch.setattr(makedelta, 'chunk_frame_size', 16384)
+    target = makedelta.DeltaTarget(series.versions, series.nonlinear_versions)
+    build(series.pattern, [None], [target])
+    pkg, _ = check_applies(series.pattern, target)
+    assert any(len(x.get("frames") or []) > 1 for x in pkg.delta_manifest["chunks"])
+
+
+def test_dictionary(series, build_dir, monkeypatch):
+    monkeypatch.setattr(makedelta, 'chunk_dictionary', True)
+    monkeypatch.setattr(makedelta, 'chunk_dictionary_min_members', 2)
+    target = makedelta.DeltaTarget(series.versions, series.nonlinear_versions)
+    build(series.pattern, [None], [target])
+    pkg, _ = check_applies(series.pattern, target)
+    chunks = pkg.delta_manifest["chunks"]
+    assert "dictionary" in pkg.delta_manifest
+    assert any(x.get("dictionary") for x in chunks)
+
+
+def test_variants(series, build_dir, tmp_path_factory):
+    # a second variant with other content under the same version names
+    other = synthetic.generate_series(dataclasses.replace(SPEC, seed=2), tmp_path_factory.mktemp('testdata-arm64'), PACKAGE_NAME)
+    variant_dir = tmp_path_factory.mktemp('testdata-variants')
+    pattern = str(variant_dir / '{name}-{version}-{variant}.zip')
+    for variant, source in [('x64', series), ('arm64', other)]:
+        for version in series.versions:
+            shutil.copy(source.pattern.format(name=PACKAGE_NAME, version=version), pattern.format(name=PACKAGE_NAME, version=version, variant=variant))
+    target = makedelta.DeltaTarget(series.versions, series.nonlinear_versions)
+    build(pattern, ['x64', 'arm64'], [target])
+    for variant in ['x64', 'arm64']:
+        check_applies(pattern, target, variant)
+
+
+def test_multiple_targets(series, build_dir):
+    targets = [
+        makedelta.DeltaTarget(series.versions, series.nonlinear_versions),
+        # an older channel without the newest version
+        makedelta.DeltaTarget(series.versions[1:], series.nonlinear_versions),
+    ]
+    build(series.pattern, [None], targets)
+    for target in targets:
+        check_applies(series.pattern, target)
@@ -0,0 +1,102 @@
+import fractions
+import os
+import random
+import shutil
+from collections import defaultdict
+
+import pytest
+
+for tool in (os.environ.get("ZSTD", "zstd"), os.environ.get("MAA_BSDIFF", "maa_bsdiff")):
+    if not shutil.which(tool):
+        pytest.skip(f"{tool} not found", allow_module_level=True)
+
+from makedelta import makedelta
+
+
+def baseline_sort_versions(versions, nonlinear_versions, diff):
+    """sort_versions of the original implementation, with exact arithmetic so ties compare equal"""
+    local_versions = [x for x in versions if x not in nonlinear_versions]
+
+    def calc_weighted_avgdiff(version_list):
+        diffsize = [diff[a, b] for a, b in zip(version_list[:-1], version_list[1:])]
+        return sum(fractions.Fraction(x * (len(diffsize) - i), len(diffsize)) for i, x in enumerate(diffsize))
+
+    while nonlinear_versions:
+        version_to_insert = nonlinear_versions.pop()
+        weighted_avgdiff_after_insert = []
+        for i in range(len(local_versions) + 1):
+            new_version_list = local_versions[:]
+            new_version_list.insert(i, version_to_insert)
+            weighted_avgdiff_after_insert.append(calc_weighted_avgdiff(new_version_list))
+        best_insert = weighted_avgdiff_after_insert.index(min(weighted_avgdiff_after_insert))
+        local_versions.insert(best_insert, version_to_insert)
+    return local_versions
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_sort_versions_matches_baseline(seed):
+    rng = random.Random(seed)
+    versions = [f'v{i}' for i in range(rng.randint(1, 12))]
+    nonlinear_versions = rng.sample(versions, rng.randint(0, len(versions)))
+    diff = {}
+    for i, a in enumerate(versions):
+        for b in versions[i + 1:]:
+            # a small range makes ties common
+            diff[a, b] = diff[b, a] = rng.randint(0, 8)
+    expected = baseline_sort_versions(versions, nonlinear_versions[:], diff)
+    assert makedelta.sort_versions(versions, nonlinear_versions[:], None, diff) == expected
+
+
+def baseline_patch_targets(history: dict[int, str], latest_content: str, source: int):
+    """Targets of one file for the original _patch_candidates.
+
+    `history` maps version ranks (0 is the newest previous version) to the content of the file
+    where it differs from the latest version. Returns ('copy', rank) for an A -> B -> A forward,
+    otherwise ('patch', targets) with 'latest' and ranks.
+    """
+    changelog = sorted(history.items(), reverse=True)
+    content_to_versions = defaultdict(list)
+    for rank, content in changelog:
+        content_to_versions[content].append(rank)
+    content_to_versions[latest_content].append('latest')
+
+    target_versions = ['latest']
+    for rank, _ in changelog:
+        if rank >= source:
+            continue
+        if rank not in target_versions:
+            target_versions.append(rank)
+
+    versions_with_source_file = [x for x in content_to_versions[history[source]] if x in target_versions]
+    if versions_with_source_file:
+        return 'copy', versions_with_source_file[-1]
+
+    seen = set()
+    deduped = []
+    for version in target_versions:
+        content = latest_content if version == 'latest' else history[version]
+        if content not in seen:
+            seen.add(content)
+            deduped.append(version)
+    return 'patch', deduped
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_file_timeline_matches_baseline(seed):
+    rng = random.Random(seed)
+    version_count = rng.randint(1, 30)
+    ranks = rng.sample(range(version_count), rng.randint(1, version_count) if seed % 2 else 1)
+    # few contents, so files often change back to an earlier content
+    history = {rank: rng.choice('ABCD') for rank in ranks}
+    timeline = makedelta._FileTimeline()
+    # delta records are added newest first, shuffled to also cover out of order inserts
+    for rank in (sorted(ranks) if seed % 3 else ranks):
+        timeline.add(rank, history[rank])
+
+    for source in ranks:
+        forward = timeline.newest_before(history[source], source)
+        if forward is not None:
+            actual = 'copy', forward
+        else:
+            actual = 'patch', ['latest', *timeline.oldest_of_each_before(source)]
+        assert actual == baseline_patch_targets(history, 'L', source)
@@ -0,0 +1,69 @@
+import threading
+import time
+
+from makedelta.scheduler import MemoryBudgetExecutor
+
+
+class _Jobs:
+    """Jobs that record their start and hold their memory until released"""
+    def __init__(self):
+        self.started = []
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+
+    def job(self, name: str):
+        with self.lock:
+            self.started.append(name)
+        self.release.wait(10)
+        return name
+
+    def wait_started(self, count: int):
+        deadline = time.monotonic() + 10
+        while len(self.started) < count:
+            assert time.monotonic() < deadline, self.started
+            time.sleep(0.01)
+        # jobs that could start have had time to
+        time.sleep(0.2)
+
+
+def test_largest_first():
+    jobs = _Jobs()
+    with MemoryBudgetExecutor(1, 100, 'test') as executor:
+        executor.submit(1, jobs.job, 'gate')
+        jobs.wait_started(1)
+        futures = [executor.submit(memory, jobs.job, name) for name, memory in [('a', 1), ('b', 5), ('c', 3), ('d', 5), ('e', 2)]]
+        jobs.release.set()
+        for future in futures:
+            future.result()
+    # equal sizes keep submission order
+    assert jobs.started == ['gate', 'b', 'd', 'c', 'e', 'a']
+
+
+def test_smaller_jobs_overtake_until_limit():
+    jobs = _Jobs()
+    with MemoryBudgetExecutor(4, 10, 'test', max_overtakes=2) as executor:
+        futures = [executor.submit(6, jobs.job, 'a')]
+        jobs.wait_started(1)
+        futures += [executor.submit(memory, jobs.job, name) for name, memory in [('b', 8), ('c', 3), ('d', 1), ('e', 1)]]
+        jobs.wait_started(3)
+        # b doesn't fit next to a, c and d start instead, then the budget is held for b
+        assert jobs.started == ['a', 'c', 'd']
+        assert executor.memory_in_use == 10
+        jobs.release.set()
+        for future in futures:
+            future.result()
+    assert jobs.started == ['a', 'c', 'd', 'b', 'e']
+
+
+def test_job_over_budget_runs_alone():
+    jobs = _Jobs()
+    with MemoryBudgetExecutor(4, 10, 'test') as executor:
+        futures = [executor.submit(20, jobs.job, 'large')]
+        jobs.wait_started(1)
+        futures.append(executor.submit(1, jobs.job, 'small'))
+        time.sleep(0.2)
+        assert jobs.started == ['large']
+        jobs.release.set()
+        for future in futures:
+            future.result()
+    assert jobs.started == ['large', 'small']